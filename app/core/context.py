@@ -0,0 +1,138 @@
+# app/core/context.py
+"""Контекст пользователя на время обработки одного апдейта"""
+
+import logging
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Optional, Dict, Any
+
+from aiogram import types
+
+from app.db import users
+
+log = logging.getLogger("kudoaibot")
+
+@dataclass
+class UserContext:
+    """
+    Пользователь, dual balance и активная подписка, загруженные одним запросом
+
+    Данные загружаются лениво при первом обращении через load() и живут
+    до конца обработки апдейта. После записи в БД вызывайте invalidate(),
+    чтобы следующее чтение получило свежие данные.
+    """
+    user_id: int
+    from_user: Optional[types.User] = None
+    user: Optional[Dict[str, Any]] = None
+    subscription: Optional[Dict[str, Any]] = None
+    _loaded: bool = field(default=False, repr=False)
+
+    async def load(self) -> "UserContext":
+        """Загрузить данные (один запрос на апдейт)"""
+        if not self._loaded:
+            row = await users.get_user_with_subscription(self.user_id)
+            self._apply(row)
+            self._loaded = True
+        return self
+
+    async def ensure_user(self) -> "UserContext":
+        """Загрузить данные и создать пользователя, если его ещё нет"""
+        await self.load()
+        if self.user is None and self.from_user is not None:
+            self.user = await users.create_user(
+                user_id=self.user_id,
+                username=self.from_user.username,
+                first_name=self.from_user.first_name,
+                last_name=self.from_user.last_name,
+                language=None  # Не устанавливаем язык по умолчанию
+            )
+            self.subscription = None
+            self._loaded = True
+            log.info(f"✅ Создан новый пользователь: {self.user_id}")
+        return self
+
+    def invalidate(self):
+        """Сбросить загруженные данные после записи"""
+        self.user = None
+        self.subscription = None
+        self._loaded = False
+
+    def _apply(self, row: Optional[Dict[str, Any]]):
+        if not row:
+            self.user = None
+            self.subscription = None
+            return
+
+        sub_id = row.pop('sub_id', None)
+        sub_plan = row.pop('sub_plan', None)
+        sub_end_date = row.pop('sub_end_date', None)
+        self.user = row
+        # Заодно обновляем процессный кэш строк users
+        users.user_cache.set(self.user_id, dict(row))
+        self.subscription = {
+            'id': sub_id,
+            'plan': sub_plan,
+            'end_date': sub_end_date
+        } if sub_id is not None else None
+
+    @property
+    def language(self) -> str:
+        """Язык пользователя (ru по умолчанию)"""
+        if self.user and self.user.get('language'):
+            return self.user['language']
+        return 'ru'
+
+    @property
+    def language_set(self) -> bool:
+        """Выбран ли язык"""
+        return bool(self.user and self.user.get('language') is not None)
+
+    @property
+    def is_blocked(self) -> bool:
+        return bool(self.user and self.user.get('is_blocked'))
+
+    @property
+    def balance(self) -> Dict[str, int]:
+        """Dual balance в формате dual_balance.get_user_dual_balance"""
+        sub = (self.user or {}).get('subscription_coins') or 0
+        perm = (self.user or {}).get('permanent_coins') or 0
+        return {
+            'subscription_coins': sub,
+            'permanent_coins': perm,
+            'total': sub + perm
+        }
+
+    @property
+    def subscription_status(self) -> Dict[str, Any]:
+        """Статус подписки в формате billing.get_user_subscription_status"""
+        balance = self.balance
+        if not self.subscription:
+            return {
+                "has_active": False,
+                "plan": "free",
+                "expires_at": None,
+                "days_left": 0,
+                "balance": balance['total'],
+                "balance_details": balance
+            }
+
+        end_date = self.subscription['end_date']
+        return {
+            "has_active": True,
+            "plan": self.subscription['plan'],
+            "expires_at": end_date,
+            "days_left": max(0, (end_date - datetime.now()).days),
+            "subscription_id": self.subscription['id'],
+            "balance": balance['total'],
+            "balance_details": balance
+        }
+
+async def get_user_context(
+    user_id: int,
+    user_ctx: Optional[UserContext] = None,
+    from_user: Optional[types.User] = None
+) -> UserContext:
+    """Вернуть загруженный контекст (из middleware или созданный на месте)"""
+    if user_ctx is None:
+        user_ctx = UserContext(user_id=user_id, from_user=from_user)
+    return await user_ctx.load()
@@ -0,0 +1,134 @@
+# app/core/leader.py
+"""
+Выбор лидера для фоновых задач между репликами
+
+Периодические задачи (сгорание подписок, предупреждения) должны работать
+в одном процессе, даже если запущено несколько webhook воркеров.
+Лидер держит session-level advisory lock Postgres на отдельном соединении
+(не из пула). Heartbeat проверяет соединение; если оно потеряно, задачи
+останавливаются, а блокировку (её Postgres снимает сам при разрыве)
+забирает другая реплика.
+"""
+
+import os
+import hashlib
+import logging
+import asyncio
+from typing import Awaitable, Callable, Dict, Any, List, Optional
+
+import asyncpg
+
+log = logging.getLogger("leader")
+
+LEADER_HEARTBEAT = float(os.getenv("LEADER_HEARTBEAT", "10"))
+
+def _lock_key(name: str) -> int:
+    """Стабильный int64 ключ advisory lock из имени"""
+    return int.from_bytes(hashlib.sha1(name.encode()).digest()[:8], "big", signed=True)
+
+class LeaderLease:
+    """Аренда лидерства на advisory lock с heartbeat и переизбранием"""
+
+    def __init__(self, name: str, heartbeat: float = LEADER_HEARTBEAT):
+        self.name = name
+        self.key = _lock_key(name)
+        self.heartbeat = heartbeat
+        self._jobs: List[Callable[[], Awaitable[None]]] = []
+        self._running: List[asyncio.Task] = []
+        self._conn: Optional[asyncpg.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+
+        self.is_leader = False
+        self.elections_won = 0
+        self.leadership_lost = 0
+
+    def add_job(self, job: Callable[[], Awaitable[None]]):
+        """Задача (корутинная функция), которая работает только у лидера"""
+        self._jobs.append(job)
+
+    def start(self):
+        """Запустить цикл выборов (идемпотентно)"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _try_acquire(self) -> bool:
+        if self._conn is None or self._conn.is_closed():
+            self._conn = await asyncpg.connect(os.getenv("DATABASE_URL"), timeout=self.heartbeat)
+        return await self._conn.fetchval("SELECT pg_try_advisory_lock($1)", self.key)
+
+    async def _alive(self) -> bool:
+        try:
+            await asyncio.wait_for(self._conn.fetchval("SELECT 1"), timeout=self.heartbeat)
+            return True
+        except Exception as e:
+            log.warning(f"⚠️ Heartbeat лидера {self.name} не прошёл: {e}")
+            return False
+
+    async def _run(self):
+        while True:
+            try:
+                if not self.is_leader:
+                    if await self._try_acquire():
+                        self._become_leader()
+                elif not await self._alive():
+                    await self._step_down()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning(f"⚠️ Ошибка выборов лидера {self.name}: {e}")
+                if self.is_leader:
+                    await self._step_down()
+                await self._close_conn()
+            await asyncio.sleep(self.heartbeat)
+
+    def _become_leader(self):
+        self.is_leader = True
+        self.elections_won += 1
+        log.info(f"👑 Процесс стал лидером {self.name}, запускаем {len(self._jobs)} задач")
+        self._running = [asyncio.create_task(job()) for job in self._jobs]
+
+    async def _step_down(self):
+        self.is_leader = False
+        self.leadership_lost += 1
+        log.warning(f"⚠️ Лидерство {self.name} потеряно, останавливаем задачи")
+        await self._cancel_jobs()
+        await self._close_conn()
+
+    async def _cancel_jobs(self):
+        for task in self._running:
+            task.cancel()
+        await asyncio.gather(*self._running, return_exceptions=True)
+        self._running = []
+
+    async def _close_conn(self):
+        if self._conn is not None:
+            try:
+                await self._conn.close(timeout=5)
+            except Exception:
+                self._conn.terminate()
+            self._conn = None
+
+    async def stop(self):
+        """Остановить задачи и отпустить лидерство"""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self._cancel_jobs()
+        if self.is_leader and self._conn is not None and not self._conn.is_closed():
+            try:
+                await self._conn.execute("SELECT pg_advisory_unlock($1)", self.key)
+            except Exception as e:
+                log.warning(f"⚠️ Не удалось отпустить блокировку {self.name}: {e}")
+        self.is_leader = False
+        await self._close_conn()
+
+    def stats(self) -> Dict[str, Any]:
+        """Состояние лидерства"""
+        return {
+            "name": self.name,
+            "is_leader": self.is_leader,
+            "jobs": len(self._running),
+            "elections_won": self.elections_won,
+            "leadership_lost": self.leadership_lost,
+        }
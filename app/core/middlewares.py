@@ -0,0 +1,56 @@
+# app/core/middlewares.py
+"""Middleware диспетчера"""
+
+import logging
+from typing import Callable, Awaitable, Dict, Any
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from .context import UserContext
+from app.handlers.states import load_user_state, save_user_state
+
+log = logging.getLogger("kudoaibot")
+
+class UserContextMiddleware(BaseMiddleware):
+    """Передаёт обработчикам user_ctx - общий контекст пользователя на апдейт"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is not None:
+            data["user_ctx"] = UserContext(user_id=user.id, from_user=user)
+        return await handler(event, data)
+
+class UserStateMiddleware(BaseMiddleware):
+    """Загружает состояние диалога из хранилища до обработчика и сохраняет после"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+
+        snapshot = await load_user_state(user.id)
+        try:
+            return await handler(event, data)
+        finally:
+            await save_user_state(user.id, snapshot)
+
+def setup_middlewares(dp):
+    """Регистрация middleware"""
+    user_context = UserContextMiddleware()
+    dp.message.middleware(user_context)
+    dp.callback_query.middleware(user_context)
+    user_state = UserStateMiddleware()
+    dp.message.middleware(user_state)
+    dp.callback_query.middleware(user_state)
+    log.info("✅ Middleware зарегистрированы")
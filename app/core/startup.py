@@ -2,20 +2,50 @@
 """Функции запуска и остановки бота"""
 
 import os
+import hmac
 import logging
-import asyncio
 from aiohttp import web
 from aiogram import types
 
-from app.db import database, subscriptions
+from app.db import database, users
 from .bot import get_bot
+from .middlewares import setup_middlewares
+from .update_queue import UpdateQueue
+from .leader import LeaderLease
 
 log = logging.getLogger("kudoaibot")
 
+# Режим приёма апдейтов: queue - ответ сразу + очередь, inline - обработка в запросе
+WEBHOOK_INGRESS = os.getenv("WEBHOOK_INGRESS", "queue")
+
+# Токен доступа к GET /stats (пусто - эндпоинт отключён)
+STATS_TOKEN = os.getenv("STATS_TOKEN", "")
+
+# Очередь апдейтов (только webhook + queue)
+_update_queue = None
+
+# Аренда лидерства для периодических задач
+_leader = None
+
+def _rss_bytes() -> int:
+    """Текущий RSS процесса (Linux), 0 если недоступно"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except Exception:
+        return 0
+
 async def setup_bot():
     """Инициализация бота и обработчиков"""
     log.info("🔧 Инициализация бота...")
     
+    # Процессы обработки изображений поднимаем до фоновых потоков
+    try:
+        from app.services import image_processing
+        await image_processing.start_pool()
+    except Exception as e:
+        log.error(f"❌ Ошибка запуска пула обработки изображений: {e}")
+    
     # Инициализация базы данных
     db_ok = await database.init_db()
     if not db_ok:
@@ -25,30 +55,55 @@ async def setup_bot():
     log.info("✅ Подключение к базе данных установлено")
     log.info("✅ Таблицы базы данных созданы/обновлены")
     
-    # Запуск задачи проверки истекших подписок
-    asyncio.create_task(check_expired_subscriptions_task())
-    log.info("✅ Задача проверки подписок запущена")
+    # Middleware диспетчера
+    bot, dp = get_bot()
+    setup_middlewares(dp)
     
-    # Запуск задачи очистки подписочных монет
+    # Периодические задачи работают только у лидера (одна реплика из N):
+    # сгорание подписок, возобновление задач VEO 3, брошенных репликами,
+    # возврат зависших резервов монеток и очистка общего хранилища состояний
+    global _leader
     from app.services.coin_expiration import coin_expiration_task
-    asyncio.create_task(coin_expiration_task())
-    log.info("✅ Задача очистки подписочных монет запущена")
-
-async def check_expired_subscriptions_task():
-    """Фоновая задача проверки истекших подписок"""
-    while True:
-        try:
-            await asyncio.sleep(3600)  # Проверяем каждый час
-            expired_count = await subscriptions.deactivate_expired_subscriptions()
-            if expired_count > 0:
-                log.info(f"✅ Деактивировано {expired_count} истекших подписок")
-        except Exception as e:
-            log.error(f"❌ Ошибка проверки подписок: {e}")
+    from app.services.clients.veo_client import veo3_resume_task
+    from app.services.billing import reservation_sweep_task
+    from app.handlers.state_storage import get_storage, state_sweep_task
+    _leader = LeaderLease("kudoaibot:periodic_jobs")
+    _leader.add_job(coin_expiration_task)
+    _leader.add_job(veo3_resume_task)
+    _leader.add_job(reservation_sweep_task)
+    if get_storage().shared:
+        _leader.add_job(state_sweep_task)
+    _leader.start()
+    log.info("✅ Выборы лидера для фоновых задач запущены")
 
 async def graceful_shutdown():
     """Graceful shutdown функции"""
     log.info("🛑 Начинаем graceful shutdown...")
     
+    if _update_queue:
+        try:
+            await _update_queue.stop()
+        except Exception as e:
+            log.error(f"❌ Ошибка остановки очереди апдейтов: {e}")
+    
+    if _leader:
+        try:
+            await _leader.stop()
+        except Exception as e:
+            log.error(f"❌ Ошибка остановки фоновых задач лидера: {e}")
+    
+    try:
+        from app.services.veo_scheduler import stop_scheduler
+        await stop_scheduler()
+    except Exception as e:
+        log.error(f"❌ Ошибка остановки планировщика Veo: {e}")
+    
+    try:
+        from app.services.notifier import stop_queue
+        await stop_queue()
+    except Exception as e:
+        log.error(f"❌ Ошибка остановки очереди исходящих сообщений: {e}")
+    
     try:
         bot, dp = get_bot()
         TELEGRAM_MODE = os.getenv("TELEGRAM_MODE", "webhook")
@@ -68,6 +123,36 @@ async def graceful_shutdown():
     except Exception as e:
         log.error(f"❌ Ошибка получения бота для shutdown: {e}")
     
+    try:
+        from app.services.clients.google_auth import stop_token_provider
+        await stop_token_provider()
+    except Exception as e:
+        log.error(f"❌ Ошибка остановки обновления Google токена: {e}")
+    
+    try:
+        from app.services.clients import veo_client
+        await veo_client.close_session()
+    except Exception as e:
+        log.error(f"❌ Ошибка закрытия HTTP сессии Veo: {e}")
+    
+    try:
+        from app.services.clients import tryon_client
+        await tryon_client.close_session()
+    except Exception as e:
+        log.error(f"❌ Ошибка закрытия HTTP сессии примерочной: {e}")
+    
+    try:
+        from app.services.ai_helper import close_openai_client
+        await close_openai_client()
+    except Exception as e:
+        log.error(f"❌ Ошибка закрытия клиента OpenAI: {e}")
+    
+    try:
+        from app.services import image_processing
+        image_processing.shutdown_pool()
+    except Exception as e:
+        log.error(f"❌ Ошибка остановки пула обработки изображений: {e}")
+    
     try:
         await database.close_db()
         log.info("✅ Соединение с БД закрыто")
@@ -78,21 +163,74 @@ async def graceful_shutdown():
 
 async def setup_web_app(dp, bot) -> web.Application:
     """Инициализация web приложения"""
+    global _update_queue
     log.info("🔧 Инициализация web приложения...")
     
     app = web.Application()
     
+    if WEBHOOK_INGRESS == "queue":
+        _update_queue = UpdateQueue(dp, bot)
+        _update_queue.start()
+    log.info(f"📥 Режим приёма апдейтов: {WEBHOOK_INGRESS}")
+    
     async def telegram_webhook(request):
         """Обработчик Telegram webhook"""
         try:
             data = await request.json()
             update = types.Update(**data)
+        except Exception as e:
+            log.exception(f"Webhook error: {e}")
+            return web.Response(text="Error", status=500)
+        
+        if _update_queue:
+            # Отвечаем сразу; при переполнении Telegram повторит доставку позже
+            if not _update_queue.put(update):
+                return web.Response(text="Busy", status=503)
+            return web.Response(text="OK", status=200)
+        
+        try:
             await dp.feed_update(bot, update)
             return web.Response(text="OK", status=200)
         except Exception as e:
             log.exception(f"Webhook error: {e}")
             return web.Response(text="Error", status=500)
     
+    async def stats_handler(request):
+        """Метрики процесса (только с Authorization: Bearer <STATS_TOKEN>)"""
+        if not STATS_TOKEN:
+            raise web.HTTPNotFound()
+        token = request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+        if not hmac.compare_digest(token.encode(), STATS_TOKEN.encode()):
+            raise web.HTTPUnauthorized()
+        
+        stats = {"ingress": WEBHOOK_INGRESS, "user_cache": users.user_cache.stats()}
+        if _update_queue:
+            stats["updates"] = _update_queue.stats()
+        if _leader:
+            stats["leader"] = _leader.stats()
+        from app.services.veo_scheduler import get_scheduler
+        stats["veo"] = get_scheduler().stats()
+        from app.services.clients.google_auth import get_token_provider
+        stats["google_token"] = get_token_provider().stats()
+        from app.services import video_processing
+        stats["ffmpeg"] = video_processing.get_stats()
+        from app.services import video_stream
+        stats["video_delivery"] = video_stream.get_stats()
+        from app.services.clients import tryon_client
+        stats["tryon"] = tryon_client.get_stats()
+        from app.services import tryon_cache
+        stats["tryon_cache"] = tryon_cache.get_stats()
+        from app.services import ai_helper
+        stats["openai"] = ai_helper.get_stats()
+        from app.services import image_processing
+        stats["images"] = image_processing.get_stats()
+        from app.services.notifier import get_queue
+        stats["outbound"] = get_queue().stats()
+        from app.handlers import states
+        stats["user_states"] = states.get_stats()
+        stats["rss_bytes"] = _rss_bytes()
+        return web.json_response(stats)
+    
     # Импортируем webhooks
     from app.webhooks.yookassa import yookassa_webhook
     from app.webhooks.sora2 import sora2_callback
@@ -100,6 +238,7 @@ async def setup_web_app(dp, bot) -> web.Application:
     # Маршруты
     app.router.add_get('/', lambda _: web.Response(text="Bot is running ✅"))
     app.router.add_post('/webhook', telegram_webhook)
+    app.router.add_get('/stats', stats_handler)
     app.router.add_post('/yookassa_webhook', yookassa_webhook)
     app.router.add_post('/sora_callback', sora2_callback)
     
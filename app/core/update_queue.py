@@ -0,0 +1,179 @@
+# app/core/update_queue.py
+"""
+Очередь входящих апдейтов Telegram для webhook режима
+
+Webhook сразу отвечает Telegram 200 OK и кладёт апдейт в очередь своего чата.
+У каждого чата с необработанными апдейтами своя FIFO и своя задача-обработчик,
+поэтому порядок внутри чата сохраняется, а медленный обработчик (примерка,
+GPT, отправка в Sora/Veo) задерживает только свой чат. Общее число
+одновременно выполняемых обработчиков ограничено UPDATE_WORKERS,
+число ожидающих апдейтов - UPDATE_QUEUE_SIZE.
+"""
+
+import os
+import time
+import logging
+import asyncio
+from collections import deque
+from typing import Deque, Dict, Any, Optional, Set, Tuple
+
+from aiogram import types
+
+log = logging.getLogger("update_queue")
+
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "64"))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+UPDATE_DRAIN_TIMEOUT = int(os.getenv("UPDATE_DRAIN_TIMEOUT", "20"))
+
+
+def _update_key(update: types.Update) -> int:
+    """Ключ очереди: чат, иначе пользователь, иначе update_id"""
+    try:
+        event = update.event
+    except Exception:
+        return update.update_id
+
+    chat = getattr(event, "chat", None)
+    if chat is None:
+        message = getattr(event, "message", None)
+        chat = getattr(message, "chat", None)
+    if chat is not None:
+        return chat.id
+
+    user = getattr(event, "from_user", None)
+    if user is not None:
+        return user.id
+
+    return update.update_id
+
+
+class UpdateQueue:
+    """Очереди апдейтов по чатам с общим лимитом обработчиков и метриками"""
+
+    def __init__(self, dp, bot, workers: int = UPDATE_WORKERS, maxsize: int = UPDATE_QUEUE_SIZE):
+        self.dp = dp
+        self.bot = bot
+        self.workers = max(1, workers)
+        self.maxsize = max(1, maxsize)
+        # chat key -> апдейты, ожидающие обработки (enqueued_at, update)
+        self._chats: Dict[int, Deque[Tuple[float, types.Update]]] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._accepting = False
+        self._queued = 0
+        self._active = 0
+
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.max_depth = 0
+        self.max_active = 0
+        self._busy_seconds = 0.0
+        self._max_wait = 0.0
+
+    def start(self):
+        """Начать приём апдейтов"""
+        if self._accepting:
+            return
+        self._semaphore = asyncio.Semaphore(self.workers)
+        self._accepting = True
+        log.info(f"✅ Очередь апдейтов запущена: до {self.workers} обработчиков одновременно")
+
+    def put(self, update: types.Update) -> bool:
+        """
+        Положить апдейт в очередь его чата без ожидания
+
+        Returns:
+            False если очередь переполнена или остановлена (backpressure)
+        """
+        if not self._accepting:
+            self.rejected += 1
+            return False
+
+        if self._queued >= self.maxsize:
+            self.rejected += 1
+            log.warning(f"⚠️ Очередь апдейтов переполнена, update {update.update_id} отклонён")
+            return False
+
+        key = _update_key(update)
+        item = (time.monotonic(), update)
+        pending = self._chats.get(key)
+        if pending is not None:
+            # Чат уже обрабатывается - его задача заберёт апдейт по порядку
+            pending.append(item)
+        else:
+            self._chats[key] = deque([item])
+            task = asyncio.create_task(self._drain_chat(key))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+        self._queued += 1
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, self._queued)
+        return True
+
+    def depth(self) -> int:
+        """Текущее количество ожидающих апдейтов"""
+        return self._queued
+
+    async def _drain_chat(self, key: int):
+        """Обработать апдейты одного чата по порядку и удалить его очередь"""
+        pending = self._chats[key]
+        try:
+            while pending:
+                enqueued_at, update = pending.popleft()
+                self._queued -= 1
+                async with self._semaphore:
+                    await self._process(update, enqueued_at)
+        finally:
+            # Между проверкой pending и удалением нет await - новый апдейт
+            # этого чата либо уже обработан, либо создаст новую задачу
+            self._queued -= len(pending)
+            self._chats.pop(key, None)
+
+    async def _process(self, update: types.Update, enqueued_at: float):
+        started = time.monotonic()
+        self._max_wait = max(self._max_wait, started - enqueued_at)
+        self._active += 1
+        self.max_active = max(self.max_active, self._active)
+        try:
+            await self.dp.feed_update(self.bot, update)
+            self.processed += 1
+        except Exception as e:
+            self.failed += 1
+            log.exception(f"❌ Ошибка обработки update {update.update_id}: {e}")
+        finally:
+            self._active -= 1
+            self._busy_seconds += time.monotonic() - started
+
+    async def stop(self, timeout: Optional[float] = UPDATE_DRAIN_TIMEOUT):
+        """Перестать принимать апдейты, дождаться обработки очередей и остановить обработчики"""
+        self._accepting = False
+        if self._tasks:
+            _, still_running = await asyncio.wait(set(self._tasks), timeout=timeout)
+            if still_running:
+                log.warning(f"⚠️ Не успели обработать {self.depth()} апдейтов "
+                            f"({len(still_running)} чатов) до остановки")
+                for task in still_running:
+                    task.cancel()
+                await asyncio.gather(*still_running, return_exceptions=True)
+        log.info("✅ Очередь апдейтов остановлена")
+
+    def stats(self) -> Dict[str, Any]:
+        """Метрики очереди"""
+        return {
+            "workers": self.workers,
+            "active": self._active,
+            "max_active": self.max_active,
+            "chats": len(self._chats),
+            "depth": self.depth(),
+            "max_depth": self.max_depth,
+            "capacity": self.maxsize,
+            "enqueued": self.enqueued,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "busy_seconds": round(self._busy_seconds, 3),
+            "max_wait_seconds": round(self._max_wait, 3),
+        }
@@ -0,0 +1,161 @@
+"""
+Модуль для работы с задачами генерации (таблица generations)
+"""
+import os
+import json
+import uuid
+import socket
+import logging
+from typing import Optional, Dict, Any, List, Set
+from .database import execute_query, fetch_one, fetch_all
+
+log = logging.getLogger("database.generations")
+
+UNFINISHED_STATUSES = ('pending', 'processing', 'delivering')
+
+# Идентификатор процесса - владельца задач (owner)
+OWNER = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+async def create_generation(
+    task_id: str,
+    user_id: int,
+    feature: str,
+    coins_spent: int,
+    prompt: Optional[str] = None,
+    model: Optional[str] = None,
+    params: Optional[Dict[str, Any]] = None,
+    reservation_id: Optional[int] = None
+) -> Optional[Dict[str, Any]]:
+    """Создать задачу генерации в статусе pending"""
+    try:
+        query = """
+            INSERT INTO generations
+            (task_id, user_id, feature, coins_spent, status, prompt, model, params,
+             reservation_id, owner)
+            VALUES ($1, $2, $3, $4, 'pending', $5, $6, $7::jsonb, $8, $9)
+            RETURNING *
+        """
+        return await fetch_one(
+            query, task_id, user_id, feature, coins_spent, prompt, model,
+            json.dumps(params or {}), reservation_id, OWNER
+        )
+    except Exception as e:
+        log.error(f"❌ Ошибка создания задачи генерации {task_id}: {e}")
+        return None
+
+async def set_operation(task_id: str, operation_name: str) -> bool:
+    """Операция запущена: сохранить её имя"""
+    try:
+        await execute_query("""
+            UPDATE generations
+            SET operation_name = $2, status = 'processing', updated_at = NOW()
+            WHERE task_id = $1
+        """, task_id, operation_name)
+        return True
+    except Exception as e:
+        log.error(f"❌ Ошибка сохранения операции задачи {task_id}: {e}")
+        return False
+
+async def mark_delivering(task_id: str) -> bool:
+    """
+    Результат готов и отправляется пользователю
+
+    Returns:
+        False если задача уже завершена или её забрал другой процесс
+    """
+    try:
+        result = await execute_query("""
+            UPDATE generations SET status = 'delivering', updated_at = NOW()
+            WHERE task_id = $1 AND owner = $2 AND status = ANY($3::text[])
+        """, task_id, OWNER, list(UNFINISHED_STATUSES))
+        return result == "UPDATE 1"
+    except Exception as e:
+        log.error(f"❌ Ошибка обновления задачи {task_id}: {e}")
+        return False
+
+async def complete_generation(task_id: str, result_file_id: Optional[str] = None) -> bool:
+    """Задача выполнена и доставлена"""
+    try:
+        await execute_query("""
+            UPDATE generations
+            SET status = 'completed', result_file_id = $2,
+                completed_at = NOW(), updated_at = NOW()
+            WHERE task_id = $1
+        """, task_id, result_file_id)
+        return True
+    except Exception as e:
+        log.error(f"❌ Ошибка завершения задачи {task_id}: {e}")
+        return False
+
+async def fail_generation(task_id: str, error_message: str) -> bool:
+    """
+    Задача завершилась ошибкой
+
+    Returns:
+        True если задача этого процесса переведена в failed (можно вернуть монетки),
+        False если она уже завершена, принадлежит другому процессу или ошибка БД
+    """
+    try:
+        result = await execute_query("""
+            UPDATE generations
+            SET status = 'failed', error_message = $2,
+                completed_at = NOW(), updated_at = NOW()
+            WHERE task_id = $1 AND owner = $3 AND status = ANY($4::text[])
+        """, task_id, error_message[:1000], OWNER, list(UNFINISHED_STATUSES))
+        return result == "UPDATE 1"
+    except Exception as e:
+        log.error(f"❌ Ошибка пометки задачи {task_id} как failed: {e}")
+        return False
+
+async def heartbeat_generations(task_ids: List[str]) -> Optional[Set[str]]:
+    """
+    Продлить владение задачами этого процесса (обновить updated_at)
+
+    Returns:
+        task_id, которые всё ещё принадлежат процессу, или None при ошибке БД
+    """
+    if not task_ids:
+        return set()
+    try:
+        rows = await fetch_all("""
+            UPDATE generations SET updated_at = NOW()
+            WHERE task_id = ANY($1::text[]) AND owner = $2 AND status = ANY($3::text[])
+            RETURNING task_id
+        """, task_ids, OWNER, list(UNFINISHED_STATUSES))
+        return {row['task_id'] for row in rows}
+    except Exception as e:
+        log.error(f"❌ Ошибка heartbeat задач генерации: {e}")
+        return None
+
+async def claim_unfinished_generations(task_prefix: str, stale_after: float) -> List[Dict[str, Any]]:
+    """
+    Забрать незавершённые задачи провайдера (по префиксу task_id), брошенные владельцем
+
+    Берутся только задачи, heartbeat которых старше stale_after секунд
+    (процесс-владелец остановлен или упал). Строки блокируются с SKIP LOCKED,
+    поэтому одновременно запущенные реплики не заберут одну задачу дважды.
+    У забранных задач owner становится текущим процессом, attempts растёт.
+    params возвращается как dict.
+    """
+    try:
+        rows = await fetch_all("""
+            WITH stale AS (
+                SELECT id FROM generations
+                WHERE task_id LIKE $1 || '%' AND status = ANY($2::text[])
+                  AND updated_at < NOW() - make_interval(secs => $3)
+                ORDER BY created_at
+                FOR UPDATE SKIP LOCKED
+            )
+            UPDATE generations g
+            SET attempts = g.attempts + 1, owner = $4, updated_at = NOW()
+            FROM stale
+            WHERE g.id = stale.id
+            RETURNING g.*, EXTRACT(EPOCH FROM (NOW() - g.created_at)) AS age_seconds
+        """, task_prefix, list(UNFINISHED_STATUSES), float(stale_after), OWNER)
+        for row in rows:
+            if isinstance(row.get('params'), str):
+                row['params'] = json.loads(row['params'])
+        return rows
+    except Exception as e:
+        log.error(f"❌ Ошибка получения незавершённых задач {task_prefix}: {e}")
+        return []
@@ -0,0 +1,14 @@
+-- Миграция 002: Резервирование монеток
+-- Описание: Разбивка списания по типам монет в журнале транзакций.
+-- Резерв хранится строкой transactions с типом 'reserve', подтверждение
+-- меняет тип на 'spend', отмена - на 'released' с отдельной строкой 'refund'.
+
+ALTER TABLE transactions ADD COLUMN IF NOT EXISTS subscription_delta INT;
+ALTER TABLE transactions ADD COLUMN IF NOT EXISTS permanent_delta INT;
+
+-- Незакрытые резервы старше RESERVE_TTL возвращает billing.reservation_sweep_task
+CREATE INDEX IF NOT EXISTS idx_transactions_reserve
+    ON transactions(created_at) WHERE transaction_type = 'reserve';
+
+COMMENT ON COLUMN transactions.subscription_delta IS '🟢 Изменение подписочных монет';
+COMMENT ON COLUMN transactions.permanent_delta IS '🟣 Изменение постоянных монет';
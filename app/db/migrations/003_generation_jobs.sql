@@ -0,0 +1,20 @@
+-- Миграция 003: Долговечные задачи генерации
+-- Описание: Таблица generations хранит состояние каждой задачи генерации видео,
+-- чтобы после рестарта процесса продолжить опрос операции или вернуть монетки.
+-- Статусы: pending (операция ещё не запущена), processing (операция запущена),
+-- delivering (результат отправляется), completed, failed.
+
+ALTER TABLE generations ADD COLUMN IF NOT EXISTS task_id TEXT;
+ALTER TABLE generations ADD COLUMN IF NOT EXISTS operation_name TEXT;
+ALTER TABLE generations ADD COLUMN IF NOT EXISTS model TEXT;
+ALTER TABLE generations ADD COLUMN IF NOT EXISTS params JSONB;
+ALTER TABLE generations ADD COLUMN IF NOT EXISTS attempts INT DEFAULT 0;
+ALTER TABLE generations ADD COLUMN IF NOT EXISTS reservation_id INT;
+ALTER TABLE generations ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP;
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_generations_task_id ON generations(task_id);
+CREATE INDEX IF NOT EXISTS idx_generations_unfinished
+    ON generations(created_at) WHERE status IN ('pending', 'processing', 'delivering');
+
+COMMENT ON COLUMN generations.operation_name IS 'Имя long-running операции провайдера';
+COMMENT ON COLUMN generations.attempts IS 'Сколько раз задача возобновлялась после рестарта';
@@ -0,0 +1,6 @@
+-- Миграция 004: Индекс для пакетного сгорания подписок
+-- Описание: Пакетное истечение подписок выбирает активные подписки
+-- с end_date <= NOW() - частичный индекс делает выборку пакета дешёвой.
+
+CREATE INDEX IF NOT EXISTS idx_subscriptions_active_end_date
+    ON subscriptions(end_date) WHERE is_active = TRUE;
@@ -0,0 +1,8 @@
+-- Миграция 005: Состояние предупреждений об истечении подписки
+-- Описание: warned_days - наименьший порог (в днях), по которому пользователь
+-- уже предупреждён. NULL - предупреждений ещё не было. Каждый порог
+-- (например 3 и 1 день) отправляется ровно один раз.
+
+ALTER TABLE subscriptions ADD COLUMN IF NOT EXISTS warned_days INT;
+
+COMMENT ON COLUMN subscriptions.warned_days IS 'Наименьший отправленный порог предупреждения (дней)';
@@ -0,0 +1,15 @@
+-- Миграция 006: Общее хранилище состояний диалогов
+-- Описание: состояние пользователя (UserState) в компактном JSON, чтобы
+-- апдейты одного пользователя могли обрабатывать разные воркеры и реплики.
+-- Строка удаляется, когда состояние возвращается к значениям по умолчанию.
+-- Строки без изменений дольше STATE_IDLE_TTL удаляет state_sweep_task лидера.
+
+CREATE TABLE IF NOT EXISTS user_states (
+    user_id BIGINT PRIMARY KEY,
+    data JSONB NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_user_states_updated_at ON user_states (updated_at);
+
+COMMENT ON TABLE user_states IS 'Состояния диалогов пользователей (общие для всех воркеров)';
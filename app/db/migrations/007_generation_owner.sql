@@ -0,0 +1,11 @@
+-- Миграция 007: Владелец незавершённой задачи генерации
+-- Описание: процесс, который опрашивает операцию, пишет себя в owner и
+-- периодически обновляет updated_at (heartbeat). Другая реплика забирает
+-- задачу только если heartbeat устарел, поэтому живые задачи не дублируются.
+
+ALTER TABLE generations ADD COLUMN IF NOT EXISTS owner TEXT;
+
+CREATE INDEX IF NOT EXISTS idx_generations_heartbeat
+    ON generations(updated_at) WHERE status IN ('pending', 'processing', 'delivering');
+
+COMMENT ON COLUMN generations.owner IS 'Процесс, который ведёт задачу (host:pid:id)';
@@ -1,10 +1,12 @@
 """
 Модуль для работы с подписками
 """
+import os
 import logging
 from typing import Optional, Dict, Any, List
 from datetime import datetime, timedelta
 from .database import execute_query, fetch_one, fetch_all
+from .users import user_cache
 
 log = logging.getLogger("database.subscriptions")
 
@@ -67,34 +69,146 @@ async def deactivate_subscription(subscription_id: int) -> bool:
         log.error(f"❌ Ошибка деактивации подписки {subscription_id}: {e}")
         return False
 
+# Пакет истекших подписок за один запрос: деактивация подписок, сгорание
+# подписочных монет, сброс тарифа на free и строки журнала 'expire'.
+# Монеты не сгорают, если у пользователя есть другая действующая подписка.
+_EXPIRE_BATCH_SQL = """
+    WITH expired AS (
+        SELECT id, user_id
+        FROM subscriptions
+        WHERE is_active = TRUE AND end_date <= NOW()
+        ORDER BY end_date
+        LIMIT $1
+        FOR UPDATE SKIP LOCKED
+    ),
+    deactivated AS (
+        UPDATE subscriptions s
+        SET is_active = FALSE, updated_at = NOW()
+        FROM expired e
+        WHERE s.id = e.id
+        RETURNING s.user_id
+    ),
+    old AS (
+        SELECT u.user_id,
+               COALESCE(u.subscription_coins, 0) AS burned,
+               COALESCE(u.permanent_coins, 0) AS permanent_coins,
+               u.language
+        FROM users u
+        WHERE u.user_id IN (SELECT DISTINCT user_id FROM expired)
+          AND NOT EXISTS (
+              SELECT 1 FROM subscriptions s2
+              WHERE s2.user_id = u.user_id
+                AND s2.is_active = TRUE
+                AND s2.end_date > NOW()
+          )
+        FOR UPDATE OF u
+    ),
+    updated AS (
+        UPDATE users u
+        SET subscription_coins = 0,
+            balance = o.permanent_coins,
+            plan = 'free',
+            updated_at = NOW()
+        FROM old o
+        WHERE u.user_id = o.user_id
+        RETURNING u.user_id
+    ),
+    ledger AS (
+        INSERT INTO transactions
+            (user_id, transaction_type, coins_delta, balance_before, balance_after,
+             note, subscription_delta, permanent_delta)
+        SELECT o.user_id, 'expire', -o.burned, o.burned + o.permanent_coins, o.permanent_coins,
+               'Сгорание подписочных монет', -o.burned, 0
+        FROM old o
+        WHERE o.burned > 0
+    )
+    SELECT d.deactivated, o.user_id, o.burned, o.permanent_coins, o.language
+    FROM (SELECT COUNT(*) AS deactivated FROM deactivated) d
+    LEFT JOIN old o ON TRUE
+"""
+
+EXPIRE_BATCH_SIZE = int(os.getenv("EXPIRE_BATCH_SIZE", "5000"))
+
+async def expire_subscriptions_batch(batch_size: int = EXPIRE_BATCH_SIZE) -> Dict[str, Any]:
+    """
+    Истечь один пакет подписок (один запрос, одна транзакция)
+    
+    Returns:
+        {"deactivated": число подписок, "users": [{user_id, burned, permanent_coins, language}]}
+    """
+    rows = await fetch_all(_EXPIRE_BATCH_SQL, batch_size)
+    deactivated = rows[0]['deactivated'] if rows else 0
+    expired_users = [
+        {k: row[k] for k in ('user_id', 'burned', 'permanent_coins', 'language')}
+        for row in rows if row['user_id'] is not None
+    ]
+    user_cache.invalidate_many([row['user_id'] for row in expired_users])
+    return {"deactivated": deactivated, "users": expired_users}
+
+async def expire_subscriptions(batch_size: int = EXPIRE_BATCH_SIZE) -> List[Dict[str, Any]]:
+    """
+    Истечь все просроченные подписки пакетами
+    
+    Returns:
+        Пользователи, у которых истекла подписка (для уведомлений после коммита)
+    """
+    expired_users: List[Dict[str, Any]] = []
+    while True:
+        batch = await expire_subscriptions_batch(batch_size)
+        expired_users.extend(batch["users"])
+        if batch["deactivated"] < batch_size:
+            break
+    if expired_users:
+        log.info(f"✅ Истекли подписки у {len(expired_users)} пользователей")
+    return expired_users
+
 async def deactivate_expired_subscriptions() -> int:
-    """Деактивировать все истекшие подписки"""
+    """Деактивировать все истекшие подписки (с сгоранием подписочных монет)"""
     try:
-        query = """
-            UPDATE subscriptions
-            SET is_active = FALSE,
-                updated_at = CURRENT_TIMESTAMP
-            WHERE is_active = TRUE 
-            AND end_date <= CURRENT_TIMESTAMP
-            RETURNING id, user_id
-        """
-        expired = await fetch_all(query)
-        
-        if expired:
-            log.info(f"✅ Деактивировано {len(expired)} истекших подписок")
-            
-            # Обновляем тарифы пользователей на free
-            for sub in expired:
-                await execute_query(
-                    "UPDATE users SET plan = 'free', updated_at = CURRENT_TIMESTAMP WHERE user_id = $1",
-                    sub['user_id']
-                )
-        
-        return len(expired)
+        return len(await expire_subscriptions())
     except Exception as e:
         log.error(f"❌ Ошибка деактивации истекших подписок: {e}")
         return 0
 
+# Подписки, по которым наступил новый порог предупреждения: помечаем порог
+# отправленным в том же запросе, поэтому каждый порог уходит ровно один раз
+_CLAIM_WARNINGS_SQL = """
+    WITH due AS (
+        SELECT s.id,
+               (SELECT t FROM unnest($1::int[]) AS t
+                WHERE s.end_date <= NOW() + make_interval(days => t)
+                ORDER BY t
+                LIMIT 1) AS threshold
+        FROM subscriptions s
+        WHERE s.is_active = TRUE
+          AND s.end_date > NOW()
+          AND s.end_date <= NOW() + make_interval(days => $2)
+        FOR UPDATE SKIP LOCKED
+    )
+    UPDATE subscriptions s
+    SET warned_days = d.threshold
+    FROM due d, users u
+    WHERE s.id = d.id
+      AND u.user_id = s.user_id
+      AND (s.warned_days IS NULL OR s.warned_days > d.threshold)
+    RETURNING s.id, s.user_id, s.plan, s.end_date, d.threshold,
+              COALESCE(u.subscription_coins, 0) AS subscription_coins, u.language
+"""
+
+async def claim_expiry_warnings(thresholds: List[int]) -> List[Dict[str, Any]]:
+    """
+    Подписки, которым пора отправить предупреждение об истечении
+    
+    Args:
+        thresholds: Пороги в днях до истечения (например [3, 1])
+    
+    Returns:
+        Подписки с наступившим порогом; порог сразу помечается отправленным
+    """
+    if not thresholds:
+        return []
+    return await fetch_all(_CLAIM_WARNINGS_SQL, sorted(thresholds), max(thresholds))
+
 async def check_subscription_status(user_id: int) -> Dict[str, Any]:
     """Проверить статус подписки пользователя"""
     try:
@@ -137,3 +137,25 @@ async def get_spending_stats(user_id: int, days: int = 30) -> Dict[str, Any]:
             "features": [],
             "period_days": days
         }
+
+async def get_stale_reservations(older_than: float, limit: int = 500) -> List[Dict[str, Any]]:
+    """
+    Резервы старше older_than секунд, которые так и не подтвердили и не вернули
+
+    Резервы незавершённых задач генерации (их ведёт процесс-владелец) не возвращаются.
+    generation_status - статус генерации резерва (None, если её нет).
+    """
+    try:
+        return await fetch_all("""
+            SELECT t.id, t.user_id, t.feature, t.created_at, g.status AS generation_status
+            FROM transactions t
+            LEFT JOIN generations g ON g.reservation_id = t.id
+            WHERE t.transaction_type = 'reserve'
+              AND t.created_at < NOW() - make_interval(secs => $1)
+              AND (g.status IS NULL OR g.status NOT IN ('pending', 'processing', 'delivering'))
+            ORDER BY t.created_at
+            LIMIT $2
+        """, float(older_than), limit)
+    except Exception as e:
+        log.error(f"❌ Ошибка получения зависших резервов: {e}")
+        return []
@@ -0,0 +1,47 @@
+"""
+Модуль для работы с состояниями диалогов (таблица user_states)
+"""
+import json
+import logging
+from typing import Optional, Dict, Any
+from .database import execute_query, fetch_one
+
+log = logging.getLogger("database.user_states")
+
+async def load_state(user_id: int) -> Optional[Dict[str, Any]]:
+    """Компактное состояние пользователя или None, если его нет"""
+    row = await fetch_one("SELECT data FROM user_states WHERE user_id = $1", user_id)
+    if not row:
+        return None
+    data = row["data"]
+    return json.loads(data) if isinstance(data, str) else data
+
+async def save_state(user_id: int, data: Dict[str, Any]):
+    """Сохранить компактное состояние пользователя"""
+    await execute_query("""
+        INSERT INTO user_states (user_id, data, updated_at)
+        VALUES ($1, $2::jsonb, NOW())
+        ON CONFLICT (user_id) DO UPDATE
+        SET data = EXCLUDED.data, updated_at = NOW()
+    """, user_id, json.dumps(data, ensure_ascii=False, separators=(",", ":")))
+
+async def delete_state(user_id: int):
+    """Удалить состояние (пользователь вернулся в состояние по умолчанию)"""
+    await execute_query("DELETE FROM user_states WHERE user_id = $1", user_id)
+
+async def delete_idle_states(idle_ttl: int, batch_size: int = 5000) -> int:
+    """Удалить состояния без изменений дольше idle_ttl секунд (пакетами), вернуть их число"""
+    deleted = 0
+    while True:
+        result = await execute_query("""
+            DELETE FROM user_states
+            WHERE user_id IN (
+                SELECT user_id FROM user_states
+                WHERE updated_at < NOW() - make_interval(secs => $1)
+                LIMIT $2
+            )
+        """, float(idle_ttl), batch_size)
+        count = int(result.split()[-1])
+        deleted += count
+        if count < batch_size:
+            return deleted
@@ -1,13 +1,25 @@
 """
 Модуль для работы с пользователями
 """
+import os
 import logging
 from typing import Optional, Dict, Any
 from datetime import datetime
 from .database import execute_query, fetch_one, fetch_all
+from .cache import TTLCache
 
 log = logging.getLogger("database.users")
 
+# Кэш строк users по user_id; все записи ниже инвалидируют его
+user_cache = TTLCache(
+    maxsize=int(os.getenv("USER_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("USER_CACHE_TTL", "60"))
+)
+
+def invalidate_user_cache(user_id: int):
+    """Сбросить кэш пользователя после изменения строки users"""
+    user_cache.invalidate(user_id)
+
 async def create_user(
     user_id: int,
     username: Optional[str] = None,
@@ -28,6 +40,10 @@ async def create_user(
             RETURNING *
         """
         user = await fetch_one(query, user_id, username, first_name, last_name, language)
+        if user:
+            user_cache.set(user_id, user)
+        else:
+            user_cache.invalidate(user_id)
         log.info(f"✅ Пользователь создан/обновлен: {user_id}")
         return user
     except Exception as e:
@@ -35,10 +51,18 @@ async def create_user(
         raise
 
 async def get_user(user_id: int) -> Optional[Dict[str, Any]]:
-    """Получить пользователя по ID"""
+    """Получить пользователя по ID (через кэш)"""
+    cached = user_cache.get(user_id)
+    if cached is not None:
+        return dict(cached)
+    
     try:
         query = "SELECT * FROM users WHERE user_id = $1"
-        return await fetch_one(query, user_id)
+        user = await fetch_one(query, user_id)
+        if user:
+            user_cache.set(user_id, user)
+            return dict(user)
+        return None
     except Exception as e:
         log.error(f"❌ Ошибка получения пользователя {user_id}: {e}")
         return None
@@ -54,6 +78,7 @@ async def update_user_balance(user_id: int, coins_delta: int) -> bool:
             RETURNING balance
         """
         result = await fetch_one(query, user_id, coins_delta)
+        invalidate_user_cache(user_id)
         if result:
             log.info(f"✅ Баланс пользователя {user_id} обновлен: {coins_delta:+d} → {result['balance']}")
             return True
@@ -72,6 +97,7 @@ async def update_user_plan(user_id: int, plan: str) -> bool:
             WHERE user_id = $1
         """
         await execute_query(query, user_id, plan)
+        invalidate_user_cache(user_id)
         log.info(f"✅ Тариф пользователя {user_id} обновлен: {plan}")
         return True
     except Exception as e:
@@ -98,6 +124,7 @@ async def set_user_balance(user_id: int, balance: int) -> bool:
             WHERE user_id = $1
         """
         await execute_query(query, user_id, balance)
+        invalidate_user_cache(user_id)
         log.info(f"✅ Баланс пользователя {user_id} установлен: {balance}")
         return True
     except Exception as e:
@@ -114,6 +141,7 @@ async def block_user(user_id: int) -> bool:
             WHERE user_id = $1
         """
         await execute_query(query, user_id)
+        invalidate_user_cache(user_id)
         log.info(f"✅ Пользователь {user_id} заблокирован")
         return True
     except Exception as e:
@@ -130,6 +158,7 @@ async def unblock_user(user_id: int) -> bool:
             WHERE user_id = $1
         """
         await execute_query(query, user_id)
+        invalidate_user_cache(user_id)
         log.info(f"✅ Пользователь {user_id} разблокирован")
         return True
     except Exception as e:
@@ -155,8 +184,39 @@ async def update_user_language(user_id: int, language: str) -> bool:
             WHERE user_id = $1
         """
         await execute_query(query, user_id, language)
+        invalidate_user_cache(user_id)
         log.info(f"✅ Язык пользователя {user_id} обновлен на {language}")
         return True
     except Exception as e:
         log.error(f"❌ Ошибка обновления языка {user_id}: {e}")
         return False
+
+async def get_user_with_subscription(user_id: int) -> Optional[Dict[str, Any]]:
+    """
+    Получить пользователя вместе с активной подпиской одним запросом
+
+    Колонки подписки возвращаются с префиксом sub_ (None, если подписки нет)
+    """
+    try:
+        query = """
+            SELECT
+                u.*,
+                s.id AS sub_id,
+                s.plan AS sub_plan,
+                s.end_date AS sub_end_date
+            FROM users u
+            LEFT JOIN LATERAL (
+                SELECT id, plan, end_date
+                FROM subscriptions
+                WHERE user_id = u.user_id
+                AND is_active = TRUE
+                AND end_date > CURRENT_TIMESTAMP
+                ORDER BY end_date DESC
+                LIMIT 1
+            ) s ON TRUE
+            WHERE u.user_id = $1
+        """
+        return await fetch_one(query, user_id)
+    except Exception as e:
+        log.error(f"❌ Ошибка получения контекста пользователя {user_id}: {e}")
+        return None
@@ -2,6 +2,7 @@
 """Обработчики callback кнопок"""
 
 import logging
+from typing import Optional
 from aiogram import F
 from aiogram.types import CallbackQuery, InlineKeyboardMarkup
 
@@ -10,7 +11,8 @@ from app.services import billing
 from app.ui import Actions, t
 from app.ui.keyboards import build_main_menu, tariff_selection, topup_packs_menu, build_profile_menu, build_tariffs_menu, build_help_menu, btn
 from app.core.bot import get_bot
-from .commands import ensure_user_exists, get_user_language, get_user_data
+from app.core.context import UserContext
+from .commands import get_user_language, get_user_data
 from .video_handlers import (
     handle_video_menu,
     handle_generate_menu,
@@ -109,14 +111,15 @@ def register_callbacks():
 
 # === НАВИГАЦИЯ ===
 
-async def callback_home(callback: CallbackQuery):
+async def callback_home(callback: CallbackQuery, user_ctx: Optional[UserContext] = None):
     """Главное меню"""
     await callback.answer()
-    await ensure_user_exists(callback.message)
-    user_language = await get_user_language(callback.from_user.id)
+    ctx = user_ctx or UserContext(user_id=callback.from_user.id, from_user=callback.from_user)
+    await ctx.ensure_user()
+    user_language = ctx.language
     
     user_id = callback.from_user.id
-    user_data = await get_user_data(user_id)
+    user_data = await get_user_data(user_id, ctx)
     name = callback.from_user.first_name or "друг"
     
     welcome_text = f"👋 {name}\n\n"
@@ -213,22 +216,22 @@ async def callback_tryon(callback: CallbackQuery):
     )
 
 # @dp.callback_query(F.data == Actions.MENU_PROFILE)
-async def callback_profile(callback: CallbackQuery):
+async def callback_profile(callback: CallbackQuery, user_ctx: Optional[UserContext] = None):
     """Профиль"""
     await callback.answer()
-    await ensure_user_exists(callback.message)
+    ctx = user_ctx or UserContext(user_id=callback.from_user.id, from_user=callback.from_user)
+    await ctx.ensure_user()
     user_id = callback.from_user.id
-    user_language = await get_user_language(user_id)
+    user_language = ctx.language
     
-    user_data = await get_user_data(user_id)
+    user_data = await get_user_data(user_id, ctx)
     name = callback.from_user.first_name or "Пользователь"
     
-    user = await users.get_user(user_id)
+    user = ctx.user
     reg_date = user.get('created_at', 'Неизвестно') if user else 'Неизвестно'
     
-    # Получаем детальную информацию о балансе
-    from app.services.dual_balance import get_user_dual_balance
-    balance_info = await get_user_dual_balance(user_id)
+    # Детальная информация о балансе из контекста
+    balance_info = ctx.balance
     
     # Рассчитываем примерное количество видео
     total_coins = balance_info['total']
@@ -580,7 +583,7 @@ async def callback_fallback(callback: CallbackQuery):
         reply_markup=build_main_menu(user_language)
     )
 
-async def callback_set_language(callback: CallbackQuery):
+async def callback_set_language(callback: CallbackQuery, user_ctx: Optional[UserContext] = None):
     """Обработчик выбора языка"""
     await callback.answer()
     
@@ -593,6 +596,8 @@ async def callback_set_language(callback: CallbackQuery):
     
     # Обновляем язык пользователя в БД
     await users.update_user_language(user_id, language)
+    if user_ctx is not None:
+        user_ctx.invalidate()
     
     # Получаем локализованные тексты
     from app.ui.texts import t
@@ -2,16 +2,17 @@
 """Обработчики команд бота (/start, /help, и т.д.)"""
 
 import logging
+from typing import Optional
 from aiogram import types, F
 from aiogram.filters import Command, CommandStart
 from aiogram.types import Message
 
 from app.db import users
-from app.services import billing
 from app.ui import t
 from app.ui.keyboards import build_main_menu, tariff_selection
 from app.config.pricing import get_full_pricing_text
 from app.core.bot import get_bot
+from app.core.context import UserContext, get_user_context
 
 log = logging.getLogger("kudoaibot")
 
@@ -28,22 +29,17 @@ def register_commands():
 
 # === ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ===
 
-async def ensure_user_exists(message: Message) -> dict:
+async def ensure_user_exists(message: Message, user_ctx: Optional[UserContext] = None) -> dict:
     """Убедиться, что пользователь существует в БД"""
-    user = await users.get_user(message.from_user.id)
-    if not user:
-        user = await users.create_user(
-            user_id=message.from_user.id,
-            username=message.from_user.username,
-            first_name=message.from_user.first_name,
-            last_name=message.from_user.last_name,
-            language=None  # Не устанавливаем язык по умолчанию
-        )
-        log.info(f"✅ Создан новый пользователь: {message.from_user.id}")
-    return user
+    ctx = user_ctx or UserContext(user_id=message.from_user.id, from_user=message.from_user)
+    await ctx.ensure_user()
+    return ctx.user
 
-async def get_user_language(user_id: int) -> str:
+async def get_user_language(user_id: int, user_ctx: Optional[UserContext] = None) -> str:
     """Получить язык пользователя"""
+    if user_ctx is not None:
+        await user_ctx.load()
+        return user_ctx.language
     user = await users.get_user(user_id)
     return user['language'] if user else 'ru'
 
@@ -52,29 +48,29 @@ async def is_language_set(user_id: int) -> bool:
     user = await users.get_user(user_id)
     return user and user.get('language') is not None
 
-async def get_user_data(user_id: int) -> dict:
+async def get_user_data(user_id: int, user_ctx: Optional[UserContext] = None) -> dict:
     """Получить данные пользователя включая подписку"""
-    user = await users.get_user(user_id)
-    if not user:
+    ctx = await get_user_context(user_id, user_ctx)
+    if not ctx.user:
         return {'subscription_type': 'Без подписки', 'videos_left': 0}
     
-    status = await billing.get_user_subscription_status(user_id)
+    status = ctx.subscription_status
     
     return {
         'subscription_type': status.get('subscription_type', 'Без подписки'),
         'videos_left': status.get('balance', 0),
-        'created_at': user.get('created_at', 'Неизвестно')
+        'created_at': ctx.user.get('created_at', 'Неизвестно')
     }
 
 # === ОБРАБОТЧИКИ КОМАНД ===
 
-async def cmd_start(message: Message):
+async def cmd_start(message: Message, user_ctx: Optional[UserContext] = None):
     """Обработчик команды /start"""
-    await ensure_user_exists(message)
-    user_id = message.from_user.id
+    ctx = user_ctx or UserContext(user_id=message.from_user.id, from_user=message.from_user)
+    await ctx.ensure_user()
     
     # Проверяем, установлен ли язык
-    if not await is_language_set(user_id):
+    if not ctx.language_set:
         # Показываем выбор языка
         from app.ui.texts import t
         from app.ui.keyboards import build_language_menu
@@ -86,17 +82,12 @@ async def cmd_start(message: Message):
         return
     
     # Если язык установлен, показываем главное меню
-    user_language = await get_user_language(user_id)
+    user_language = ctx.language
     name = message.from_user.first_name or "друг"
     
-    # Получаем dual balance
-    from app.services.dual_balance import get_user_dual_balance, format_balance_display
-    from app.services import billing
-    
-    balance = await get_user_dual_balance(user_id)
-    
-    # Получаем информацию о подписке
-    status = await billing.get_user_subscription_status(user_id)
+    # Баланс и подписка уже загружены в контексте
+    balance = ctx.balance
+    status = ctx.subscription_status
     days_left = status.get('days_left', 0) if status.get('has_active') else None
     
     welcome_text = f"👋 Привет, {name}!\n\n"
@@ -113,10 +104,11 @@ async def cmd_start(message: Message):
         reply_markup=build_main_menu(user_language)
     )
 
-async def cmd_help(message: Message):
+async def cmd_help(message: Message, user_ctx: Optional[UserContext] = None):
     """Обработчик команды /help"""
-    await ensure_user_exists(message)
-    user_language = await get_user_language(message.from_user.id)
+    ctx = user_ctx or UserContext(user_id=message.from_user.id, from_user=message.from_user)
+    await ctx.ensure_user()
+    user_language = ctx.language
     
     help_text = """
 🤖 <b>KudoAiBot - Инструкция</b>
@@ -144,18 +136,16 @@ async def cmd_help(message: Message):
     """
     await message.answer(help_text)
 
-async def cmd_balance(message: Message):
+async def cmd_balance(message: Message, user_ctx: Optional[UserContext] = None):
     """Показать баланс монеток"""
-    await ensure_user_exists(message)
-    user_id = message.from_user.id
-    user_language = await get_user_language(user_id)
+    ctx = user_ctx or UserContext(user_id=message.from_user.id, from_user=message.from_user)
+    await ctx.ensure_user()
     
-    from app.services.dual_balance import get_user_dual_balance, format_balance_display
     from app.utils.formatting import format_coins
     
-    # Получаем dual balance
-    balance = await get_user_dual_balance(user_id)
-    status = await billing.get_user_subscription_status(user_id)
+    # Баланс и подписка из контекста (один запрос)
+    balance = ctx.balance
+    status = ctx.subscription_status
     
     balance_text = f"💰 <b>Ваш баланс</b>\n\n"
     
@@ -176,15 +166,14 @@ async def cmd_balance(message: Message):
     
     await message.answer(balance_text)
 
-async def cmd_profile(message: Message):
+async def cmd_profile(message: Message, user_ctx: Optional[UserContext] = None):
     """Показать профиль пользователя"""
-    await ensure_user_exists(message)
+    ctx = user_ctx or UserContext(user_id=message.from_user.id, from_user=message.from_user)
+    await ctx.ensure_user()
     user_id = message.from_user.id
     
-    user = await users.get_user(user_id)
-    status = await billing.get_user_subscription_status(user_id)
-    from app.services.dual_balance import get_user_dual_balance
-    balance_info = await get_user_dual_balance(user_id)
+    user = ctx.user
+    status = ctx.subscription_status
     
     profile_text = f"👤 <b>Ваш профиль</b>\n\n"
     profile_text += f"ID: <code>{user_id}</code>\n"
@@ -202,10 +191,11 @@ async def cmd_profile(message: Message):
     
     await message.answer(profile_text)
 
-async def cmd_tariffs(message: Message):
+async def cmd_tariffs(message: Message, user_ctx: Optional[UserContext] = None):
     """Показать тарифы"""
-    await ensure_user_exists(message)
-    user_language = await get_user_language(message.from_user.id)
+    ctx = user_ctx or UserContext(user_id=message.from_user.id, from_user=message.from_user)
+    await ctx.ensure_user()
+    user_language = ctx.language
     
     tariffs_text = get_full_pricing_text()
     await message.answer(
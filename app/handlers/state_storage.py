@@ -0,0 +1,320 @@
+# app/handlers/state_storage.py
+"""
+Хранилища состояний диалогов (UserState)
+
+Обработчики работают с состоянием синхронно через app.handlers.states,
+а middleware подгружает его из хранилища до обработчика и сохраняет после.
+Бэкенд выбирается STATE_STORAGE:
+- memory - состояние живёт в памяти процесса (один воркер, по умолчанию);
+- postgres - таблица user_states, апдейты одного пользователя можно
+  обрабатывать в разных воркерах и репликах.
+
+Рабочий набор процесса (LocalStateStore) ограничен: состояния без активности
+дольше STATE_IDLE_TTL вытесняются, записей не больше STATE_MAX_ENTRIES,
+а байты вложений (фото примерочной) укладываются в STATE_BLOB_BUDGET -
+при превышении у самых давних состояний вложения сбрасываются.
+В общем хранилище строки без изменений дольше STATE_IDLE_TTL удаляет
+фоновая задача лидера (state_sweep_task).
+"""
+
+import os
+import time
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any
+
+log = logging.getLogger("state_storage")
+
+STATE_STORAGE = os.getenv("STATE_STORAGE", "memory").strip().lower()
+STATE_IDLE_TTL = int(os.getenv("STATE_IDLE_TTL", str(24 * 3600)))
+STATE_MAX_ENTRIES = int(os.getenv("STATE_MAX_ENTRIES", "50000"))
+STATE_BLOB_BUDGET = int(os.getenv("STATE_BLOB_BUDGET", str(256 * 1024 * 1024)))
+
+# Как часто проходить по рабочему набору в поисках простаивающих состояний
+_SWEEP_INTERVAL = 60.0
+# Как часто лидер удаляет простаивающие состояния из общего хранилища
+STATE_STORE_SWEEP_INTERVAL = int(os.getenv("STATE_STORE_SWEEP_INTERVAL", "3600"))
+
+def _blob_size(value: Any) -> int:
+    """Сколько байт вложений (bytes) внутри значения поля"""
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(_blob_size(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(_blob_size(v) for v in value)
+    return 0
+
+def _drop_blobs(value: Any) -> Any:
+    """Заменить вложения на None (остальные данные не трогаем)"""
+    if isinstance(value, (bytes, bytearray)):
+        return None
+    if isinstance(value, dict):
+        for key, item in value.items():
+            value[key] = _drop_blobs(item)
+    elif isinstance(value, list):
+        for i, item in enumerate(value):
+            value[i] = _drop_blobs(item)
+    return value
+
+class LocalStateStore:
+    """
+    Рабочий набор состояний процесса: user_id -> UserState
+
+    Порядок записей - по последнему обращению (LRU). Простой определяется
+    по UserState.last_activity. Байты вложений пересчитываются в account()
+    после каждого апдейта, потому что обработчики меняют состояние на месте.
+    """
+
+    def __init__(self, idle_ttl: int = STATE_IDLE_TTL, maxsize: int = STATE_MAX_ENTRIES,
+                 blob_budget: int = STATE_BLOB_BUDGET):
+        self.idle_ttl = timedelta(seconds=idle_ttl)
+        self.maxsize = maxsize
+        self.blob_budget = blob_budget
+        self._data: "OrderedDict[int, Any]" = OrderedDict()
+        self._blobs: Dict[int, int] = {}
+        self.blob_bytes = 0
+        self._last_sweep = time.monotonic()
+
+        self.expired = 0
+        self.evicted = 0
+        self.blobs_dropped = 0
+        self.blob_bytes_dropped = 0
+
+    def _idle(self, state: Any, now: datetime) -> bool:
+        return now - state.last_activity > self.idle_ttl
+
+    def _remove(self, user_id: int):
+        self._data.pop(user_id, None)
+        self.blob_bytes -= self._blobs.pop(user_id, 0)
+
+    def get(self, user_id: int, default: Any = None) -> Any:
+        """Состояние (LRU обновляется); простаивающее вытесняется"""
+        state = self._data.get(user_id)
+        if state is None:
+            return default
+        if self._idle(state, datetime.now()):
+            self._remove(user_id)
+            self.expired += 1
+            return default
+        self._data.move_to_end(user_id)
+        return state
+
+    def __contains__(self, user_id: int) -> bool:
+        return self.get(user_id) is not None
+
+    def __getitem__(self, user_id: int) -> Any:
+        state = self.get(user_id)
+        if state is None:
+            raise KeyError(user_id)
+        return state
+
+    def __setitem__(self, user_id: int, state: Any):
+        if user_id in self._data:
+            self.blob_bytes -= self._blobs.pop(user_id, 0)
+        self._data[user_id] = state
+        self._data.move_to_end(user_id)
+        self._enforce(user_id)
+
+    def pop(self, user_id: int, default: Any = None) -> Any:
+        state = self._data.get(user_id, default)
+        self._remove(user_id)
+        return state
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def clear(self):
+        self._data.clear()
+        self._blobs.clear()
+        self.blob_bytes = 0
+
+    def account(self, user_id: int):
+        """Пересчитать вложения состояния после апдейта и применить лимиты"""
+        state = self._data.get(user_id)
+        if state is None:
+            return
+        size = sum(_blob_size(v) for v in vars(state).values())
+        self.blob_bytes += size - self._blobs.get(user_id, 0)
+        if size:
+            self._blobs[user_id] = size
+        else:
+            self._blobs.pop(user_id, None)
+        self._enforce(user_id)
+
+    def _enforce(self, current: int):
+        now = time.monotonic()
+        if now - self._last_sweep >= _SWEEP_INTERVAL:
+            self._last_sweep = now
+            self.sweep()
+
+        while len(self._data) > self.maxsize:
+            user_id = next(iter(self._data))
+            self._remove(user_id)
+            self.evicted += 1
+
+        if self.blob_bytes > self.blob_budget:
+            self._drop_oldest_blobs(current)
+
+    def sweep(self):
+        """Вытеснить простаивающие состояния (с начала LRU до первого активного)"""
+        now = datetime.now()
+        while self._data:
+            user_id, state = next(iter(self._data.items()))
+            if not self._idle(state, now):
+                break
+            self._remove(user_id)
+            self.expired += 1
+
+    def _drop_oldest_blobs(self, current: int):
+        """Сбросить вложения самых давних состояний, пока не уложимся в бюджет"""
+        for user_id in [uid for uid in self._data if uid in self._blobs]:
+            if self.blob_bytes <= self.blob_budget:
+                return
+            # Текущего пользователя трогаем в последнюю очередь
+            if user_id == current and len(self._blobs) > 1:
+                continue
+            state = self._data[user_id]
+            for value in vars(state).values():
+                _drop_blobs(value)
+            size = self._blobs.pop(user_id)
+            self.blob_bytes -= size
+            self.blobs_dropped += 1
+            self.blob_bytes_dropped += size
+            log.warning(f"⚠️ Вложения состояния user {user_id} сброшены ({size} байт): превышен бюджет")
+
+    def stats(self) -> Dict[str, Any]:
+        """Размер рабочего набора и память вложений"""
+        return {
+            "entries": len(self._data),
+            "maxsize": self.maxsize,
+            "idle_ttl": int(self.idle_ttl.total_seconds()),
+            "with_blobs": len(self._blobs),
+            "blob_bytes": self.blob_bytes,
+            "blob_budget": self.blob_budget,
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "blobs_dropped": self.blobs_dropped,
+            "blob_bytes_dropped": self.blob_bytes_dropped,
+        }
+
+class StateStorage(ABC):
+    """Интерфейс хранилища компактных состояний"""
+
+    # Имя бэкенда (значение STATE_STORAGE)
+    name = "abstract"
+    # Состояние видят другие процессы - его нужно загружать и сохранять
+    shared = False
+
+    def __init__(self):
+        self.loads = 0
+        self.saves = 0
+        self.deletes = 0
+        self.errors = 0
+        self.expired = 0
+
+    @abstractmethod
+    async def load(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Компактное состояние или None, если сохранённого нет"""
+
+    @abstractmethod
+    async def save(self, user_id: int, data: Dict[str, Any]):
+        """Сохранить компактное состояние"""
+
+    @abstractmethod
+    async def delete(self, user_id: int):
+        """Удалить состояние"""
+
+    async def expire(self, idle_ttl: int) -> int:
+        """Удалить состояния без изменений дольше idle_ttl секунд, вернуть их число"""
+        return 0
+
+    def stats(self) -> Dict[str, Any]:
+        """Метрики хранилища"""
+        return {
+            "backend": self.name,
+            "loads": self.loads,
+            "saves": self.saves,
+            "deletes": self.deletes,
+            "errors": self.errors,
+            "expired": self.expired,
+        }
+
+class MemoryStateStorage(StateStorage):
+    """Состояния только в памяти процесса: рабочий набор в states и есть хранилище"""
+
+    name = "memory"
+
+    async def load(self, user_id: int) -> Optional[Dict[str, Any]]:
+        return None
+
+    async def save(self, user_id: int, data: Dict[str, Any]):
+        pass
+
+    async def delete(self, user_id: int):
+        pass
+
+class PostgresStateStorage(StateStorage):
+    """Состояния в таблице user_states (общие для всех воркеров)"""
+
+    name = "postgres"
+    shared = True
+
+    async def load(self, user_id: int) -> Optional[Dict[str, Any]]:
+        from app.db import user_states
+        self.loads += 1
+        return await user_states.load_state(user_id)
+
+    async def save(self, user_id: int, data: Dict[str, Any]):
+        from app.db import user_states
+        self.saves += 1
+        await user_states.save_state(user_id, data)
+
+    async def delete(self, user_id: int):
+        from app.db import user_states
+        self.deletes += 1
+        await user_states.delete_state(user_id)
+
+    async def expire(self, idle_ttl: int) -> int:
+        from app.db import user_states
+        deleted = await user_states.delete_idle_states(idle_ttl)
+        self.expired += deleted
+        return deleted
+
+_BACKENDS = {
+    "memory": MemoryStateStorage,
+    "postgres": PostgresStateStorage,
+}
+
+_storage: Optional[StateStorage] = None
+
+def get_storage() -> StateStorage:
+    """Хранилище процесса по STATE_STORAGE (создаётся лениво)"""
+    global _storage
+    if _storage is None:
+        backend = _BACKENDS.get(STATE_STORAGE)
+        if backend is None:
+            log.warning(f"⚠️ Неизвестный STATE_STORAGE={STATE_STORAGE}, используем memory")
+            backend = MemoryStateStorage
+        _storage = backend()
+        log.info(f"✅ Хранилище состояний: {_storage.name}")
+    return _storage
+
+async def state_sweep_task():
+    """
+    Фоновая задача лидера: удалять из общего хранилища состояния
+    без изменений дольше STATE_IDLE_TTL
+    Запускается каждые STATE_STORE_SWEEP_INTERVAL секунд
+    """
+    storage = get_storage()
+    while True:
+        try:
+            deleted = await storage.expire(STATE_IDLE_TTL)
+            if deleted:
+                log.info(f"🧹 Удалено простаивающих состояний: {deleted}")
+        except Exception as e:
+            log.error(f"❌ Ошибка очистки состояний: {e}")
+        await asyncio.sleep(STATE_STORE_SWEEP_INTERVAL)
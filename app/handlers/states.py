@@ -1,10 +1,22 @@
 # app/handlers/states.py
-"""Состояния пользователя для диалогов"""
+"""
+Состояния пользователя для диалогов
 
-from dataclasses import dataclass, field
-from typing import Optional, Dict, Any
+Обработчики читают и меняют состояние синхронно (get_user_state / set_user_state).
+UserStateMiddleware перед обработчиком загружает состояние из хранилища
+(load_user_state), а после - сохраняет, если оно изменилось (save_user_state).
+"""
+
+import base64
+import logging
+from dataclasses import dataclass, field, fields
+from typing import Optional, Dict, Any, Union
 from datetime import datetime
 
+from .state_storage import get_storage, LocalStateStore
+
+log = logging.getLogger("kudoaibot")
+
 @dataclass
 class UserState:
     """Состояние пользователя"""
@@ -18,7 +30,7 @@ class UserState:
     last_prompt: Optional[str] = None
     last_activity: datetime = field(default_factory=datetime.now)
     tryon_data: Dict[str, Any] = field(default_factory=dict)  # Данные для примерочной
-    
+
     def reset(self):
         """Сброс состояния"""
         self.current_screen = "main"
@@ -30,8 +42,59 @@ class UserState:
         self.last_prompt = None
         self.tryon_data = {}
 
-# Хранилище состояний пользователей
-user_states: Dict[int, UserState] = {}
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Компактная форма для хранилища: только поля, отличные от значений по умолчанию
+
+        user_id - ключ хранилища, last_activity - время апдейта, в форму не входят.
+        Пустой dict - состояние по умолчанию.
+        """
+        data = {}
+        for f in fields(self):
+            if f.name in _NOT_STORED:
+                continue
+            value = getattr(self, f.name)
+            if value != _default(f):
+                data[f.name] = _encode(value)
+        return data
+
+    @classmethod
+    def from_dict(cls, user_id: int, data: Dict[str, Any]) -> "UserState":
+        """Восстановить состояние из компактной формы (неизвестные поля пропускаются)"""
+        state = cls(user_id=user_id)
+        for key, value in (data or {}).items():
+            if key in _STORED_FIELDS:
+                setattr(state, key, _decode(value))
+        return state
+
+_NOT_STORED = {"user_id", "last_activity"}
+_STORED_FIELDS = {f.name for f in fields(UserState)} - _NOT_STORED
+_BYTES_KEY = "__b64__"
+
+def _default(f) -> Any:
+    return f.default_factory() if callable(f.default_factory) else f.default
+
+def _encode(value: Any) -> Any:
+    """JSON-совместимое значение (bytes - в base64)"""
+    if isinstance(value, (bytes, bytearray)):
+        return {_BYTES_KEY: base64.b64encode(value).decode("ascii")}
+    if isinstance(value, dict):
+        return {k: _encode(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(v) for v in value]
+    return value
+
+def _decode(value: Any) -> Any:
+    if isinstance(value, dict):
+        if set(value) == {_BYTES_KEY}:
+            return base64.b64decode(value[_BYTES_KEY])
+        return {k: _decode(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_decode(v) for v in value]
+    return value
+
+# Рабочий набор состояний процесса (для memory бэкенда - само хранилище)
+user_states = LocalStateStore()
 
 def get_user_state(user_id: int) -> UserState:
     """Получить или создать состояние пользователя"""
@@ -40,18 +103,24 @@ def get_user_state(user_id: int) -> UserState:
     user_states[user_id].last_activity = datetime.now()
     return user_states[user_id]
 
-def set_user_state(user_id: int, state_data: dict):
-    """Установить состояние пользователя из словаря"""
+def set_user_state(user_id: int, state_data: Union[UserState, dict]):
+    """Установить состояние пользователя из словаря или объекта UserState"""
+    if isinstance(state_data, UserState):
+        state_data.user_id = user_id
+        state_data.last_activity = datetime.now()
+        user_states[user_id] = state_data
+        return
+
     # Получаем существующее состояние или создаем новое
     if user_id not in user_states:
         user_states[user_id] = UserState(user_id=user_id)
-    
+
     # Обновляем поля состояния из словаря
     state = user_states[user_id]
     for key, value in state_data.items():
         if hasattr(state, key):
             setattr(state, key, value)
-    
+
     state.last_activity = datetime.now()
 
 def clear_user_state(user_id: int):
@@ -64,3 +133,49 @@ def is_waiting_for_input(user_id: int) -> bool:
     state = get_user_state(user_id)
     return state.waiting_for is not None
 
+async def load_user_state(user_id: int) -> Optional[Dict[str, Any]]:
+    """
+    Загрузить состояние из хранилища в рабочий набор перед обработкой апдейта
+
+    Returns:
+        Снимок компактной формы для save_user_state (None - хранилище не общее)
+    """
+    storage = get_storage()
+    if not storage.shared:
+        return None
+    try:
+        data = await storage.load(user_id)
+    except Exception as e:
+        storage.errors += 1
+        log.error(f"❌ Ошибка загрузки состояния user {user_id}: {e}")
+        # Продолжаем с локальной копией; не сохраняем её поверх общей
+        return None
+    user_states[user_id] = UserState.from_dict(user_id, data or {})
+    return data or {}
+
+async def save_user_state(user_id: int, snapshot: Optional[Dict[str, Any]]):
+    """Сохранить состояние после обработки апдейта, если оно изменилось"""
+    storage = get_storage()
+    state = user_states.get(user_id)
+    if state is None:
+        return
+    try:
+        if not storage.shared or snapshot is None:
+            return
+        data = state.to_dict()
+        if data == snapshot:
+            return
+        if data:
+            await storage.save(user_id, data)
+        else:
+            await storage.delete(user_id)
+    except Exception as e:
+        storage.errors += 1
+        log.error(f"❌ Ошибка сохранения состояния user {user_id}: {e}")
+    finally:
+        # Обработчик мог положить или убрать вложения - пересчитываем память
+        user_states.account(user_id)
+
+def get_stats() -> Dict[str, Any]:
+    """Метрики хранилища и рабочего набора состояний"""
+    return {**get_storage().stats(), "local": user_states.stats()}
@@ -2,6 +2,7 @@
 """Обработчик текстовых сообщений"""
 
 import logging
+from typing import Optional
 from aiogram import F
 from aiogram.types import Message
 
@@ -9,6 +10,7 @@ from app.handlers.states import is_waiting_for_input
 from app.handlers.video_handlers import handle_text_input
 from app.handlers.commands import cmd_start
 from app.core.bot import get_bot
+from app.core.context import UserContext
 
 log = logging.getLogger("kudoaibot")
 
@@ -25,7 +27,7 @@ def register_text_handlers():
     # Регистрируем fallback для всех остальных типов сообщений
     dp.message.register(handle_fallback_message)
 
-async def handle_photo_message(message: Message):
+async def handle_photo_message(message: Message, user_ctx: Optional[UserContext] = None):
     """Обработка фото (для примерочной)"""
     user_id = message.from_user.id
     
@@ -39,9 +41,9 @@ async def handle_photo_message(message: Message):
             "📸 Фото получено, но я не понимаю, что с ним делать.\n\n"
             "Выберите раздел из меню:"
         )
-        await cmd_start(message)
+        await cmd_start(message, user_ctx)
 
-async def handle_text_message(message: Message):
+async def handle_text_message(message: Message, user_ctx: Optional[UserContext] = None):
     """Обработка текстовых сообщений с учетом режимов"""
     user_id = message.from_user.id
     text = message.text.strip()
@@ -63,8 +65,8 @@ async def handle_text_message(message: Message):
         # Обрабатываем промпт в зависимости от режима
         if mode == "helper":
             # Умный помощник - улучшаем промпт через GPT
-            from app.services.gpt_templates import improve_scene
-            improved_prompt = improve_scene(text, "complex")
+            from app.services.gpt_templates import improve_scene_with_timeout
+            improved_prompt = await improve_scene_with_timeout(text, "complex")
             await message.answer(
                 f"🧠 **Улучшенный промпт:**\n\n{improved_prompt}\n\n"
                 f"Генерирую видео..."
@@ -74,8 +76,8 @@ async def handle_text_message(message: Message):
             
         elif mode == "neurokudo":
             # Neurokudo режим - специальная обработка
-            from app.services.gpt_templates import improve_scene
-            improved_prompt = improve_scene(text, "absurd")
+            from app.services.gpt_templates import improve_scene_with_timeout
+            improved_prompt = await improve_scene_with_timeout(text, "absurd")
             await message.answer(
                 f"🔮 **Neurokudo промпт:**\n\n{improved_prompt}\n\n"
                 f"Генерирую видео в стиле Neurokudo..."
@@ -84,7 +86,7 @@ async def handle_text_message(message: Message):
             
         elif mode == "meme":
             # Мемный режим - быстрая генерация
-            from app.services.gpt_templates import random_meme_scene, improve_scene
+            from app.services.gpt_templates import random_meme_scene, improve_scene_with_timeout
             if text.lower() in ["случайно", "случайная", "random", "мем"]:
                 meme_prompt = random_meme_scene()
                 await message.answer(
@@ -94,7 +96,7 @@ async def handle_text_message(message: Message):
                 await handle_text_input(message, meme_prompt)
             else:
                 # Улучшаем пользовательский промпт для мемов
-                meme_prompt = improve_scene(text, "absurd")
+                meme_prompt = await improve_scene_with_timeout(text, "absurd")
                 await message.answer(
                     f"🤡 **Мемный промпт:**\n\n{meme_prompt}\n\n"
                     f"Генерирую мем..."
@@ -111,12 +113,12 @@ async def handle_text_message(message: Message):
         
     else:
         # Обычное сообщение - показываем главное меню
-        await cmd_start(message)
+        await cmd_start(message, user_ctx)
 
-async def handle_fallback_message(message: Message):
+async def handle_fallback_message(message: Message, user_ctx: Optional[UserContext] = None):
     """Обработка всех остальных типов сообщений (фото, видео, стикеры и т.д.)"""
     log.info(f"Получено необработанное сообщение от пользователя {message.from_user.id}: {message.content_type}")
     
     # Просто показываем главное меню
-    await cmd_start(message)
+    await cmd_start(message, user_ctx)
 
@@ -13,6 +13,22 @@ from .commands import get_user_language
 
 log = logging.getLogger("kudoaibot")
 
+# В состоянии примерочной хранятся только file_id фото Telegram,
+# сами изображения скачиваются при подтверждении примерки.
+
+async def _download_photo(ref) -> bytes:
+    """Скачать фото по file_id (bytes из состояний до перехода на file_id - как есть)"""
+    if isinstance(ref, (bytes, bytearray)):
+        return bytes(ref)
+    from app.core.bot import get_bot
+    bot, _ = get_bot()
+    file = await bot.download(ref)
+    return file.read()
+
+async def _download_photos(*refs) -> list:
+    """Скачать несколько фото параллельно"""
+    return list(await asyncio.gather(*(_download_photo(ref) for ref in refs)))
+
 # === ОБРАБОТЧИКИ ПРИМЕРОЧНОЙ ===
 
 async def callback_tryon_start(callback: CallbackQuery):
@@ -66,101 +82,74 @@ async def callback_tryon_confirm(callback: CallbackQuery):
         )
         return
     
-    # Проверяем доступ
-    access = await billing.check_access(user_id, "tryon_basic")
-    if not access['access']:
+    await callback.message.edit_text("⏳ Делаю примерку… Это может занять до 2 минут.")
+    
+    try:
+        person_bytes, garment_bytes = await _download_photos(
+            tryon_data["person"], tryon_data["garment"]
+        )
+    except Exception as e:
+        log.error(f"TRYON user {user_id}: Failed to download photos: {e}")
         await callback.message.edit_text(
-            f"❌ Недостаточно монеток!\n\n"
-            f"💰 Нужно: {access.get('cost', 6)} монет\n"
-            f"💳 У вас: {access.get('balance', 0)} монет\n\n"
-            f"Пополните баланс в профиле.",
+            "❌ Ошибка загрузки фото. Попробуйте ещё раз.",
             reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [btn("💳 Пополнить", "show_topup")],
+                [btn("🔄 Начать заново", "menu_tryon")],
                 [btn("🏠 Главное меню", "home")]
             ])
         )
         return
     
-    # Списываем монетки
-    deduct_result = await billing.deduct_coins_for_feature(user_id, "tryon_basic")
+    # Резервируем монетки до обращения к кэшу: блокировка и баланс проверяются
+    # (и примерка оплачивается) одинаково для новой пары фото и для повтора
+    deduct_result = await billing.reserve(user_id, "tryon_basic")
     
     if not deduct_result['success']:
-        await callback.message.edit_text(
-            deduct_result['message'],
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [btn("🏠 Главное меню", "home")]
-            ])
-        )
+        if deduct_result['reason'] == "insufficient_funds":
+            await callback.message.edit_text(
+                f"❌ Недостаточно монеток!\n\n"
+                f"💰 Нужно: {deduct_result.get('cost', 6)} монет\n"
+                f"💳 У вас: {deduct_result.get('balance', 0)} монет\n\n"
+                f"Пополните баланс в профиле.",
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                    [btn("💳 Пополнить", "show_topup")],
+                    [btn("🏠 Главное меню", "home")]
+                ])
+            )
+        else:
+            await callback.message.edit_text(
+                deduct_result['message'],
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                    [btn("🏠 Главное меню", "home")]
+                ])
+            )
         return
     
+    reservation_id = deduct_result['reservation_id']
+    
     # Информация о списании
     deduction_info = (
         f"💰 <b>Списано:</b> {deduct_result['coins_spent']} монет\n"
         f"💳 <b>Остаток:</b> {deduct_result['balance_after']} монет\n\n"
     )
     
-    await callback.message.edit_text("⏳ Делаю примерку… Это может занять до 2 минут.")
-    
     try:
-        # Запускаем примерку
-        from app.services.clients.tryon_client import virtual_tryon
-        
-        log.info(f"TRYON user {user_id}: Starting virtual try-on")
-        
-        loop = asyncio.get_event_loop()
-        result_bytes = await loop.run_in_executor(
-            None,
-            virtual_tryon,
-            tryon_data["person"],
-            tryon_data["garment"],
-            1
-        )
-        
-        log.info(f"TRYON user {user_id}: Success, result size: {len(result_bytes)}")
-        
-        # Сохраняем результат
-        tryon_data["dressed"] = result_bytes
-        tryon_data["stage"] = "after"
-        state.tryon_data = tryon_data
-        set_user_state(user_id, state)
-        
-        # Отправляем результат
-        from aiogram.types import BufferedInputFile
-        photo_file = BufferedInputFile(result_bytes, filename="tryon_result.png")
-        
-        result_text = f"✅ <b>Готово! Одежда перенесена на человека.</b>\n\n{deduction_info}"
-        result_text += "Что делать дальше?"
-        
-        keyboard = [
-            [btn("🔄 Другая одежда", "tryon_reset")],
-            [btn("🏠 Главное меню", "home")]
-        ]
-        
-        await callback.message.answer_photo(
-            photo=photo_file,
-            caption=result_text,
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
-        )
-        
-        # Удаляем сообщение "Делаю примерку..."
-        try:
-            await callback.message.delete()
-        except:
-            pass
+        await _run_tryon(callback, state, person_bytes, garment_bytes, deduction_info)
+        await billing.commit(reservation_id)
             
     except Exception as e:
         log.exception(f"TRYON user {user_id}: Failed with error: {e}")
         
         # Возвращаем монетки
         try:
-            from app.services.dual_balance import add_permanent_coins
-            await add_permanent_coins(user_id, deduct_result['coins_spent'])
-            log.info(f"TRYON user {user_id}: Refunded {deduct_result['coins_spent']} coins")
+            refund = await billing.release(reservation_id, f"Ошибка примерочной: {e}"[:200])
+            if not refund['success']:
+                raise RuntimeError("reservation already closed")
+            log.info(f"TRYON user {user_id}: Refunded {refund['refunded']} coins")
             
             await callback.message.edit_text(
                 f"⚠️ Ошибка примерочной: {str(e)}\n\n"
-                f"💰 Возвращено: {deduct_result['coins_spent']} монет\n"
-                f"💳 Баланс: {deduct_result['balance_after'] + deduct_result['coins_spent']} монет\n\n"
+                f"💰 Возвращено: {refund['refunded']} монет\n"
+                f"💳 Баланс: {refund['balance']} монет\n\n"
                 f"Попробуйте ещё раз или обратитесь в поддержку.",
                 reply_markup=InlineKeyboardMarkup(inline_keyboard=[
                     [btn("🔄 Попробовать снова", "menu_tryon")],
@@ -177,6 +166,86 @@ async def callback_tryon_confirm(callback: CallbackQuery):
                 ])
             )
 
+async def _send_tryon_result(callback: CallbackQuery, state, photo, deduction_info: str):
+    """Отправить результат примерки и сохранить его file_id в состоянии"""
+    result_text = f"✅ <b>Готово! Одежда перенесена на человека.</b>\n\n{deduction_info}"
+    result_text += "Что делать дальше?"
+    
+    keyboard = [
+        [btn("🔄 Другая одежда", "tryon_reset")],
+        [btn("🏠 Главное меню", "home")]
+    ]
+    
+    sent = await callback.message.answer_photo(
+        photo=photo,
+        caption=result_text,
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
+    )
+    
+    # Сохраняем результат ссылкой на уже загруженное в Telegram фото
+    file_id = sent.photo[-1].file_id if sent.photo else None
+    state.tryon_data["dressed"] = file_id
+    state.tryon_data["stage"] = "after"
+    set_user_state(state.user_id, state)
+    
+    # Удаляем сообщение "Делаю примерку..."
+    try:
+        await callback.message.delete()
+    except:
+        pass
+    
+    return file_id
+
+async def _run_tryon(callback: CallbackQuery, state, person_bytes: bytes, garment_bytes: bytes,
+                     deduction_info: str):
+    """
+    Получить результат примерки (из кэша или от модели) и отправить его
+    
+    Ключ кэша считается по фото после prepare_input - тем байтам, что уходят в модель.
+    Ошибки пробрасываются вызывающему (он возвращает монетки).
+    """
+    from app.services import image_processing, tryon_cache
+    user_id = state.user_id
+    
+    original_size = len(person_bytes) + len(garment_bytes)
+    person_bytes, garment_bytes = await asyncio.gather(
+        image_processing.prepare_input(person_bytes),
+        image_processing.prepare_input(garment_bytes)
+    )
+    key = tryon_cache.result_key(person_bytes, garment_bytes)
+    
+    async with tryon_cache.locked(key):
+        # Та же пара фото уже примерялась - отдаём готовый результат без запроса к модели
+        cached_file_id = await tryon_cache.get(key)
+        if cached_file_id:
+            log.info(f"TRYON user {user_id}: Cache hit {key[:12]}")
+            try:
+                return await _send_tryon_result(callback, state, cached_file_id, deduction_info)
+            except Exception as e:
+                # Сохранённый file_id не подошёл - делаем примерку заново
+                log.warning(f"TRYON user {user_id}: Cached result failed to send: {e}")
+                await tryon_cache.forget(key)
+        
+        # Запускаем примерку
+        from app.services.clients.tryon_client import virtual_tryon, RESULT_FILENAME
+        
+        log.info(f"TRYON user {user_id}: Starting virtual try-on")
+        
+        result_bytes = await virtual_tryon(
+            person_bytes, garment_bytes, 1, prepared=True, original_size=original_size
+        )
+        
+        log.info(f"TRYON user {user_id}: Success, result size: {len(result_bytes)}")
+        
+        # Отправляем результат
+        from aiogram.types import BufferedInputFile
+        photo_file = BufferedInputFile(result_bytes, filename=RESULT_FILENAME)
+        
+        file_id = await _send_tryon_result(callback, state, photo_file, deduction_info)
+        if file_id:
+            await tryon_cache.put(key, file_id)
+        return file_id
+
 async def callback_tryon_swap(callback: CallbackQuery):
     """Поменять местами человека и одежду"""
     await callback.answer()
@@ -261,18 +330,13 @@ async def handle_tryon_photo(message: Message):
         # Не ожидаем фото
         return False
     
-    # Получаем фото
+    # Получаем фото (только file_id, скачиваем при подтверждении)
     try:
-        from app.core.bot import get_bot
-        bot, _ = get_bot()
-        
-        photo = message.photo[-1]  # Берем самое большое фото
-        file = await bot.download(photo.file_id)
-        photo_bytes = file.read()
+        photo_id = message.photo[-1].file_id  # Берем самое большое фото
         
         if stage == "await_person":
             # Сохраняем фото человека
-            tryon_data["person"] = photo_bytes
+            tryon_data["person"] = photo_id
             tryon_data["stage"] = "await_garment"
             state.tryon_data = tryon_data
             set_user_state(user_id, state)
@@ -297,7 +361,7 @@ async def handle_tryon_photo(message: Message):
             
         elif stage == "await_garment":
             # Сохраняем фото одежды
-            tryon_data["garment"] = photo_bytes
+            tryon_data["garment"] = photo_id
             tryon_data["stage"] = "confirm"
             state.tryon_data = tryon_data
             set_user_state(user_id, state)
@@ -18,9 +18,8 @@ from app.ui.keyboards import (
 )
 from app.handlers.states import get_user_state, clear_user_state
 from app.services.ai_helper import improve_prompt_async
-from app.services.clients import generate_video_veo3_async, generate_video_sora2_async
+from app.services.clients import generate_video_sora2_async
 from app.services import billing
-from app.config.pricing import get_feature_cost
 
 log = logging.getLogger("video_handlers")
 
@@ -279,34 +278,25 @@ async def generate_video(message: Message, state):
     
     log.info(f"🎬 generate_video: user_id={user_id}, model={getattr(state, 'video_model', 'None')}")
     
-    # Проверяем доступ
+    # Резервируем монетки (проверка блокировки, баланса и списание - один запрос)
     feature_name = "video_8s_mute" if not state.video_params.get("with_audio", False) else "video_8s_audio"
-    access = await billing.check_access(user_id, feature_name)
-    
-    if not access['access']:
-        await message.answer(
-            t("error.no_balance", cost=access.get('cost', 0), balance=access.get('balance', 0)),
-            reply_markup=build_main_menu()
-        )
+    deduct_result = await billing.reserve(user_id, feature_name)
+    
+    if not deduct_result['success']:
+        if deduct_result['reason'] == "insufficient_funds":
+            text = t("error.no_balance", cost=deduct_result.get('cost', 0), balance=deduct_result.get('balance', 0))
+        else:
+            text = deduct_result['message']
+        await message.answer(text, reply_markup=build_main_menu())
         clear_user_state(user_id)
         return
     
+    reservation_id = deduct_result['reservation_id']
+    
     # Уведомляем о начале генерации
     status_msg = await message.answer(t("video.generating"))
     
     try:
-        # Списываем монетки
-        cost = get_feature_cost(feature_name)
-        deduct_result = await billing.deduct_coins_for_feature(user_id, feature_name)
-        
-        if not deduct_result['success']:
-            await status_msg.edit_text(
-                deduct_result['message'],
-                reply_markup=build_main_menu()
-            )
-            clear_user_state(user_id)
-            return
-        
         # Показываем информацию о списании
         deduction_info = (
             f"💰 <b>Списано:</b> {deduct_result['coins_spent']} монет\n"
@@ -322,7 +312,8 @@ async def generate_video(message: Message, state):
                 prompt=state.last_prompt,
                 aspect_ratio=state.video_params.get("aspect_ratio", "9:16"),
                 duration=state.video_params.get("duration", 5),
-                user_id=user_id
+                user_id=user_id,
+                reservation_id=reservation_id
             )
             
             if task_status == "success":
@@ -339,6 +330,7 @@ async def generate_video(message: Message, state):
                 clear_user_state(user_id)
                 return
             elif task_status == "demo_mode":
+                await billing.release(reservation_id, "SORA 2 недоступна")
                 await status_msg.edit_text(
                     "🎬 <b>Демо режим SORA 2</b>\n\n"
                     "⚠️ OpenAI SORA 2 API не настроен\n"
@@ -359,7 +351,10 @@ async def generate_video(message: Message, state):
                 duration=state.video_params.get("duration", 8),
                 aspect_ratio=state.video_params.get("aspect_ratio", "9:16"),
                 with_audio=state.video_params.get("with_audio", True),
-                user_id=user_id
+                user_id=user_id,
+                reservation_id=reservation_id,
+                feature=feature_name,
+                coins_spent=deduct_result['cost']
             )
             
             if task_status == "success":
@@ -381,6 +376,7 @@ async def generate_video(message: Message, state):
         
         # Обработка ошибок (если дошли сюда)
         if "error" in result:
+            await billing.release(reservation_id, result["error"][:200])
             await status_msg.edit_text(
                 t("video.error", error=result["error"]),
                 reply_markup=build_main_menu()
@@ -390,6 +386,7 @@ async def generate_video(message: Message, state):
         
     except Exception as e:
         log.error(f"Ошибка генерации видео: {e}", exc_info=True)
+        await billing.release(reservation_id, "Ошибка генерации видео")
         await status_msg.edit_text(
             t("video.error", error=str(e)),
             reply_markup=build_main_menu()
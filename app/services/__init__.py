@@ -11,7 +11,10 @@ from .billing import (
     check_access,
     process_subscription_payment,
     process_topup_payment,
-    deduct_coins_for_feature
+    deduct_coins_for_feature,
+    reserve,
+    commit,
+    release
 )
 
 __all__ = [
@@ -22,5 +25,8 @@ __all__ = [
     'check_access',
     'process_subscription_payment',
     'process_topup_payment',
-    'deduct_coins_for_feature'
+    'deduct_coins_for_feature',
+    'reserve',
+    'commit',
+    'release'
 ]
@@ -1,48 +1,131 @@
 # app/services/ai_helper.py
-"""AI помощник для улучшения промптов и генерации мемов"""
+"""
+AI помощник для улучшения промптов и генерации мемов
+
+Все запросы к GPT идут через один AsyncOpenAI клиент процесса:
+общий пул соединений httpx (HTTP/2, если установлен h2, иначе keep-alive
+HTTP/1.1), тайм-аут на каждый вызов и не больше OPENAI_CONCURRENCY
+одновременных запросов. Потоки ОС на ожидание ответа не тратятся.
+"""
 
 import os
+import asyncio
 import logging
+import importlib.util
+from typing import Optional, List, Dict, Any
 
 log = logging.getLogger("ai_helper")
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "30"))
+OPENAI_CONCURRENCY = int(os.getenv("OPENAI_CONCURRENCY", "16"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
 
 # Ленивая инициализация клиента (не при импорте)
 _client = None
+_semaphore: Optional[asyncio.Semaphore] = None
+
+_stats = {
+    "requests": 0,
+    "errors": 0,
+    "in_flight": 0,
+    "http2": False,
+}
 
 def get_openai_client():
-    """Получить OpenAI клиента (ленивая инициализация)"""
+    """Получить общий AsyncOpenAI клиент (ленивая инициализация)"""
     global _client
-    
+
     if _client is None and OPENAI_API_KEY:
         try:
-            from openai import OpenAI
-            _client = OpenAI(api_key=OPENAI_API_KEY)
-            log.info("✅ OpenAI клиент инициализирован")
+            import httpx
+            from openai import AsyncOpenAI
+
+            http2 = importlib.util.find_spec("h2") is not None
+            http_client = httpx.AsyncClient(
+                http2=http2,
+                limits=httpx.Limits(
+                    max_connections=max(1, OPENAI_CONCURRENCY),
+                    max_keepalive_connections=max(1, OPENAI_CONCURRENCY),
+                    keepalive_expiry=60
+                ),
+                timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=10)
+            )
+            _client = AsyncOpenAI(
+                api_key=OPENAI_API_KEY,
+                http_client=http_client,
+                timeout=OPENAI_TIMEOUT,
+                max_retries=OPENAI_MAX_RETRIES
+            )
+            _stats["http2"] = http2
+            log.info(f"✅ OpenAI клиент инициализирован ({'HTTP/2' if http2 else 'HTTP/1.1 keep-alive'})")
         except Exception as e:
             log.error(f"❌ Ошибка инициализации OpenAI: {e}")
             _client = False  # Помечаем как неудачную попытку
-    
+
     return _client if _client and _client is not False else None
 
-def improve_prompt_with_gpt(user_input: str, mode: str = "helper") -> str:
+async def close_openai_client():
+    """Закрыть пул соединений клиента (при остановке приложения)"""
+    global _client
+    if _client:
+        await _client.close()
+    _client = None
+
+def _get_semaphore() -> asyncio.Semaphore:
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(max(1, OPENAI_CONCURRENCY))
+    return _semaphore
+
+async def chat_completion(messages: List[Dict[str, str]], max_tokens: int,
+                          temperature: float, timeout: float = OPENAI_TIMEOUT) -> Optional[str]:
+    """
+    Один запрос chat.completions через общий клиент
+
+    Returns:
+        Текст ответа (без пробелов по краям) или None, если OpenAI не настроен.
+        Ошибки API пробрасываются вызывающему.
+    """
+    client = get_openai_client()
+    if not client:
+        return None
+
+    async with _get_semaphore():
+        _stats["requests"] += 1
+        _stats["in_flight"] += 1
+        try:
+            response = await client.chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                timeout=timeout
+            )
+        except Exception:
+            _stats["errors"] += 1
+            raise
+        finally:
+            _stats["in_flight"] -= 1
+
+    return (response.choices[0].message.content or "").strip()
+
+async def improve_prompt_async(user_input: str, mode: str = "helper") -> str:
     """
     Улучшить промпт с помощью GPT
-    
+
     Args:
         user_input: Исходный текст от пользователя
         mode: Режим работы (helper, meme)
-    
+
     Returns:
         Улучшенный промпт для VEO 3
     """
-    client = get_openai_client()
-    
-    if not client:
+    if not get_openai_client():
         log.warning("OpenAI API key not set, returning original prompt")
         return user_input
-    
+
     try:
         if mode == "meme":
             system_prompt = """Ты создаёшь короткие мемные видео промпты для VEO 3.
@@ -62,27 +145,25 @@ def improve_prompt_with_gpt(user_input: str, mode: str = "helper") -> str:
 
 Отвечай ТОЛЬКО готовым промптом на английском, без объяснений и дополнительного текста."""
 
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
+        improved_prompt = await chat_completion(
+            [
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": user_input}
             ],
             temperature=0.8 if mode == "meme" else 0.7,
             max_tokens=500
         )
-        
-        improved_prompt = response.choices[0].message.content.strip()
+        if not improved_prompt:
+            return user_input
+
         log.info(f"GPT улучшил промпт ({mode}): {user_input[:50]}... -> {improved_prompt[:50]}...")
-        
+
         return improved_prompt
-        
+
     except Exception as e:
         log.error(f"Ошибка улучшения промпта: {e}")
         return user_input
 
-async def improve_prompt_async(user_input: str, mode: str = "helper") -> str:
-    """Асинхронная версия улучшения промпта"""
-    import asyncio
-    return await asyncio.to_thread(improve_prompt_with_gpt, user_input, mode)
-
+def get_stats() -> Dict[str, Any]:
+    """Метрики клиента OpenAI"""
+    return {**_stats, "concurrency": OPENAI_CONCURRENCY, "timeout": OPENAI_TIMEOUT}
@@ -2,10 +2,12 @@
 Система биллинга
 Управление платежами, подписками и доступом к функциям
 """
+import os
 import logging
+import asyncio
 from typing import Dict, Any, Optional
 from datetime import datetime
-from app.db import users, subscriptions
+from app.db import users, subscriptions, transactions
 from app.config.pricing import (
     get_tariff_info,
     get_feature_cost,
@@ -15,6 +17,13 @@ from . import balance_manager
 
 log = logging.getLogger("billing")
 
+# Через сколько секунд незакрытый резерв считается брошенным (операция упала
+# или callback не пришёл) и возвращается, и как часто это проверять
+RESERVE_TTL = int(os.getenv("RESERVE_TTL", str(6 * 3600)))
+RESERVE_SWEEP_INTERVAL = int(os.getenv("RESERVE_SWEEP_INTERVAL", "600"))
+# Сколько раз пытаться подтвердить резерв при ошибке БД (результат уже отдан)
+COMMIT_RETRIES = int(os.getenv("COMMIT_RETRIES", "3"))
+
 async def check_access(user_id: int, feature: str) -> Dict[str, Any]:
     """
     Проверить доступ пользователя к функции
@@ -107,7 +116,7 @@ async def deduct_coins_for_feature(
         
         # Списываем монетки (с приоритетом: подписочные → постоянные)
         from app.services.dual_balance import deduct_coins
-        result = await deduct_coins(user_id, cost)
+        result = await deduct_coins(user_id, cost, feature=feature)
         
         if not result['success']:
             return {
@@ -144,6 +153,170 @@ async def deduct_coins_for_feature(
             "message": "❌ Ошибка списания монеток"
         }
 
+async def reserve(
+    user_id: int,
+    feature: str,
+    custom_cost: Optional[int] = None
+) -> Dict[str, Any]:
+    """
+    Зарезервировать монетки за функцию одним запросом к БД
+    
+    Заменяет пару check_access + deduct_coins_for_feature: проверка
+    блокировки, баланса и списание выполняются атомарно. После операции
+    резерв нужно подтвердить через commit() или вернуть через release().
+    
+    Args:
+        user_id: ID пользователя
+        feature: Название функции
+        custom_cost: Пользовательская стоимость (если None, берется из конфига)
+        
+    Returns:
+        Dict с результатом (при успехе содержит reservation_id)
+    """
+    cost = custom_cost if custom_cost is not None else get_feature_cost(feature)
+    
+    try:
+        from app.services.dual_balance import reserve_coins
+        result = await reserve_coins(user_id, cost, feature)
+    except Exception as e:
+        log.error(f"❌ Ошибка резервирования монеток {user_id} для {feature}: {e}")
+        return {
+            "success": False,
+            "reason": "error",
+            "message": "❌ Ошибка списания монеток",
+            "cost": cost,
+            "balance": 0
+        }
+    
+    if not result['success']:
+        balance_info = result.get('old_balance') or {
+            'subscription_coins': 0,
+            'permanent_coins': 0,
+            'total': 0
+        }
+        balance = balance_info['total']
+        
+        if result['error'] == 'user_blocked':
+            reason, message = "user_blocked", "❌ Ваш аккаунт заблокирован"
+        elif result['error'] == 'insufficient_balance':
+            reason = "insufficient_funds"
+            message = (
+                f"❌ Недостаточно монеток!\n\n"
+                f"Стоимость: {cost} монет\n"
+                f"Ваш баланс: {balance} монет\n"
+                f"├ 🟢 Подписочные: {balance_info['subscription_coins']}\n"
+                f"└ 🟣 Постоянные: {balance_info['permanent_coins']}"
+            )
+        else:
+            reason, message = "user_not_found", "❌ Пользователь не найден"
+        
+        return {
+            "success": False,
+            "reason": reason,
+            "message": message,
+            "cost": cost,
+            "balance": balance,
+            "balance_details": balance_info
+        }
+    
+    log.info(
+        f"🔒 Зарезервировано {cost} монет у user {user_id} за {feature}: "
+        f"{result['deducted_from_subscription']}🟢 + "
+        f"{result['deducted_from_permanent']}🟣"
+    )
+    
+    return {
+        "success": True,
+        "reservation_id": result['reservation_id'],
+        "cost": cost,
+        "coins_spent": cost,
+        "deducted_from_subscription": result['deducted_from_subscription'],
+        "deducted_from_permanent": result['deducted_from_permanent'],
+        "balance_after": result['new_balance']['total'],
+        "balance_details": result['new_balance'],
+        "message": (
+            f"✅ Списано {cost} монет\n"
+            f"Остаток: {result['new_balance']['total']} монет"
+        )
+    }
+
+async def commit(reservation_id: int) -> bool:
+    """
+    Подтвердить резерв после успешной операции
+    
+    Результат уже отдан пользователю, поэтому при ошибке БД подтверждение
+    повторяется (COMMIT_RETRIES попыток с backoff), иначе резерв вернула бы
+    очистка зависших резервов.
+    """
+    from app.services.dual_balance import commit_reservation
+    
+    for attempt in range(1, COMMIT_RETRIES + 1):
+        try:
+            return await commit_reservation(reservation_id)
+        except Exception as e:
+            log.error(f"❌ Ошибка подтверждения резерва #{reservation_id} ({attempt}/{COMMIT_RETRIES}): {e}")
+            if attempt < COMMIT_RETRIES:
+                await asyncio.sleep(2 ** (attempt - 1))
+    return False
+
+async def release(reservation_id: int, note: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Вернуть зарезервированные монетки после неудачной операции
+    
+    Returns:
+        Dict с результатом: success, refunded, balance
+    """
+    try:
+        from app.services.dual_balance import release_reservation
+        result = await release_reservation(reservation_id, note)
+        return {
+            "success": result['success'],
+            "refunded": result['refunded'],
+            "balance": result['new_balance']['total'] if result['success'] else None
+        }
+    except Exception as e:
+        log.error(f"❌ Ошибка возврата резерва #{reservation_id}: {e}")
+        return {"success": False, "refunded": 0, "balance": None}
+
+async def release_stale_reservations() -> int:
+    """
+    Закрыть резервы старше RESERVE_TTL (одна пачка за вызов)
+    
+    Резерв доставленной генерации (commit не прошёл) подтверждается,
+    остальные возвращаются пользователю.
+    
+    Returns:
+        Количество возвращённых резервов
+    """
+    released = 0
+    for reservation in await transactions.get_stale_reservations(RESERVE_TTL):
+        if reservation['generation_status'] == 'completed':
+            if await commit(reservation['id']):
+                log.warning(f"✅ Зависший резерв #{reservation['id']} доставленной генерации подтверждён")
+            continue
+        result = await release(reservation['id'], "Резерв не закрыт вовремя")
+        if result['success']:
+            released += 1
+            log.warning(
+                f"↩️ Зависший резерв #{reservation['id']} ({reservation['feature']}) "
+                f"user {reservation['user_id']}: возвращено {result['refunded']} монет"
+            )
+    return released
+
+async def reservation_sweep_task():
+    """
+    Фоновая задача лидера: возврат брошенных резервов
+    Запускается каждые RESERVE_SWEEP_INTERVAL секунд
+    """
+    while True:
+        try:
+            released = await release_stale_reservations()
+            if released:
+                log.info(f"↩️ Возвращено зависших резервов: {released}")
+        except Exception as e:
+            log.error(f"❌ Ошибка возврата зависших резервов: {e}")
+        await asyncio.sleep(RESERVE_SWEEP_INTERVAL)
+
 async def process_subscription_payment(
     user_id: int,
     tariff_name: str,
@@ -0,0 +1,157 @@
+# app/services/clients/google_auth.py
+"""
+Общий провайдер access token сервисного аккаунта Google
+
+Учётка собирается один раз, токен кэшируется до истечения и заранее
+обновляется в фоне, поэтому запросы к Vertex AI / GCS не ждут OAuth.
+Используется всеми Google клиентами (Veo, Virtual Try-On).
+"""
+
+import os
+import json
+import base64
+import logging
+import asyncio
+import threading
+from datetime import datetime
+from typing import Optional, Dict, Any
+
+from google.oauth2 import service_account
+from google.auth.transport.requests import Request
+
+log = logging.getLogger("google_auth")
+
+SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
+# За сколько секунд до истечения обновлять токен
+GOOGLE_TOKEN_REFRESH_MARGIN = int(os.getenv("GOOGLE_TOKEN_REFRESH_MARGIN", "300"))
+
+def _load_credentials():
+    """Возвращает учётку сервисного аккаунта из ENV."""
+    # Сначала пробуем base64 (как в Veo)
+    key_b64 = os.getenv("GCP_KEY_JSON_B64")
+    if key_b64:
+        try:
+            key_json = base64.b64decode(key_b64).decode("utf-8")
+            return service_account.Credentials.from_service_account_info(
+                json.loads(key_json), scopes=SCOPES
+            )
+        except Exception as e:
+            log.error("Failed to parse GCP_KEY_JSON_B64: %s", e)
+
+    # Затем пробуем обычный JSON
+    json_str = os.getenv("GOOGLE_CREDENTIALS_JSON", "").strip()
+    if json_str:
+        try:
+            return service_account.Credentials.from_service_account_info(
+                json.loads(json_str), scopes=SCOPES
+            )
+        except Exception as e:
+            log.error("Failed to parse GOOGLE_CREDENTIALS_JSON: %s", e)
+
+    # fallback: путь до файла
+    path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS", "").strip()
+    if path and os.path.exists(path):
+        return service_account.Credentials.from_service_account_file(path, scopes=SCOPES)
+
+    raise RuntimeError("No Google credentials found. Set GCP_KEY_JSON_B64, GOOGLE_CREDENTIALS_JSON or GOOGLE_APPLICATION_CREDENTIALS")
+
+class GoogleTokenProvider:
+    """Кэшированный access token с упреждающим фоновым обновлением"""
+
+    def __init__(self, refresh_margin: int = GOOGLE_TOKEN_REFRESH_MARGIN):
+        self.refresh_margin = refresh_margin
+        self._credentials = None
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+        self.refreshes = 0
+        self.refresh_errors = 0
+
+    def _seconds_left(self) -> float:
+        creds = self._credentials
+        if creds is None or not creds.token or creds.expiry is None:
+            return 0.0
+        # google-auth хранит expiry как naive UTC
+        return (creds.expiry - datetime.utcnow()).total_seconds()
+
+    def _fresh(self) -> bool:
+        return self._seconds_left() > self.refresh_margin
+
+    def _refresh(self):
+        """Обновить токен (блокирующий OAuth запрос)"""
+        if self._credentials is None:
+            self._credentials = _load_credentials()
+        try:
+            self._credentials.refresh(Request())
+        except Exception as e:
+            self.refresh_errors += 1
+            # Испорченная учётка: собираем заново и пробуем ещё раз
+            if "Invalid JWT Signature" in str(e) or "invalid_grant" in str(e):
+                log.warning("JWT signature invalid, reloading credentials...")
+                self._credentials = _load_credentials()
+                self._credentials.refresh(Request())
+            else:
+                raise RuntimeError(f"Authentication failed: {e}")
+        self.refreshes += 1
+        log.info(f"🔑 Google access token обновлён (действует {self._seconds_left():.0f}с)")
+
+    def token_sync(self) -> str:
+        """Access token для синхронного кода (обновляет только при необходимости)"""
+        if not self._fresh():
+            with self._lock:
+                if not self._fresh():
+                    self._refresh()
+        return self._credentials.token
+
+    async def token(self) -> str:
+        """Access token; OAuth запрос выполняется в потоке только если кэш устарел"""
+        if not self._fresh():
+            await asyncio.to_thread(self.token_sync)
+        self.start()
+        return self._credentials.token
+
+    def start(self):
+        """Запустить фоновое обновление (идемпотентно, нужен работающий event loop)"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._refresh_loop())
+
+    async def _refresh_loop(self):
+        while True:
+            try:
+                wait = max(0.0, self._seconds_left() - self.refresh_margin)
+                await asyncio.sleep(wait)
+                await asyncio.to_thread(self.token_sync)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.error(f"❌ Ошибка фонового обновления Google токена: {e}")
+                await asyncio.sleep(30)
+
+    async def stop(self):
+        """Остановить фоновое обновление"""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        """Метрики провайдера"""
+        return {
+            "expires_in": round(self._seconds_left()),
+            "refreshes": self.refreshes,
+            "refresh_errors": self.refresh_errors,
+        }
+
+_provider: Optional[GoogleTokenProvider] = None
+
+def get_token_provider() -> GoogleTokenProvider:
+    """Провайдер токена процесса (создаётся лениво)"""
+    global _provider
+    if _provider is None:
+        _provider = GoogleTokenProvider()
+    return _provider
+
+async def stop_token_provider():
+    """Остановить фоновое обновление токена, если провайдер был создан"""
+    if _provider is not None:
+        await _provider.stop()
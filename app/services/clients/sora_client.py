@@ -17,7 +17,8 @@ async def create_sora_task(
     prompt: str,
     aspect_ratio: str = "9:16",
     duration: int = 5,
-    user_id: Optional[int] = None
+    user_id: Optional[int] = None,
+    reservation_id: Optional[int] = None
 ) -> Tuple[Optional[str], str]:
     """
     Создает задачу генерации видео через OpenAI SORA 2
@@ -27,6 +28,7 @@ async def create_sora_task(
         aspect_ratio: Соотношение сторон (9:16 или 16:9)
         duration: Длительность в секундах (до 20)
         user_id: ID пользователя для callback
+        reservation_id: ID резерва монеток (подтверждается/возвращается в callback)
     
     Returns:
         (task_id, status): ID задачи и статус ("success", "error", "demo_mode")
@@ -57,6 +59,8 @@ async def create_sora_task(
             "user_id": str(user_id) if user_id else "unknown"
         }
     }
+    if reservation_id:
+        payload["metadata"]["reservation_id"] = str(reservation_id)
     
     # Если доступен webhook, добавляем callback URL
     if PUBLIC_URL:
@@ -195,6 +199,17 @@ async def generate_video_sora2_async(
             "error": f"SORA 2 generation failed: {status}"
         }
 
+def extract_reservation_from_metadata(metadata: dict) -> Optional[int]:
+    """Извлекает reservation_id из метаданных callback"""
+    try:
+        reservation_id = metadata.get("reservation_id")
+        if reservation_id:
+            return int(reservation_id)
+        return None
+    except Exception as e:
+        log.error(f"❌ Error extracting reservation_id from metadata: {e}")
+        return None
+
 def extract_user_from_metadata(metadata: dict) -> Optional[int]:
     """Извлекает user_id из метаданных callback"""
     try:
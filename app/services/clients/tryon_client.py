@@ -1,143 +1,160 @@
 # app/services/clients/tryon_client.py
 # Клиент для Vertex AI Virtual Try-On (virtual-try-on-preview-08-04)
+# Асинхронный: общая aiohttp сессия, повторы через asyncio.sleep,
+# ограничение одновременных запросов. Постобработка результата -
+# в пуле процессов app.services.image_processing.
 
 import os
-import base64
 import json
+import base64
+import random
+import asyncio
 import logging
-import time
-import requests
-from PIL import Image, ImageEnhance, ImageFilter
-import io
+from typing import Optional, Dict, Any, Union
 
-from google.oauth2 import service_account
-from google.auth.transport.requests import Request
+import aiohttp
+
+from app.services import image_processing
+from .google_auth import get_token_provider
 
 log = logging.getLogger("tryon-client")
 
 PROJECT_ID = os.getenv("GCP_PROJECT_ID", "ornate-producer-473220-g2")
 LOCATION = os.getenv("GCP_LOCATION", "us-central1")
-SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
 MODEL_ID = "virtual-try-on-preview-08-04"
 HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "3"))
 TRYON_HTTP_TIMEOUT = int(os.getenv("TRYON_HTTP_TIMEOUT", "240"))
+# Одновременных запросов примерки
+TRYON_CONCURRENCY = int(os.getenv("TRYON_CONCURRENCY", "4"))
+# Имя файла результата (расширение по формату image_processing)
+RESULT_FILENAME = image_processing.output_filename("tryon_result")
+
+# Параметры predict (кроме sampleCount); входят в ключ кэша результатов
+PARAMETERS = {
+    "quality": "ultra_high",  # Максимальное качество
+    "resolution": "high",  # Высокое разрешение
+    "enhancement": "super_resolution",  # Супер-разрешение
+    "noise_reduction": True,  # Подавление шума
+    "sharpening": "medium",  # Умеренная резкость (не слишком агрессивно)
+    "color_correction": True,  # Коррекция цвета
+    "detail_preservation": True  # Сохранение деталей
+    # "storageUri": "gs://your-bucket/path/"  # если хочешь сохранять в GCS
+}
+
+_session: Optional[aiohttp.ClientSession] = None
+_semaphore: Optional[asyncio.Semaphore] = None
+
+_stats = {
+    "requests": 0,
+    "retries": 0,
+    "failed": 0,
+    "in_flight": 0,
+    "upload_bytes": 0,
+    "saved_bytes": 0,
+}
+
+# Кусок сырых байт для base64 (кратен 3 - без паддинга в середине)
+_B64_CHUNK = 3 * 64 * 1024
+
+async def _access_token() -> str:
+    """Access token из общего провайдера (кэшируется до истечения)"""
+    return await get_token_provider().token()
+
+def get_session() -> aiohttp.ClientSession:
+    """Общая HTTP сессия клиента примерочной с пулом соединений"""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=max(1, TRYON_CONCURRENCY)),
+            timeout=aiohttp.ClientTimeout(total=TRYON_HTTP_TIMEOUT)
+        )
+    return _session
+
+async def close_session():
+    """Закрыть общую HTTP сессию (при остановке приложения)"""
+    global _session
+    if _session and not _session.closed:
+        await _session.close()
+    _session = None
+
+def _get_semaphore() -> asyncio.Semaphore:
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(max(1, TRYON_CONCURRENCY))
+    return _semaphore
+
+def _write_b64(body: bytearray, data: bytes):
+    """Дописать base64 кусками прямо в тело запроса (без промежуточной строки)"""
+    view = memoryview(data)
+    for offset in range(0, len(view), _B64_CHUNK):
+        body += base64.b64encode(view[offset:offset + _B64_CHUNK])
+
+def _build_body(person_bytes: bytes, garment_bytes: bytes, parameters: dict) -> bytearray:
+    """
+    JSON тело predict запроса
 
-def _load_credentials():
-    """Возвращает учётку сервисного аккаунта из ENV."""
-    # Сначала пробуем base64 (как в Veo)
-    key_b64 = os.getenv("GCP_KEY_JSON_B64")
-    if key_b64:
-        try:
-            key_json = base64.b64decode(key_b64).decode("utf-8")
-            creds = service_account.Credentials.from_service_account_info(
-                json.loads(key_json), scopes=SCOPES
-            )
-            return creds
-        except Exception as e:
-            log.error("Failed to parse GCP_KEY_JSON_B64: %s", e)
-    
-    # Затем пробуем обычный JSON
-    json_str = os.getenv("GOOGLE_CREDENTIALS_JSON", "").strip()
-    if json_str:
-        try:
-            info = json.loads(json_str)
-            creds = service_account.Credentials.from_service_account_info(info, scopes=SCOPES)
-            return creds
-        except Exception as e:
-            log.error("Failed to parse GOOGLE_CREDENTIALS_JSON: %s", e)
-
-    # fallback: путь до файла
-    path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS", "").strip()
-    if path and os.path.exists(path):
-        creds = service_account.Credentials.from_service_account_file(path, scopes=SCOPES)
-        return creds
-
-    raise RuntimeError("No Google credentials found. Set GCP_KEY_JSON_B64, GOOGLE_CREDENTIALS_JSON or GOOGLE_APPLICATION_CREDENTIALS")
-
-def _access_token() -> str:
-    try:
-        creds = _load_credentials()
-        req = Request()
-        creds.refresh(req)
-        return creds.token
-    except Exception as e:
-        log.error("Failed to get access token: %s", e)
-        # Если JWT подпись неверная, попробуем перезагрузить credentials
-        if "Invalid JWT Signature" in str(e) or "invalid_grant" in str(e):
-            log.warning("JWT signature invalid, attempting to reload credentials...")
-            # Очищаем кеш и пробуем снова
-            try:
-                creds = _load_credentials()
-                req = Request()
-                creds.refresh(req)
-                return creds.token
-            except Exception as e2:
-                log.error("Failed to reload credentials: %s", e2)
-                raise RuntimeError(f"Authentication failed: {e2}")
-        else:
-            raise RuntimeError(f"Authentication failed: {e}")
-
-
-def _post_with_retry(url: str, headers: dict, payload: dict,
-                     timeout: int = TRYON_HTTP_TIMEOUT,
-                     attempts: int = HTTP_RETRIES):
-    backoff = 2
+    Картинки кодируются в base64 сразу в итоговый буфер: нет отдельных
+    base64 строк и повторной сериализации их через json.dumps.
+    """
+    body = bytearray(b'{"instances":[{"personImage":{"image":{"bytesBase64Encoded":"')
+    _write_b64(body, person_bytes)
+    body += b'"}},"productImages":[{"image":{"bytesBase64Encoded":"'
+    _write_b64(body, garment_bytes)
+    body += b'"}}]}],"parameters":'
+    body += json.dumps(parameters).encode("utf-8")
+    body += b"}"
+    return body
+
+async def _post_with_retry(url: str, payload: Union[dict, bytearray],
+                           timeout: int = TRYON_HTTP_TIMEOUT,
+                           attempts: int = HTTP_RETRIES) -> dict:
+    """
+    POST с повторами: экспоненциальная пауза с джиттером, без блокировки потока
+
+    payload - dict (сериализуется в JSON) или готовое JSON тело в байтах.
+    """
     last_error = None
 
     for attempt in range(1, attempts + 1):
         try:
-            response = requests.post(url, headers=headers, json=payload, timeout=timeout)
-            if response.status_code < 400:
-                return response
-
-            if response.status_code in (429, 500, 502, 503, 504):
-                last_error = RuntimeError(
-                    f"Retryable error {response.status_code}: {response.text[:512]}"
-                )
+            headers = {"Authorization": f"Bearer {await _access_token()}"}
+            if isinstance(payload, dict):
+                body = {"json": payload}
             else:
-                response.raise_for_status()
-        except requests.RequestException as exc:
+                headers["Content-Type"] = "application/json; charset=utf-8"
+                body = {"data": payload}
+            async with get_session().post(
+                url, headers=headers, **body,
+                timeout=aiohttp.ClientTimeout(total=timeout)
+            ) as response:
+                if response.status < 400:
+                    return await response.json()
+
+                text = await response.text()
+                if response.status in (429, 500, 502, 503, 504):
+                    last_error = RuntimeError(f"Retryable error {response.status}: {text[:512]}")
+                else:
+                    raise RuntimeError(f"Try-on request error {response.status}: {text[:512]}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
             last_error = exc
 
         if attempt < attempts:
-            sleep_for = backoff ** (attempt - 1)
+            _stats["retries"] += 1
+            sleep_for = random.uniform(0, min(20, 2 ** attempt))
             log.warning("Try-on request retry %s/%s after %s", attempt, attempts, last_error)
-            time.sleep(min(20, sleep_for))
+            await asyncio.sleep(sleep_for)
 
     raise RuntimeError(f"Try-on request failed after {attempts} attempts: {last_error}")
 
-def _enhance_image_quality(image_bytes: bytes) -> bytes:
-    """Улучшает качество изображения без потери деталей: убирает шум, повышает резкость."""
-    try:
-        # Открываем изображение
-        image = Image.open(io.BytesIO(image_bytes))
-        
-        # Сохраняем оригинальный размер
-        original_size = image.size
-        
-        # Легкое подавление шума (более мягкий подход)
-        image = image.filter(ImageFilter.MedianFilter(size=1))
-        
-        # Умеренное повышение резкости (не слишком агрессивно)
-        enhancer = ImageEnhance.Sharpness(image)
-        image = enhancer.enhance(1.2)  # Было 1.8, теперь 1.2
-        
-        # Легкое улучшение контраста
-        enhancer = ImageEnhance.Contrast(image)
-        image = enhancer.enhance(1.1)  # Было 1.3, теперь 1.1
-        
-        # Сохраняем в высоком качестве без потери деталей
-        output = io.BytesIO()
-        image.save(output, format='PNG', quality=95, optimize=True, compress_level=0)
-        return output.getvalue()
-        
-    except Exception as e:
-        log.warning("Failed to enhance image quality: %s", e)
-        return image_bytes  # Возвращаем оригинал если не удалось улучшить
-
-def virtual_tryon(person_bytes: bytes, garment_bytes: bytes, sample_count: int = 1):
+async def virtual_tryon(person_bytes: bytes, garment_bytes: bytes, sample_count: int = 1,
+                        prepared: bool = False, original_size: Optional[int] = None):
     """
-    Вызывает Vertex AI VTO. Возвращает PNG-байты результата или словарь с gcsUri.
+    Вызывает Vertex AI VTO. Возвращает байты результата (формат
+    IMAGE_OUTPUT_FORMAT, см. RESULT_FILENAME) или словарь с gcsUri.
+
+    Одновременно выполняется не больше TRYON_CONCURRENCY запросов.
+    prepared=True - фото уже прошли image_processing.prepare_input;
+    original_size - суммарный размер фото до неё (для метрики saved_bytes).
     """
     if not PROJECT_ID:
         raise RuntimeError("GCP_PROJECT_ID is not set")
@@ -147,46 +164,48 @@ def virtual_tryon(person_bytes: bytes, garment_bytes: bytes, sample_count: int =
         f"/locations/{LOCATION}/publishers/google/models/{MODEL_ID}:predict"
     )
 
-    headers = {
-        "Authorization": f"Bearer {_access_token()}",
-        "Content-Type": "application/json; charset=utf-8"
-    }
-
-    payload = {
-        "instances": [{
-            "personImage": {"image": {"bytesBase64Encoded": base64.b64encode(person_bytes).decode("utf-8")}},
-            "productImages": [
-                {"image": {"bytesBase64Encoded": base64.b64encode(garment_bytes).decode("utf-8")}}
-            ]
-        }],
-        "parameters": {
-            "sampleCount": int(sample_count),
-            "quality": "ultra_high",  # Максимальное качество
-            "resolution": "high",  # Высокое разрешение
-            "enhancement": "super_resolution",  # Супер-разрешение
-            "noise_reduction": True,  # Подавление шума
-            "sharpening": "medium",  # Умеренная резкость (не слишком агрессивно)
-            "color_correction": True,  # Коррекция цвета
-            "detail_preservation": True  # Сохранение деталей
-            # "storageUri": "gs://your-bucket/path/"  # если хочешь сохранять в GCS
-        }
-    }
-
-    log.info("VTO request → %s", url)
-    r = _post_with_retry(url, headers, payload)
-
-    data = r.json()
+    parameters = {"sampleCount": int(sample_count), **PARAMETERS}
+
+    # Уменьшаем фото до полезного для модели разрешения (в пуле процессов)
+    if original_size is None:
+        original_size = len(person_bytes) + len(garment_bytes)
+    if not prepared:
+        person_bytes, garment_bytes = await asyncio.gather(
+            image_processing.prepare_input(person_bytes),
+            image_processing.prepare_input(garment_bytes)
+        )
+    payload = _build_body(person_bytes, garment_bytes, parameters)
+    del person_bytes, garment_bytes
+
+    raw_size = original_size * 4 // 3
+    _stats["upload_bytes"] += len(payload)
+    _stats["saved_bytes"] += max(0, raw_size - len(payload))
+
+    async with _get_semaphore():
+        _stats["requests"] += 1
+        _stats["in_flight"] += 1
+        try:
+            log.info("VTO request → %s (%d KB, было бы %d KB)", url, len(payload) // 1024, raw_size // 1024)
+            data = await _post_with_retry(url, payload)
+        except Exception:
+            _stats["failed"] += 1
+            raise
+        finally:
+            _stats["in_flight"] -= 1
+
     preds = data.get("predictions") or []
     if not preds:
         raise RuntimeError(f"Empty VTO predictions: {data}")
 
     pred = preds[0]
     if "bytesBase64Encoded" in pred:
-        result_bytes = base64.b64decode(pred["bytesBase64Encoded"])
-        # Улучшаем качество результата
-        enhanced_bytes = _enhance_image_quality(result_bytes)
-        return enhanced_bytes
+        # Декодирование, улучшение качества и кодирование - в пуле процессов
+        return await image_processing.enhance(pred["bytesBase64Encoded"])
     if "gcsUri" in pred:
         return {"gcsUri": pred["gcsUri"]}
 
     raise RuntimeError(f"Unexpected VTO response structure: {list(pred.keys())}")
+
+def get_stats() -> Dict[str, Any]:
+    """Метрики клиента примерочной"""
+    return {**_stats, "concurrency": TRYON_CONCURRENCY}
@@ -1,12 +1,13 @@
 import os
 import time
-import json
-import base64
+import asyncio
 import logging
-import requests
-import subprocess
-from google.auth.transport.requests import Request
-from google.oauth2 import service_account
+from typing import Optional
+from urllib.parse import quote
+
+import aiohttp
+
+from .google_auth import get_token_provider
 
 log = logging.getLogger("veo_client")
 logging.basicConfig(level=logging.INFO)
@@ -18,78 +19,80 @@ OUTPUT_GCS_URI = os.getenv("VEO_OUTPUT_GCS_URI")  # gs://bucket/path/
 DOWNLOAD = os.getenv("DOWNLOAD_VIDEOS", "1") == "1"
 HTTP_TIMEOUT = int(os.getenv("HTTP_TIMEOUT", "60"))
 HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "3"))
+VEO_HTTP_POOL = int(os.getenv("VEO_HTTP_POOL", "20"))
+VEO_POLL_MIN = float(os.getenv("VEO_POLL_MIN", "5"))
+VEO_POLL_MAX = float(os.getenv("VEO_POLL_MAX", "30"))
+VEO_MAX_WAIT = int(os.getenv("VEO_MAX_WAIT", "1200"))
+VEO_RESUME_ATTEMPTS = int(os.getenv("VEO_RESUME_ATTEMPTS", "3"))
+# Как часто процесс продлевает владение своими задачами и через сколько
+# секунд без heartbeat задачу может забрать другая реплика
+VEO_HEARTBEAT = float(os.getenv("VEO_HEARTBEAT", "30"))
+VEO_HEARTBEAT_TTL = float(os.getenv("VEO_HEARTBEAT_TTL", "300"))
+DOWNLOAD_CHUNK = 1024 * 1024
+TASK_PREFIX = "veo3_"
 
-def _get_credentials():
-    key_b64 = os.getenv("GCP_KEY_JSON_B64")
-    if not key_b64:
-        raise RuntimeError("GCP_KEY_JSON_B64 не задан")
-    key_json = base64.b64decode(key_b64).decode("utf-8")
-    creds = service_account.Credentials.from_service_account_info(
-        json.loads(key_json),
-        scopes=["https://www.googleapis.com/auth/cloud-platform"],
-    )
-    creds.refresh(Request())
-    return creds
+BASE_URL = (
+    f"https://{LOCATION}-aiplatform.googleapis.com/v1/projects/{PROJECT_ID}"
+    f"/locations/{LOCATION}/publishers/google/models/{MODEL}"
+)
 
-def _authorized_session():
-    creds = _get_credentials()
-    s = requests.Session()
-    s.headers.update({"Authorization": f"Bearer {creds.token}"})
-    return s
+_session: Optional[aiohttp.ClientSession] = None
+
+async def _access_token() -> str:
+    """Access token сервисного аккаунта из общего провайдера"""
+    return await get_token_provider().token()
+
+def get_session() -> aiohttp.ClientSession:
+    """Общая HTTP сессия Veo клиента с пулом соединений"""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=VEO_HTTP_POOL),
+            timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT)
+        )
+    return _session
 
+async def close_session():
+    """Закрыть общую HTTP сессию (при остановке приложения)"""
+    global _session
+    if _session and not _session.closed:
+        await _session.close()
+    _session = None
 
-def _post_with_retry(session, url: str, payload: dict, timeout: int = HTTP_TIMEOUT,
-                     attempts: int = HTTP_RETRIES):
+async def _post_with_retry(url: str, payload: dict, timeout: int = HTTP_TIMEOUT,
+                           attempts: int = HTTP_RETRIES) -> dict:
     """Отправляет POST с повторными попытками и ограничением по тайм-ауту."""
     backoff = 2
     last_error = None
 
     for attempt in range(1, attempts + 1):
         try:
-            response = session.post(url, json=payload, timeout=timeout)
-            if response.status_code < 400:
-                return response
+            headers = {"Authorization": f"Bearer {await _access_token()}"}
+            async with get_session().post(
+                url, json=payload, headers=headers,
+                timeout=aiohttp.ClientTimeout(total=timeout)
+            ) as response:
+                if response.status < 400:
+                    return await response.json()
 
-            if response.status_code in (429, 500, 502, 503, 504):
-                last_error = RuntimeError(
-                    f"Retryable error {response.status_code}: {response.text[:256]}"
-                )
-            else:
-                response.raise_for_status()
-        except requests.RequestException as exc:
+                text = await response.text()
+                if response.status in (429, 500, 502, 503, 504):
+                    last_error = RuntimeError(f"Retryable error {response.status}: {text[:256]}")
+                else:
+                    raise RuntimeError(f"Veo request error {response.status}: {text[:256]}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
             last_error = exc
 
         if attempt < attempts:
             sleep_for = backoff ** (attempt - 1)
             log.warning("Veo request retry %s/%s after error: %s", attempt, attempts, last_error)
-            time.sleep(min(15, sleep_for))
+            await asyncio.sleep(min(15, sleep_for))
 
     raise RuntimeError(f"Veo request failed after {attempts} attempts: {last_error}")
 
-def _fix_aspect_with_ffmpeg(input_path: str, aspect="9:16") -> str:
-    """Прогон через ffmpeg, чтобы Telegram не сплющивал превью."""
-    fixed_path = input_path.replace(".mp4", "_fixed.mp4")
-    try:
-        subprocess.run([
-            "ffmpeg", "-y", "-i", input_path,
-            "-c:v", "libx264", "-preset", "fast", "-crf", "18",
-            "-c:a", "aac", "-b:a", "128k",
-            "-aspect", aspect,
-            "-movflags", "+faststart",
-            fixed_path
-        ], check=True)
-        return fixed_path
-    except Exception as e:
-        log.warning(f"FFmpeg fix failed: {e}")
-        return input_path
-
-def generate_video_sync(prompt: str, duration: int = 8, aspect_ratio: str = "9:16", with_audio: bool = True):
-    sess = _authorized_session()
-    url = (
-        f"https://{LOCATION}-aiplatform.googleapis.com/v1/projects/{PROJECT_ID}"
-        f"/locations/{LOCATION}/publishers/google/models/{MODEL}:predictLongRunning"
-    )
-
+async def start_generation(prompt: str, duration: int = 8, aspect_ratio: str = "9:16",
+                           with_audio: bool = True) -> str:
+    """Запустить генерацию, вернуть имя long-running операции"""
     params = {
         "sampleCount": 1,
         "resolution": "720p",  # Veo 3 поддерживает только 720p или 1080p
@@ -105,95 +108,90 @@ def generate_video_sync(prompt: str, duration: int = 8, aspect_ratio: str = "9:1
         "parameters": params,
     }
 
+    url = f"{BASE_URL}:predictLongRunning"
     log.info(f"Запрос генерации: {url}")
-    r = _post_with_retry(sess, url, body)
+    resp = await _post_with_retry(url, body)
 
-    resp = r.json()
     op_name = resp.get("name")
     if not op_name:
         raise RuntimeError(f"Не удалось получить operation name: {resp}")
     log.info(f"Получили op_name: {op_name}")
+    return op_name
 
-    return _poll_and_collect(sess, op_name)
-
-def _poll_and_collect(sess, op_name: str):
-    url = (
-        f"https://{LOCATION}-aiplatform.googleapis.com/v1/projects/{PROJECT_ID}"
-        f"/locations/{LOCATION}/publishers/google/models/{MODEL}:fetchPredictOperation"
+async def fetch_operation(op_name: str, attempts: int = HTTP_RETRIES) -> dict:
+    """Один опрос состояния операции"""
+    return await _post_with_retry(
+        f"{BASE_URL}:fetchPredictOperation",
+        {"operationName": op_name},
+        timeout=HTTP_TIMEOUT,
+        attempts=attempts
     )
-    payload = {"operationName": op_name}
 
-    while True:
-        rr = _post_with_retry(sess, url, payload, timeout=HTTP_TIMEOUT, attempts=HTTP_RETRIES)
-
-        data = rr.json()
-        if data.get("done"):
-            videos = (data.get("response") or {}).get("videos") or []
-            out_files = []
-            if not videos:
-                return {"videos": []}
-
-            from google.cloud import storage
-            storage_client = storage.Client(project=PROJECT_ID, credentials=_get_credentials())
-            ts = int(time.time())
-
-            for i, v in enumerate(videos):
-                item = {}
-                gcs_uri = v.get("gcsUri")
-                if gcs_uri:
-                    _, path = gcs_uri.split("gs://", 1)
-                    bucket_name, blob_name = path.split("/", 1)
-                    bucket = storage_client.bucket(bucket_name)
-                    blob = bucket.blob(blob_name)
-                    local_path = f"video_{ts}_{i}.mp4"
-                    blob.download_to_filename(local_path)
-                    log.info(f"Скачано в {local_path}")
-                    fixed_path = _fix_aspect_with_ffmpeg(local_path)
-                    item["uri"] = gcs_uri
-                    item["file_path"] = fixed_path
-                    out_files.append(item)
-                    continue
+def _operation_progress(data: dict) -> Optional[float]:
+    """Прогресс операции 0..100, если API его отдаёт"""
+    metadata = data.get("metadata") or {}
+    for key in ("progressPercent", "progressPercentage", "progress"):
+        value = metadata.get(key)
+        if value is not None:
+            try:
+                return float(value)
+            except (TypeError, ValueError):
+                return None
+    return None
 
-                b64 = v.get("bytesBase64Encoded")
-                if b64:
-                    raw = base64.b64decode(b64)
-                    local_path = f"video_{ts}_{i}.mp4"
-                    with open(local_path, "wb") as f:
-                        f.write(raw)
-                    fixed_path = _fix_aspect_with_ffmpeg(local_path)
-                    item["file_path"] = fixed_path
-                    out_files.append(item)
-                    continue
+def _next_poll_delay(delay: float, started: float, progress: Optional[float]) -> float:
+    """
+    Интервал до следующего опроса
 
-            return {"videos": out_files}
-        time.sleep(5)
+    Если операция сообщает прогресс, ждём примерно до её окончания
+    (оценка по текущей скорости), иначе плавно увеличиваем интервал.
+    """
+    if progress and 0 < progress < 100:
+        elapsed = time.monotonic() - started
+        remaining = elapsed * (100 - progress) / progress
+        return max(VEO_POLL_MIN, min(VEO_POLL_MAX, remaining / 2))
+    return min(VEO_POLL_MAX, delay * 1.5)
 
-async def generate_video_veo3_async(
-    prompt: str,
-    duration: int = 8,
-    aspect_ratio: str = "9:16",
-    with_audio: bool = True
-) -> dict:
-    """Асинхронная версия генерации VEO 3"""
-    import asyncio
-    return await asyncio.to_thread(
-        generate_video_sync,
-        prompt=prompt,
-        duration=duration,
-        aspect_ratio=aspect_ratio,
-        with_audio=with_audio
+async def iter_gcs(gcs_uri: str, chunk_size: int = DOWNLOAD_CHUNK):
+    """Читать объект GCS через JSON API потоково, кусками"""
+    _, path = gcs_uri.split("gs://", 1)
+    bucket_name, blob_name = path.split("/", 1)
+    url = (
+        f"https://storage.googleapis.com/storage/v1/b/{bucket_name}"
+        f"/o/{quote(blob_name, safe='')}?alt=media"
     )
+    headers = {"Authorization": f"Bearer {await _access_token()}"}
+    async with get_session().get(
+        url, headers=headers, timeout=aiohttp.ClientTimeout(total=None, sock_read=HTTP_TIMEOUT)
+    ) as response:
+        response.raise_for_status()
+        async for chunk in response.content.iter_chunked(chunk_size):
+            yield chunk
+
+def video_chunks(video: dict):
+    """Поток байт результата операции (GCS или base64), None если результата нет"""
+    from app.services.video_stream import b64_chunks
+    
+    if video.get("gcsUri"):
+        return iter_gcs(video["gcsUri"])
+    if video.get("bytesBase64Encoded"):
+        return b64_chunks(video["bytesBase64Encoded"])
+    return None
 
 async def create_veo3_task(
     prompt: str,
     duration: int = 8,
     aspect_ratio: str = "9:16",
     with_audio: bool = True,
-    user_id: int = None
+    user_id: int = None,
+    reservation_id: int = None,
+    feature: str = "video",
+    coins_spent: int = 0
 ):
     """
-    Создает асинхронную задачу генерации через VEO 3 (с polling)
-    Возвращает task_id и запускает фоновый polling
+    Создает задачу генерации через VEO 3
+    Сохраняет задачу в generations, запускает операцию и ставит её
+    на опрос в общий планировщик
     
     Args:
         prompt: Текстовое описание
@@ -201,113 +199,189 @@ async def create_veo3_task(
         aspect_ratio: Ориентация (9:16 или 16:9)
         with_audio: Генерировать аудио
         user_id: ID пользователя для отправки результата
+        reservation_id: ID резерва монеток (подтверждается после отправки, иначе возвращается)
+        feature: Функция биллинга
+        coins_spent: Стоимость задачи в монетках
     
     Returns:
         (task_id, status): ID задачи и статус
     """
     import uuid
-    import asyncio
+    from app.db import generations
     
     # Генерируем уникальный ID задачи
-    task_id = f"veo3_{uuid.uuid4().hex[:12]}"
+    task_id = f"{TASK_PREFIX}{uuid.uuid4().hex[:12]}"
     
     log.info(f"🎬 Creating VEO 3 task {task_id} for user {user_id}")
     
-    # Запускаем генерацию в фоне
-    asyncio.create_task(
-        _generate_and_notify_veo3(
-            task_id=task_id,
-            user_id=user_id,
-            prompt=prompt,
-            duration=duration,
-            aspect_ratio=aspect_ratio,
-            with_audio=with_audio
-        )
+    params = {
+        "duration": duration,
+        "aspect_ratio": aspect_ratio,
+        "with_audio": with_audio
+    }
+    job = await generations.create_generation(
+        task_id, user_id, feature, coins_spent,
+        prompt=prompt, model=MODEL, params=params, reservation_id=reservation_id
     )
+    if job is None:
+        # Без строки generations результат не будет доставлен - не запускаем генерацию
+        log.error(f"❌ VEO 3 task {task_id}: не удалось сохранить задачу, генерация не запущена")
+        return None, "error"
+    
+    try:
+        op_name = await start_generation(prompt, duration, aspect_ratio, with_audio)
+    except Exception as e:
+        log.error(f"❌ VEO 3 task {task_id}: не удалось запустить генерацию: {e}")
+        await generations.fail_generation(task_id, f"start failed: {e}")
+        return None, "error"
+    
+    await generations.set_operation(task_id, op_name)
+    _schedule_veo3(task_id, user_id, reservation_id, op_name)
     
     return task_id, "success"
 
-async def _generate_and_notify_veo3(
+def _schedule_veo3(task_id: str, user_id: int, reservation_id: Optional[int],
+                   op_name: str, elapsed: float = 0.0):
+    """Поставить операцию задачи на опрос в общий планировщик"""
+    from functools import partial
+    from app.services.veo_scheduler import get_scheduler
+    
+    get_scheduler().register(
+        op_name,
+        on_done=partial(_deliver_veo3, task_id, user_id, reservation_id),
+        on_error=partial(_fail_veo3, task_id, user_id, reservation_id),
+        elapsed=elapsed,
+        task_id=task_id
+    )
+
+async def resume_veo3_jobs() -> int:
+    """
+    Возобновить незавершённые задачи VEO 3, брошенные своим процессом
+    
+    Забираются только задачи без heartbeat дольше VEO_HEARTBEAT_TTL
+    (процесс-владелец остановлен или упал), задачи живых реплик не трогаются.
+    - операция запущена: снова ставим на опрос (готовый результат будет доставлен);
+    - операция не успела запуститься: запускаем заново с сохранёнными параметрами;
+    - задача возобновлялась слишком много раз: помечаем failed и возвращаем монетки.
+    
+    Returns:
+        Количество возобновлённых задач
+    """
+    from app.db import generations
+    
+    jobs = await generations.claim_unfinished_generations(TASK_PREFIX, VEO_HEARTBEAT_TTL)
+    resumed = 0
+    
+    for job in jobs:
+        task_id = job['task_id']
+        user_id = job['user_id']
+        reservation_id = job.get('reservation_id')
+        
+        try:
+            if job['attempts'] > VEO_RESUME_ATTEMPTS:
+                await _fail_veo3(
+                    task_id, user_id, reservation_id,
+                    RuntimeError(f"задача прервана {job['attempts']} раз")
+                )
+                continue
+            
+            op_name = job.get('operation_name')
+            if not op_name:
+                params = job.get('params') or {}
+                op_name = await start_generation(
+                    job.get('prompt') or "",
+                    params.get('duration', 8),
+                    params.get('aspect_ratio', "9:16"),
+                    params.get('with_audio', True)
+                )
+                await generations.set_operation(task_id, op_name)
+                elapsed = 0.0
+            else:
+                elapsed = float(job.get('age_seconds') or 0)
+            
+            _schedule_veo3(task_id, user_id, reservation_id, op_name, elapsed=elapsed)
+            resumed += 1
+        except Exception as e:
+            log.error(f"❌ Не удалось возобновить VEO 3 task {task_id}: {e}")
+            await _fail_veo3(task_id, user_id, reservation_id, e)
+    
+    if jobs:
+        log.info(f"🔁 Возобновлено задач VEO 3: {resumed} из {len(jobs)}")
+    return resumed
+
+async def veo3_resume_task():
+    """
+    Фоновая задача лидера: забирать задачи VEO 3, брошенные упавшими
+    или остановленными репликами
+    Запускается сразу и затем каждые VEO_HEARTBEAT_TTL секунд
+    """
+    while True:
+        try:
+            await resume_veo3_jobs()
+        except Exception as e:
+            log.error(f"❌ Ошибка возобновления задач VEO 3: {e}")
+        await asyncio.sleep(VEO_HEARTBEAT_TTL)
+
+async def _deliver_veo3(
     task_id: str,
     user_id: int,
-    prompt: str,
-    duration: int,
-    aspect_ratio: str,
-    with_audio: bool
+    reservation_id: Optional[int],
+    data: dict
 ):
     """
-    Фоновая задача: генерирует видео и отправляет пользователю
+    Стадия доставки: отправляет результат завершённой операции пользователю потоком
     """
-    import asyncio
-    from aiogram import Bot
-    import os
+    from app.db import generations
+    from app.services import billing, notifier, video_stream
     
-    bot_token = os.getenv("BOT_TOKEN")
-    if not bot_token:
-        log.error("BOT_TOKEN not found for VEO 3 notification")
+    if not await generations.mark_delivering(task_id):
+        # Задачу уже доставил или забрал другой процесс - не отправляем второй раз
+        log.warning(f"⚠️ VEO 3 task {task_id}: задача не принадлежит процессу, доставка пропущена")
         return
     
-    bot = Bot(token=bot_token)
-    
+    delivered = False
+    failed = False
+    prepared = None
     try:
-        log.info(f"🎬 Starting VEO 3 generation for task {task_id}")
-        
-        # Генерируем видео (синхронная функция в отдельном потоке)
-        result = await asyncio.to_thread(
-            generate_video_sync,
-            prompt=prompt,
-            duration=duration,
-            aspect_ratio=aspect_ratio,
-            with_audio=with_audio
-        )
+        if data.get("error"):
+            raise RuntimeError(f"Veo operation failed: {data['error']}")
         
-        videos = result.get('videos', [])
-        if not videos:
+        videos = (data.get("response") or {}).get("videos") or []
+        chunks = video_chunks(videos[0]) if videos else None
+        if chunks is None:
             log.error(f"❌ VEO 3 task {task_id}: No videos generated")
-            await bot.send_message(
+            await notifier.send_message(
                 user_id,
                 "❌ Ошибка генерации видео VEO 3. Монетки возвращены на баланс.",
                 parse_mode="HTML"
             )
             return
         
-        video_file = videos[0].get('file_path')
-        if video_file and os.path.exists(video_file):
-            log.info(f"✅ VEO 3 task {task_id}: Sending video to user {user_id}")
-            
-            # Отправляем видео
-            from aiogram.types import FSInputFile
-            video = FSInputFile(video_file)
-            
-            await bot.send_video(
-                user_id,
-                video,
-                caption="✅ Видео VEO 3 готово!",
-                parse_mode="HTML"
-            )
-            
-            log.info(f"✅ VEO 3 task {task_id}: Video sent successfully")
-            
-            # Удаляем временные файлы
-            try:
-                os.remove(video_file)
-                original_file = video_file.replace("_fixed.mp4", ".mp4")
-                if os.path.exists(original_file) and original_file != video_file:
-                    os.remove(original_file)
-            except Exception as e:
-                log.warning(f"Failed to remove temp files: {e}")
-        else:
-            log.error(f"❌ VEO 3 task {task_id}: Video file not found")
-            await bot.send_message(
-                user_id,
-                "❌ Ошибка: файл видео не найден",
-                parse_mode="HTML"
-            )
+        # Байты идут из GCS/base64 прямо в загрузку Telegram
+        prepared = await video_stream.open_video(chunks, filename=f"{task_id}.mp4")
+        log.info(
+            f"✅ VEO 3 task {task_id}: Sending video to user {user_id} "
+            f"({'stream' if prepared['streamed'] else 'remux'})"
+        )
+        
+        await notifier.send_video(
+            user_id,
+            prepared["file"],
+            width=prepared["width"],
+            height=prepared["height"],
+            supports_streaming=True,
+            caption="✅ Видео VEO 3 готово!",
+            parse_mode="HTML"
+        )
+        
+        log.info(f"✅ VEO 3 task {task_id}: Video sent successfully")
+        delivered = True
+        await generations.complete_generation(task_id)
     
     except Exception as e:
         log.error(f"❌ VEO 3 task {task_id} failed: {e}", exc_info=True)
         try:
-            await bot.send_message(
+            await notifier.send_message(
                 user_id,
                 f"❌ Ошибка генерации видео VEO 3: {str(e)}",
                 parse_mode="HTML"
@@ -316,4 +390,36 @@ async def _generate_and_notify_veo3(
             log.error(f"Failed to send error message to user {user_id}")
     
     finally:
-        await bot.session.close()
+        video_stream.cleanup(prepared)
+        if not delivered:
+            failed = await generations.fail_generation(task_id, "видео не доставлено")
+        if reservation_id:
+            if delivered:
+                await billing.commit(reservation_id)
+            elif failed:
+                await billing.release(reservation_id, f"VEO 3 {task_id}: видео не доставлено")
+
+async def _fail_veo3(
+    task_id: str,
+    user_id: int,
+    reservation_id: Optional[int],
+    error: Exception
+):
+    """Операция не завершилась (таймаут или ошибки опроса): сообщаем и возвращаем монетки"""
+    from app.db import generations
+    from app.services import billing, notifier
+    
+    log.error(f"❌ VEO 3 task {task_id} failed: {error}")
+    if not await generations.fail_generation(task_id, str(error)):
+        # Задача уже завершена или её ведёт другой процесс - монетки не трогаем
+        log.warning(f"⚠️ VEO 3 task {task_id}: задача не принадлежит процессу, возврат пропущен")
+        return
+    
+    if reservation_id:
+        await billing.release(reservation_id, f"VEO 3 {task_id}: {str(error)[:150]}")
+    
+    await notifier.notify(
+        user_id,
+        "❌ Ошибка генерации видео VEO 3. Монетки возвращены на баланс.",
+        parse_mode="HTML"
+    )
@@ -8,10 +8,11 @@
 """
 
 import logging
-from typing import Dict, Tuple
+from typing import Dict, Tuple, Optional
 from datetime import datetime
 
 from app.db import database
+from app.db.users import invalidate_user_cache
 
 log = logging.getLogger("dual_balance")
 
@@ -52,19 +53,237 @@ async def get_user_dual_balance(user_id: int) -> Dict[str, int]:
             'total': result['subscription_coins'] + result['permanent_coins']
         }
 
-async def deduct_coins(user_id: int, coins: int) -> Dict:
+# Списание одним оператором: блокировка строки, разбивка "сначала подписочные",
+# проверка баланса и запись в журнал транзакций выполняются атомарно
+_DEDUCT_SQL = """
+    WITH old AS (
+        SELECT
+            user_id,
+            COALESCE(subscription_coins, 0) AS sub,
+            COALESCE(permanent_coins, 0) AS perm
+        FROM users
+        WHERE user_id = $1
+        FOR UPDATE
+    ), upd AS (
+        UPDATE users u
+        SET subscription_coins = old.sub - LEAST($2, old.sub),
+            permanent_coins = old.perm - ($2 - LEAST($2, old.sub)),
+            balance = old.sub + old.perm - $2,
+            updated_at = NOW()
+        FROM old
+        WHERE u.user_id = old.user_id
+          AND old.sub + old.perm >= $2
+        RETURNING u.user_id, u.subscription_coins, u.permanent_coins
+    ), ledger AS (
+        INSERT INTO transactions
+            (user_id, transaction_type, feature, coins_delta, balance_before, balance_after, note,
+             subscription_delta, permanent_delta)
+        SELECT
+            upd.user_id, 'spend', $3, -$2,
+            old.sub + old.perm, upd.subscription_coins + upd.permanent_coins, $4,
+            upd.subscription_coins - old.sub, upd.permanent_coins - old.perm
+        FROM upd JOIN old ON old.user_id = upd.user_id
+        RETURNING id
+    )
+    SELECT
+        old.sub,
+        old.perm,
+        upd.subscription_coins AS new_sub,
+        upd.permanent_coins AS new_perm,
+        (SELECT id FROM ledger) AS transaction_id
+    FROM old
+    LEFT JOIN upd ON upd.user_id = old.user_id
+"""
+
+async def deduct_coins(
+    user_id: int,
+    coins: int,
+    feature: Optional[str] = None,
+    note: Optional[str] = None
+) -> Dict:
     """
     Списать монетки с приоритетом: сначала подписочные, потом постоянные
     
+    Выполняется одним запросом: строка пользователя блокируется, поэтому
+    параллельные генерации не могут списать одни и те же монетки дважды.
+    
     Args:
         user_id: ID пользователя
         coins: Сколько монеток списать
+        feature: Название функции для журнала транзакций
+        note: Описание для журнала транзакций
+    
+    Returns:
+        {
+            'success': bool,
+            'deducted_from_subscription': int,
+            'deducted_from_permanent': int,
+            'new_balance': dict,
+            'transaction_id': int
+        }
+    """
+    pool = database.get_db_pool()
+    if not pool:
+        raise RuntimeError("Database pool not initialized")
+    
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            row = await conn.fetchrow(
+                _DEDUCT_SQL, user_id, coins, feature,
+                note or (f"Использование: {feature}" if feature else None)
+            )
+    invalidate_user_cache(user_id)
+    
+    if not row:
+        return {'success': False, 'error': 'User not found'}
+    
+    if row['new_sub'] is None:
+        return {
+            'success': False,
+            'error': 'Insufficient balance',
+            'needed': coins,
+            'available': row['sub'] + row['perm']
+        }
+    
+    deducted_sub = row['sub'] - row['new_sub']
+    deducted_perm = row['perm'] - row['new_perm']
+    
+    log.info(
+        f"💰 Списано {coins} монет у user {user_id}: "
+        f"{deducted_sub} подписочных + {deducted_perm} постоянных"
+    )
+    
+    return {
+        'success': True,
+        'deducted_from_subscription': deducted_sub,
+        'deducted_from_permanent': deducted_perm,
+        'new_balance': {
+            'subscription_coins': row['new_sub'],
+            'permanent_coins': row['new_perm'],
+            'total': row['new_sub'] + row['new_perm']
+        },
+        'transaction_id': row['transaction_id']
+    }
+
+# Резерв: то же списание, но с проверкой блокировки и типом 'reserve'
+_RESERVE_SQL = """
+    WITH old AS (
+        SELECT
+            user_id,
+            COALESCE(subscription_coins, 0) AS sub,
+            COALESCE(permanent_coins, 0) AS perm,
+            COALESCE(is_blocked, FALSE) AS is_blocked
+        FROM users
+        WHERE user_id = $1
+        FOR UPDATE
+    ), upd AS (
+        UPDATE users u
+        SET subscription_coins = old.sub - LEAST($2, old.sub),
+            permanent_coins = old.perm - ($2 - LEAST($2, old.sub)),
+            balance = old.sub + old.perm - $2,
+            updated_at = NOW()
+        FROM old
+        WHERE u.user_id = old.user_id
+          AND NOT old.is_blocked
+          AND old.sub + old.perm >= $2
+        RETURNING u.user_id, u.subscription_coins, u.permanent_coins
+    ), ledger AS (
+        INSERT INTO transactions
+            (user_id, transaction_type, feature, coins_delta, balance_before, balance_after, note,
+             subscription_delta, permanent_delta)
+        SELECT
+            upd.user_id, 'reserve', $3, -$2,
+            old.sub + old.perm, upd.subscription_coins + upd.permanent_coins,
+            'Резерв: ' || COALESCE($3, ''),
+            upd.subscription_coins - old.sub, upd.permanent_coins - old.perm
+        FROM upd JOIN old ON old.user_id = upd.user_id
+        RETURNING id
+    )
+    SELECT
+        old.sub,
+        old.perm,
+        old.is_blocked,
+        upd.subscription_coins AS new_sub,
+        upd.permanent_coins AS new_perm,
+        (SELECT id FROM ledger) AS reservation_id
+    FROM old
+    LEFT JOIN upd ON upd.user_id = old.user_id
+"""
+
+# Отмена резерва: помечаем резерв как 'released' (только один раз) и
+# возвращаем монетки в те же кошельки. Подписочные возвращаются
+# постоянными, если активной подписки уже нет.
+_RELEASE_SQL = """
+    WITH res AS (
+        UPDATE transactions
+        SET transaction_type = 'released'
+        WHERE id = $1 AND transaction_type = 'reserve'
+        RETURNING
+            user_id,
+            feature,
+            -COALESCE(subscription_delta, 0) AS sub,
+            -COALESCE(permanent_delta, coins_delta - COALESCE(subscription_delta, 0)) AS perm
+    ), refund AS (
+        SELECT
+            res.user_id,
+            res.feature,
+            CASE WHEN active.has_sub THEN res.sub ELSE 0 END AS sub,
+            CASE WHEN active.has_sub THEN res.perm ELSE res.perm + res.sub END AS perm
+        FROM res
+        CROSS JOIN LATERAL (
+            SELECT EXISTS (
+                SELECT 1 FROM subscriptions s
+                WHERE s.user_id = res.user_id
+                  AND s.is_active = TRUE
+                  AND s.end_date > NOW()
+            ) AS has_sub
+        ) active
+    ), upd AS (
+        UPDATE users u
+        SET subscription_coins = COALESCE(u.subscription_coins, 0) + refund.sub,
+            permanent_coins = COALESCE(u.permanent_coins, 0) + refund.perm,
+            balance = COALESCE(u.subscription_coins, 0) + COALESCE(u.permanent_coins, 0)
+                      + refund.sub + refund.perm,
+            updated_at = NOW()
+        FROM refund
+        WHERE u.user_id = refund.user_id
+        RETURNING u.user_id, u.subscription_coins, u.permanent_coins
+    ), ledger AS (
+        INSERT INTO transactions
+            (user_id, transaction_type, feature, coins_delta, balance_before, balance_after, note,
+             subscription_delta, permanent_delta)
+        SELECT
+            upd.user_id, 'refund', refund.feature, refund.sub + refund.perm,
+            upd.subscription_coins + upd.permanent_coins - refund.sub - refund.perm,
+            upd.subscription_coins + upd.permanent_coins,
+            $2, refund.sub, refund.perm
+        FROM upd JOIN refund ON refund.user_id = upd.user_id
+    )
+    SELECT
+        upd.user_id,
+        refund.sub,
+        refund.perm,
+        upd.subscription_coins AS new_sub,
+        upd.permanent_coins AS new_perm
+    FROM upd JOIN refund ON refund.user_id = upd.user_id
+"""
+
+async def reserve_coins(user_id: int, coins: int, feature: Optional[str] = None) -> Dict:
+    """
+    Зарезервировать монетки под операцию одним запросом
+    
+    Проверяет блокировку и баланс, списывает монетки (сначала подписочные)
+    и создаёт строку резерва в журнале транзакций. Резерв затем
+    подтверждается commit_reservation или отменяется release_reservation.
     
     Returns:
         {
             'success': bool,
+            'error': str,              # при неудаче: user_not_found, user_blocked, insufficient_balance
+            'reservation_id': int,
             'deducted_from_subscription': int,
             'deducted_from_permanent': int,
+            'old_balance': dict,
             'new_balance': dict
         }
     """
@@ -73,63 +292,109 @@ async def deduct_coins(user_id: int, coins: int) -> Dict:
         raise RuntimeError("Database pool not initialized")
     
     async with pool.acquire() as conn:
-        # Получаем текущие балансы
-        user = await conn.fetchrow("""
-            SELECT subscription_coins, permanent_coins
-            FROM users
-            WHERE user_id = $1
-        """, user_id)
-        
-        if not user:
-            return {'success': False, 'error': 'User not found'}
-        
-        sub_coins = user['subscription_coins'] or 0
-        perm_coins = user['permanent_coins'] or 0
-        total = sub_coins + perm_coins
-        
-        if total < coins:
-            return {
-                'success': False,
-                'error': 'Insufficient balance',
-                'needed': coins,
-                'available': total
-            }
-        
-        # Списываем сначала с подписочных
-        deducted_sub = min(coins, sub_coins)
-        remaining = coins - deducted_sub
-        
-        # Если не хватило подписочных, списываем с постоянных
-        deducted_perm = min(remaining, perm_coins) if remaining > 0 else 0
-        
-        new_sub = sub_coins - deducted_sub
-        new_perm = perm_coins - deducted_perm
-        
-        # Обновляем балансы
-        await conn.execute("""
-            UPDATE users
-            SET subscription_coins = $2,
-                permanent_coins = $3,
-                balance = $4,
-                updated_at = NOW()
-            WHERE user_id = $1
-        """, user_id, new_sub, new_perm, new_sub + new_perm)
-        
-        log.info(
-            f"💰 Списано {coins} монет у user {user_id}: "
-            f"{deducted_sub} подписочных + {deducted_perm} постоянных"
-        )
-        
+        row = await conn.fetchrow(_RESERVE_SQL, user_id, coins, feature)
+    invalidate_user_cache(user_id)
+    
+    if not row:
+        return {'success': False, 'error': 'user_not_found'}
+    
+    old_balance = {
+        'subscription_coins': row['sub'],
+        'permanent_coins': row['perm'],
+        'total': row['sub'] + row['perm']
+    }
+    
+    if row['is_blocked']:
+        return {'success': False, 'error': 'user_blocked', 'old_balance': old_balance}
+    
+    if row['new_sub'] is None:
         return {
-            'success': True,
-            'deducted_from_subscription': deducted_sub,
-            'deducted_from_permanent': deducted_perm,
-            'new_balance': {
-                'subscription_coins': new_sub,
-                'permanent_coins': new_perm,
-                'total': new_sub + new_perm
-            }
+            'success': False,
+            'error': 'insufficient_balance',
+            'needed': coins,
+            'old_balance': old_balance
         }
+    
+    deducted_sub = row['sub'] - row['new_sub']
+    deducted_perm = row['perm'] - row['new_perm']
+    
+    log.info(
+        f"🔒 Резерв #{row['reservation_id']}: {coins} монет у user {user_id} "
+        f"({deducted_sub} подписочных + {deducted_perm} постоянных)"
+    )
+    
+    return {
+        'success': True,
+        'reservation_id': row['reservation_id'],
+        'deducted_from_subscription': deducted_sub,
+        'deducted_from_permanent': deducted_perm,
+        'old_balance': old_balance,
+        'new_balance': {
+            'subscription_coins': row['new_sub'],
+            'permanent_coins': row['new_perm'],
+            'total': row['new_sub'] + row['new_perm']
+        }
+    }
+
+async def commit_reservation(reservation_id: int) -> bool:
+    """
+    Подтвердить резерв: монетки окончательно списаны
+    
+    Returns:
+        True если резерв был активен и подтверждён
+    """
+    pool = database.get_db_pool()
+    if not pool:
+        raise RuntimeError("Database pool not initialized")
+    
+    async with pool.acquire() as conn:
+        committed = await conn.fetchval("""
+            UPDATE transactions
+            SET transaction_type = 'spend'
+            WHERE id = $1 AND transaction_type = 'reserve'
+            RETURNING id
+        """, reservation_id)
+    
+    if committed:
+        log.info(f"✅ Резерв #{reservation_id} подтверждён")
+    else:
+        log.warning(f"⚠️ Резерв #{reservation_id} уже закрыт")
+    return bool(committed)
+
+async def release_reservation(reservation_id: int, note: Optional[str] = None) -> Dict:
+    """
+    Отменить резерв и вернуть монетки (повторная отмена ничего не делает)
+    
+    Returns:
+        {'success': bool, 'refunded': int, 'new_balance': dict}
+    """
+    pool = database.get_db_pool()
+    if not pool:
+        raise RuntimeError("Database pool not initialized")
+    
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(_RELEASE_SQL, reservation_id, note or "Возврат резерва")
+    
+    if not row:
+        log.warning(f"⚠️ Резерв #{reservation_id} уже закрыт, возврат не нужен")
+        return {'success': False, 'refunded': 0}
+    
+    invalidate_user_cache(row['user_id'])
+    refunded = row['sub'] + row['perm']
+    log.info(
+        f"↩️ Резерв #{reservation_id} отменён: user {row['user_id']} +{refunded} "
+        f"({row['sub']} подписочных + {row['perm']} постоянных)"
+    )
+    
+    return {
+        'success': True,
+        'refunded': refunded,
+        'new_balance': {
+            'subscription_coins': row['new_sub'],
+            'permanent_coins': row['new_perm'],
+            'total': row['new_sub'] + row['new_perm']
+        }
+    }
 
 async def add_subscription_coins(user_id: int, coins: int) -> Dict:
     """
@@ -154,6 +419,7 @@ async def add_subscription_coins(user_id: int, coins: int) -> Dict:
                 updated_at = NOW()
             WHERE user_id = $1
         """, user_id, coins)
+        invalidate_user_cache(user_id)
         
         # Получаем новый баланс
         balance = await get_user_dual_balance(user_id)
@@ -189,6 +455,7 @@ async def add_permanent_coins(user_id: int, coins: int) -> Dict:
                 updated_at = NOW()
             WHERE user_id = $1
         """, user_id, coins)
+        invalidate_user_cache(user_id)
         
         # Получаем новый баланс
         balance = await get_user_dual_balance(user_id)
@@ -232,6 +499,7 @@ async def reset_subscription_coins(user_id: int) -> Dict:
                     updated_at = NOW()
                 WHERE user_id = $1
             """, user_id)
+            invalidate_user_cache(user_id)
             
             log.info(f"🔥 Сгорело {old_sub} подписочных монет у user {user_id}")
             
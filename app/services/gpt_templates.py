@@ -1,12 +1,17 @@
 # app/services/gpt_templates.py
 """GPT инструкции и шаблоны из babka-bot-clean"""
 
+import os
 import json
+import asyncio
 import logging
 from typing import Optional
 
 log = logging.getLogger(__name__)
 
+# Сколько обработчик ждёт улучшения промпта, прежде чем взять исходный текст
+PROMPT_IMPROVE_TIMEOUT = float(os.getenv("PROMPT_IMPROVE_TIMEOUT", "15"))
+
 # Стили из babka-bot-clean
 STYLE_HINTS = {
     "Анимэ": {
@@ -39,9 +44,9 @@ def style_instructions(style_name: Optional[str]) -> str:
         f"Shot: {s['shot']}."
     )
 
-def improve_scene(user_text: str, mode: str = "normal") -> str:
+async def improve_scene(user_text: str, mode: str = "normal") -> str:
     """Улучшение сцены через GPT (из babka-bot-clean)"""
-    from app.services.ai_helper import get_openai_client
+    from app.services.ai_helper import chat_completion
     
     style = {
         "normal": "Сделай рабочую сцену.",
@@ -61,33 +66,36 @@ def improve_scene(user_text: str, mode: str = "normal") -> str:
     temp = {"normal": 0.65, "complex": 0.85, "simple": 0.55, "absurd": 0.9}[mode]
     
     try:
-        client = get_openai_client()
-        if not client:
-            return user_text
-            
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
+        result = await chat_completion(
+            [
                 {"role": "system", "content": sys},
                 {"role": "user", "content": user_text}
             ],
             temperature=temp,
             max_tokens=140,
         )
-        
-        result = response.choices[0].message.content.strip()
         return result if result else user_text
         
     except Exception as e:
         log.error(f"GPT improve_scene error: {e}")
         return user_text
 
-def improve_scene_with_phrase(scene_text: str, phrase: str, mode: str = "complex") -> str:
+async def improve_scene_with_timeout(user_text: str, mode: str = "normal",
+                                    timeout: Optional[float] = None) -> str:
+    """Улучшение сцены для обработчиков: по тайм-ауту возвращается исходный текст"""
+    timeout = PROMPT_IMPROVE_TIMEOUT if timeout is None else timeout
+    try:
+        return await asyncio.wait_for(improve_scene(user_text, mode), timeout=timeout)
+    except asyncio.TimeoutError:
+        log.warning(f"GPT improve_scene timeout ({timeout}s), using original text")
+        return user_text
+
+async def improve_scene_with_phrase(scene_text: str, phrase: str, mode: str = "complex") -> str:
     """Улучшает сцену, сохраняя фразу (из babka-bot-clean)"""
-    from app.services.ai_helper import get_openai_client
+    from app.services.ai_helper import chat_completion
     
     if not phrase:
-        return improve_scene(scene_text, mode)
+        return await improve_scene(scene_text, mode)
     
     # Извлекаем фразу из сцены, если она там есть
     import re
@@ -95,7 +103,7 @@ def improve_scene_with_phrase(scene_text: str, phrase: str, mode: str = "complex
     scene_without_phrase = re.sub(quote_pattern, '', scene_text).strip()
     
     # Улучшаем сцену без фразы
-    improved_scene = improve_scene(scene_without_phrase, mode)
+    improved_scene = await improve_scene(scene_without_phrase, mode)
     
     # Встраиваем фразу обратно
     embed_prompt = (
@@ -113,17 +121,13 @@ def improve_scene_with_phrase(scene_text: str, phrase: str, mode: str = "complex
     )
     
     try:
-        client = get_openai_client()
-        if not client:
-            return improved_scene
-            
-        resp = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": embed_prompt}],
+        result = await chat_completion(
+            [{"role": "user", "content": embed_prompt}],
             max_tokens=200,
             temperature=0.7,
         )
-        result = resp.choices[0].message.content.strip() if resp else ""
+        if result is None:
+            return improved_scene
         
         # Очищаем результат от лишних строк
         lines = result.split('\n')
@@ -146,13 +150,13 @@ def improve_scene_with_phrase(scene_text: str, phrase: str, mode: str = "complex
         log.error(f"GPT embed phrase error: {e}")
         return improved_scene
 
-def create_rich_json_template(scene: str, style: Optional[str], replica: Optional[str],
-                             mode: Optional[str], aspect_ratio: str, context: Optional[str]) -> str:
+async def create_rich_json_template(scene: str, style: Optional[str], replica: Optional[str],
+                                   mode: Optional[str], aspect_ratio: str, context: Optional[str]) -> str:
     """
     Создает промт-директиву для GPT, чтобы он вернул ГОТОВЫЙ JSON под Veo.
     Скопировано из babka-bot-clean
     """
-    from app.services.ai_helper import get_openai_client
+    from app.services.ai_helper import chat_completion
     
     style_text = style_instructions(style)
 
@@ -233,8 +237,13 @@ def create_rich_json_template(scene: str, style: Optional[str], replica: Optiona
         usr += f"context_for_continuity: {context}\n"
 
     try:
-        client = get_openai_client()
-        if not client:
+        result = await chat_completion(
+            [{"role": "system", "content": sys},
+             {"role": "user", "content": usr}],
+            temperature=0.55,
+            max_tokens=1300,
+        )
+        if result is None:
             # fallback JSON если GPT недоступен
             style_stub = style_text or ""
             return json.dumps({
@@ -255,14 +264,7 @@ def create_rich_json_template(scene: str, style: Optional[str], replica: Optiona
                 "restrictions": "No text or logos"
             }, ensure_ascii=False)
             
-        r = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "system", "content": sys},
-                      {"role": "user", "content": usr}],
-            temperature=0.55,
-            max_tokens=1300,
-        )
-        return (r.choices[0].message.content or "").strip()
+        return result
     except Exception as e:
         log.error("GPT JSON convert error: %s", e)
         # fallback максимально честный и простой
@@ -0,0 +1,193 @@
+# app/services/image_processing.py
+"""
+Обработка изображений примерочной (входные фото и результат) в пуле процессов
+
+Pillow держит GIL на фильтрах и кодировании, поэтому работа идёт
+в ProcessPoolExecutor на IMAGE_WORKERS процессов, а не в потоках.
+Результат кодируется в компактный формат (JPEG/WebP с заданным качеством)
+вместо несжатого PNG - Telegram всё равно пережимает фото в JPEG.
+
+Входные фото перед отправкой в модель уменьшаются до IMAGE_INPUT_MAX_SIDE
+по длинной стороне и перекодируются в JPEG (prepare_input).
+"""
+
+import os
+import io
+import time
+import base64
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Any, Optional, Union
+
+from PIL import Image, ImageEnhance, ImageOps
+
+log = logging.getLogger("image_processing")
+
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", str(min(2, os.cpu_count() or 1))))
+IMAGE_OUTPUT_FORMAT = os.getenv("IMAGE_OUTPUT_FORMAT", "JPEG").upper()
+IMAGE_OUTPUT_QUALITY = int(os.getenv("IMAGE_OUTPUT_QUALITY", "90"))
+# Полезное для модели разрешение входа (длинная сторона) и качество перекодирования
+IMAGE_INPUT_MAX_SIDE = int(os.getenv("IMAGE_INPUT_MAX_SIDE", "1536"))
+IMAGE_INPUT_QUALITY = int(os.getenv("IMAGE_INPUT_QUALITY", "92"))
+
+_EXTENSIONS = {"JPEG": "jpg", "WEBP": "webp", "PNG": "png"}
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+_stats = {
+    "processed": 0,
+    "failed": 0,
+    "bytes_in": 0,
+    "bytes_out": 0,
+    "seconds": 0.0,
+    "inputs": 0,
+    "input_bytes_in": 0,
+    "input_bytes_out": 0,
+}
+
+def _encode(image: Image.Image, fmt: str, quality: int) -> bytes:
+    """Кодирование в выходной формат"""
+    output = io.BytesIO()
+    if fmt == "JPEG":
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image.save(output, format="JPEG", quality=quality, optimize=True, progressive=True)
+    elif fmt == "WEBP":
+        image.save(output, format="WEBP", quality=quality, method=4)
+    else:
+        image.save(output, format="PNG", optimize=True)
+    return output.getvalue()
+
+def enhance_image(data: Union[bytes, str], fmt: str = IMAGE_OUTPUT_FORMAT,
+                  quality: int = IMAGE_OUTPUT_QUALITY) -> bytes:
+    """
+    Улучшает качество изображения без потери деталей: резкость и контраст
+
+    Выполняется в процессе пула. data - байты или base64 строка.
+    При ошибке возвращается исходное изображение.
+    """
+    image_bytes = base64.b64decode(data) if isinstance(data, str) else data
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+        image.load()
+
+        # Умеренное повышение резкости (не слишком агрессивно)
+        image = ImageEnhance.Sharpness(image).enhance(1.2)
+
+        # Легкое улучшение контраста
+        image = ImageEnhance.Contrast(image).enhance(1.1)
+
+        return _encode(image, fmt, quality)
+    except Exception as e:
+        log.warning("Failed to enhance image quality: %s", e)
+        return image_bytes  # Возвращаем оригинал если не удалось улучшить
+
+def shrink_image(image_bytes: bytes, max_side: int = IMAGE_INPUT_MAX_SIDE,
+                 quality: int = IMAGE_INPUT_QUALITY) -> bytes:
+    """
+    Уменьшить фото до max_side по длинной стороне и перекодировать в JPEG
+
+    Выполняется в процессе пула. Исходные байты возвращаются, если фото
+    уже меньше и перекодирование не уменьшает размер, или при ошибке.
+    """
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+        # Поворот по EXIF, иначе после перекодирования фото "ляжет на бок"
+        image = ImageOps.exif_transpose(image)
+        resized = max(image.size) > max_side
+        if resized:
+            image.thumbnail((max_side, max_side), Image.LANCZOS)
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=quality, optimize=True)
+        encoded = output.getvalue()
+        if not resized and len(encoded) >= len(image_bytes):
+            return image_bytes
+        return encoded
+    except Exception as e:
+        log.warning("Failed to shrink image: %s", e)
+        return image_bytes
+
+def output_filename(name: str, fmt: str = IMAGE_OUTPUT_FORMAT) -> str:
+    """Имя файла с расширением выходного формата"""
+    return f"{name}.{_EXTENSIONS.get(fmt, 'jpg')}"
+
+def get_pool() -> ProcessPoolExecutor:
+    """Пул процессов обработки изображений (создаётся лениво)"""
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=max(1, IMAGE_WORKERS))
+    return _pool
+
+async def start_pool():
+    """
+    Поднять процессы пула заранее (при старте, пока у процесса мало потоков),
+    чтобы первая примерка не ждала их запуска
+    """
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(get_pool(), time.sleep, 0)
+    log.info(f"✅ Пул обработки изображений: {IMAGE_WORKERS} процессов")
+
+def shutdown_pool():
+    """Остановить пул процессов"""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+async def enhance(data: Union[bytes, str]) -> bytes:
+    """
+    Улучшить и перекодировать изображение в пуле процессов
+
+    Args:
+        data: Байты изображения или base64 строка (декодируется в процессе пула)
+    """
+    loop = asyncio.get_running_loop()
+    started = time.monotonic()
+    try:
+        result = await loop.run_in_executor(get_pool(), enhance_image, data)
+        _stats["processed"] += 1
+    except BrokenProcessPool as e:
+        # Процесс пула упал - пересоздаём пул, отдаём изображение без обработки
+        log.error(f"❌ Пул обработки изображений сломан: {e}")
+        _stats["failed"] += 1
+        shutdown_pool()
+        result = base64.b64decode(data) if isinstance(data, str) else data
+    finally:
+        _stats["seconds"] += time.monotonic() - started
+
+    _stats["bytes_in"] += len(data) * 3 // 4 if isinstance(data, str) else len(data)
+    _stats["bytes_out"] += len(result)
+    return result
+
+async def prepare_input(image_bytes: bytes) -> bytes:
+    """Уменьшить и перекодировать входное фото в пуле процессов"""
+    loop = asyncio.get_running_loop()
+    started = time.monotonic()
+    try:
+        result = await loop.run_in_executor(get_pool(), shrink_image, image_bytes)
+    except BrokenProcessPool as e:
+        log.error(f"❌ Пул обработки изображений сломан: {e}")
+        shutdown_pool()
+        result = image_bytes
+    finally:
+        _stats["seconds"] += time.monotonic() - started
+
+    _stats["inputs"] += 1
+    _stats["input_bytes_in"] += len(image_bytes)
+    _stats["input_bytes_out"] += len(result)
+    return result
+
+def get_stats() -> Dict[str, Any]:
+    """Метрики стадии обработки изображений"""
+    return {
+        **_stats,
+        "seconds": round(_stats["seconds"], 3),
+        "workers": IMAGE_WORKERS,
+        "format": IMAGE_OUTPUT_FORMAT,
+        "quality": IMAGE_OUTPUT_QUALITY,
+        "input_max_side": IMAGE_INPUT_MAX_SIDE,
+    }
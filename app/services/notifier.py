@@ -0,0 +1,294 @@
+# app/services/notifier.py
+"""
+Отправка сообщений из фоновых задач (доставка генераций, вебхуки, уведомления)
+
+Все фоновые отправители используют один общий Bot из app.core.bot
+с его пулом соединений, а не создают Bot на каждую задачу.
+
+Исходящие сообщения проходят через очередь с лимитами Telegram:
+- общий token bucket (TELEGRAM_GLOBAL_RATE сообщений в секунду),
+- не чаще TELEGRAM_CHAT_RATE сообщений в секунду в один чат,
+- чаты обслуживаются по кругу, массовая рассылка не блокирует остальных,
+- приоритеты: ответы пользователю раньше доставок, доставки раньше рассылок,
+- TelegramRetryAfter и сетевые ошибки - повтор после паузы.
+"""
+
+import os
+import time
+import logging
+import asyncio
+from collections import deque, OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Set
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError
+
+log = logging.getLogger("notifier")
+
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_SEND_CONCURRENCY = int(os.getenv("TELEGRAM_SEND_CONCURRENCY", "8"))
+TELEGRAM_SEND_RETRIES = int(os.getenv("TELEGRAM_SEND_RETRIES", "3"))
+
+# Приоритеты (меньше - раньше)
+PRIORITY_INTERACTIVE = 0
+PRIORITY_DELIVERY = 1
+PRIORITY_BULK = 2
+PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_DELIVERY, PRIORITY_BULK)
+
+def get_bot() -> Bot:
+    """Общий Bot процесса (создаётся при первом обращении)"""
+    from app.core.bot import get_bot as get_bot_and_dispatcher
+    bot, _ = get_bot_and_dispatcher()
+    return bot
+
+@dataclass
+class _Job:
+    chat_id: int
+    call: Callable[[], Awaitable[Any]]
+    future: asyncio.Future
+    retries: int
+    attempts: int = 0
+    enqueued: float = field(default_factory=time.monotonic)
+
+class OutboundQueue:
+    """Очередь исходящих сообщений с глобальным и по-чатовым лимитом"""
+
+    def __init__(self, global_rate: float = TELEGRAM_GLOBAL_RATE,
+                 chat_rate: float = TELEGRAM_CHAT_RATE,
+                 concurrency: int = TELEGRAM_SEND_CONCURRENCY):
+        self.global_rate = max(0.1, global_rate)
+        self.chat_interval = 1.0 / max(0.01, chat_rate)
+        # Token bucket: ёмкость = секунда трафика
+        self._tokens = self.global_rate
+        self._refilled = time.monotonic()
+        # priority -> chat_id -> очередь сообщений чата (порядок ключей = круг обслуживания)
+        self._chats: Dict[int, "OrderedDict[int, Deque[_Job]]"] = {p: OrderedDict() for p in PRIORITIES}
+        self._chat_ready_at: Dict[int, float] = {}
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(max(1, concurrency))
+        self._task: Optional[asyncio.Task] = None
+        self._sending: Set[asyncio.Task] = set()
+
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.retry_after = 0
+        self._max_wait = 0.0
+
+    def start(self):
+        """Запустить диспетчер очереди (идемпотентно)"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def submit(self, chat_id: int, call: Callable[[], Awaitable[Any]],
+               priority: int = PRIORITY_DELIVERY, retries: int = TELEGRAM_SEND_RETRIES) -> asyncio.Future:
+        """
+        Поставить отправку в очередь
+
+        Args:
+            chat_id: Чат получателя
+            call: Фабрика корутины отправки (вызывается на каждую попытку)
+            priority: PRIORITY_INTERACTIVE / PRIORITY_DELIVERY / PRIORITY_BULK
+            retries: Сколько раз повторять при RetryAfter и сетевых ошибках
+
+        Returns:
+            Future с результатом отправки
+        """
+        job = _Job(chat_id=chat_id, call=call, future=asyncio.get_running_loop().create_future(),
+                   retries=retries)
+        self._push(priority, job)
+        self.start()
+        return job.future
+
+    def _push(self, priority: int, job: _Job, front: bool = False):
+        chats = self._chats[priority]
+        queue = chats.get(job.chat_id)
+        if queue is None:
+            queue = chats[job.chat_id] = deque()
+        if front:
+            queue.appendleft(job)
+        else:
+            queue.append(job)
+        self._wakeup.set()
+
+    def depth(self) -> int:
+        """Сообщений в очереди"""
+        return sum(len(q) for chats in self._chats.values() for q in chats.values())
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.global_rate, self._tokens + (now - self._refilled) * self.global_rate)
+        self._refilled = now
+
+    def _next_job(self):
+        """
+        Следующее сообщение: самый высокий приоритет, чат по кругу,
+        чат не упирается в свой лимит. Иначе - через сколько секунд освободится чат.
+        """
+        now = time.monotonic()
+        soonest = None
+        for priority in PRIORITIES:
+            chats = self._chats[priority]
+            for chat_id in list(chats.keys()):
+                ready_at = self._chat_ready_at.get(chat_id, 0.0)
+                if ready_at > now:
+                    soonest = ready_at if soonest is None else min(soonest, ready_at)
+                    continue
+                queue = chats.pop(chat_id)
+                job = queue.popleft()
+                if queue:
+                    # Чат уходит в конец круга
+                    chats[chat_id] = queue
+                return priority, job, None
+        return None, None, (soonest - now) if soonest is not None else None
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            self._refill()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.global_rate)
+                continue
+
+            priority, job, wait = self._next_job()
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._slots.acquire()
+            self._tokens -= 1
+            self._chat_ready_at[job.chat_id] = time.monotonic() + self.chat_interval
+            self._max_wait = max(self._max_wait, time.monotonic() - job.enqueued)
+            task = asyncio.create_task(self._send(priority, job))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send(self, priority: int, job: _Job):
+        try:
+            job.attempts += 1
+            result = await job.call()
+        except TelegramRetryAfter as e:
+            self.retry_after += 1
+            # Чат (а при массовой волне - весь поток) притормаживаем на указанное время
+            self._chat_ready_at[job.chat_id] = time.monotonic() + e.retry_after
+            self._tokens = min(self._tokens, 0)
+            self._retry_or_fail(priority, job, e)
+        except (TelegramNetworkError, TelegramServerError) as e:
+            self._chat_ready_at[job.chat_id] = time.monotonic() + min(30, 2 ** job.attempts)
+            self._retry_or_fail(priority, job, e)
+        except Exception as e:
+            self.failed += 1
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            self.sent += 1
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._slots.release()
+            self._wakeup.set()
+
+    def _retry_or_fail(self, priority: int, job: _Job, error: Exception):
+        if job.attempts <= job.retries:
+            self.retried += 1
+            log.warning(f"⚠️ Повтор отправки в чат {job.chat_id} ({job.attempts}/{job.retries}): {error}")
+            self._push(priority, job, front=True)
+        else:
+            self.failed += 1
+            if not job.future.done():
+                job.future.set_exception(error)
+
+    async def stop(self, timeout: float = 10):
+        """Дождаться отправки очереди (с тайм-аутом) и остановить диспетчер"""
+        deadline = time.monotonic() + timeout
+        while (self.depth() or self._sending) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self.depth():
+            log.warning(f"⚠️ Не отправлено сообщений до остановки: {self.depth()}")
+
+    def stats(self) -> Dict[str, Any]:
+        """Метрики очереди"""
+        return {
+            "depth": self.depth(),
+            "sending": len(self._sending),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "retry_after": self.retry_after,
+            "max_wait_seconds": round(self._max_wait, 3),
+            "global_rate": self.global_rate,
+        }
+
+_queue: Optional[OutboundQueue] = None
+
+def get_queue() -> OutboundQueue:
+    """Очередь исходящих сообщений процесса (создаётся лениво)"""
+    global _queue
+    if _queue is None:
+        _queue = OutboundQueue()
+    return _queue
+
+async def stop_queue():
+    """Остановить очередь, если она была создана"""
+    if _queue is not None:
+        await _queue.stop()
+
+async def send_message(chat_id: int, text: str, priority: int = PRIORITY_DELIVERY, **kwargs: Any):
+    """Отправить сообщение через очередь (ошибки пробрасываются вызывающему)"""
+    return await get_queue().submit(
+        chat_id, lambda: get_bot().send_message(chat_id, text, **kwargs), priority
+    )
+
+def _replayable(media: Any) -> bool:
+    """Можно ли отправить файл повторно (потоковый InputFile читается один раз)"""
+    from app.services.video_stream import StreamInputFile
+    return not isinstance(media, StreamInputFile)
+
+async def send_video(chat_id: int, video: Any, priority: int = PRIORITY_DELIVERY, **kwargs: Any):
+    """Отправить видео через очередь (ошибки пробрасываются вызывающему)"""
+    return await get_queue().submit(
+        chat_id, lambda: get_bot().send_video(chat_id, video, **kwargs), priority,
+        retries=TELEGRAM_SEND_RETRIES if _replayable(video) else 0
+    )
+
+async def send_photo(chat_id: int, photo: Any, priority: int = PRIORITY_DELIVERY, **kwargs: Any):
+    """Отправить фото через очередь (ошибки пробрасываются вызывающему)"""
+    return await get_queue().submit(
+        chat_id, lambda: get_bot().send_photo(chat_id, photo, **kwargs), priority,
+        retries=TELEGRAM_SEND_RETRIES if _replayable(photo) else 0
+    )
+
+async def notify(chat_id: int, text: str, priority: int = PRIORITY_DELIVERY, **kwargs: Any) -> bool:
+    """Отправить уведомление; ошибку только логируем"""
+    try:
+        await send_message(chat_id, text, priority=priority, **kwargs)
+        return True
+    except Exception as e:
+        log.error(f"❌ Ошибка отправки уведомления user {chat_id}: {e}")
+        return False
+
+def notify_later(chat_id: int, text: str, priority: int = PRIORITY_BULK, **kwargs: Any) -> asyncio.Future:
+    """
+    Поставить уведомление в очередь без ожидания (массовые рассылки)
+
+    Ошибки доставки логируются, вызывающий не блокируется.
+    """
+    future = get_queue().submit(
+        chat_id, lambda: get_bot().send_message(chat_id, text, **kwargs), priority
+    )
+
+    def _log_result(f: asyncio.Future):
+        if not f.cancelled() and f.exception() is not None:
+            log.error(f"❌ Ошибка отправки уведомления user {chat_id}: {f.exception()}")
+
+    future.add_done_callback(_log_result)
+    return future
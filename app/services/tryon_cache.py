@@ -0,0 +1,151 @@
+# app/services/tryon_cache.py
+"""
+Кэш результатов примерочной по содержимому входных фото
+
+Ключ - sha256 от байт фото человека и одежды после prepare_input (то, что
+уходит в модель), параметров модели и настроек обработки изображений.
+Значение - file_id уже отправленного в Telegram результата, поэтому повтор
+(двойное нажатие, swap туда-обратно, повтор после сетевой ошибки) отдаётся
+сразу, без нового запроса к Vertex. Кэш экономит только запрос к модели:
+проверка блокировки и списание монеток выполняются и для повторов.
+
+Уровни: LRU в памяти (TRYON_CACHE_SIZE / TRYON_CACHE_TTL) и, если задан
+TRYON_CACHE_DIR, файлы на диске - переживают рестарт процесса.
+Одинаковые запросы, пришедшие одновременно, выполняются один раз (locked).
+"""
+
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, Any
+
+from app.db.cache import TTLCache
+
+log = logging.getLogger("tryon_cache")
+
+TRYON_CACHE_SIZE = int(os.getenv("TRYON_CACHE_SIZE", "10000"))
+TRYON_CACHE_TTL = int(os.getenv("TRYON_CACHE_TTL", str(7 * 24 * 3600)))
+TRYON_CACHE_DIR = os.getenv("TRYON_CACHE_DIR", "").strip()
+
+_memory = TTLCache(maxsize=TRYON_CACHE_SIZE, ttl=TRYON_CACHE_TTL)
+# key -> [lock, число ожидающих]
+_locks: Dict[str, list] = {}
+
+_stats = {
+    "disk_hits": 0,
+    "stores": 0,
+    "disk_errors": 0,
+}
+
+def result_key(person_bytes: bytes, garment_bytes: bytes, sample_count: int = 1) -> str:
+    """Ключ кэша: фото после prepare_input + параметры модели + настройки обработки"""
+    from app.services import image_processing
+    from app.services.clients import tryon_client
+
+    settings = {
+        "model": tryon_client.MODEL_ID,
+        "parameters": {"sampleCount": int(sample_count), **tryon_client.PARAMETERS},
+        "input_max_side": image_processing.IMAGE_INPUT_MAX_SIDE,
+        "input_quality": image_processing.IMAGE_INPUT_QUALITY,
+        "output_format": image_processing.IMAGE_OUTPUT_FORMAT,
+        "output_quality": image_processing.IMAGE_OUTPUT_QUALITY,
+    }
+    digest = hashlib.sha256()
+    digest.update(hashlib.sha256(person_bytes).digest())
+    digest.update(hashlib.sha256(garment_bytes).digest())
+    digest.update(json.dumps(settings, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+def _disk_path(key: str) -> str:
+    return os.path.join(TRYON_CACHE_DIR, key[:2], key)
+
+def _disk_read(key: str) -> Optional[str]:
+    path = _disk_path(key)
+    try:
+        if time.time() - os.path.getmtime(path) > TRYON_CACHE_TTL:
+            os.remove(path)
+            return None
+        with open(path, encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def _disk_write(key: str, file_id: str):
+    path = _disk_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(file_id)
+    os.replace(tmp_path, path)
+
+async def get(key: str) -> Optional[str]:
+    """file_id результата или None"""
+    file_id = _memory.get(key)
+    if file_id or not TRYON_CACHE_DIR:
+        return file_id
+    try:
+        file_id = await asyncio.to_thread(_disk_read, key)
+    except Exception as e:
+        _stats["disk_errors"] += 1
+        log.warning(f"⚠️ Ошибка чтения кэша примерочной {key}: {e}")
+        return None
+    if file_id:
+        _stats["disk_hits"] += 1
+        _memory.set(key, file_id)
+    return file_id
+
+async def put(key: str, file_id: str):
+    """Запомнить file_id результата"""
+    _memory.set(key, file_id)
+    _stats["stores"] += 1
+    if not TRYON_CACHE_DIR:
+        return
+    try:
+        await asyncio.to_thread(_disk_write, key, file_id)
+    except Exception as e:
+        _stats["disk_errors"] += 1
+        log.warning(f"⚠️ Ошибка записи кэша примерочной {key}: {e}")
+
+def _disk_remove(key: str):
+    try:
+        os.remove(_disk_path(key))
+    except FileNotFoundError:
+        pass
+
+async def forget(key: str):
+    """Удалить запись (file_id больше не принимается Telegram)"""
+    _memory.invalidate(key)
+    if TRYON_CACHE_DIR:
+        try:
+            await asyncio.to_thread(_disk_remove, key)
+        except Exception as e:
+            _stats["disk_errors"] += 1
+            log.warning(f"⚠️ Ошибка удаления из кэша примерочной {key}: {e}")
+
+@asynccontextmanager
+async def locked(key: str):
+    """Одновременные запросы с одним ключом выполняются по очереди"""
+    entry = _locks.get(key)
+    if entry is None:
+        entry = _locks[key] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            _locks.pop(key, None)
+
+def get_stats() -> Dict[str, Any]:
+    """Метрики кэша результатов"""
+    return {
+        **_memory.stats(),
+        **_stats,
+        "disk": bool(TRYON_CACHE_DIR),
+        "in_progress": len(_locks),
+    }
@@ -0,0 +1,283 @@
+# app/services/veo_scheduler.py
+"""
+Общий планировщик long-running операций Veo 3
+
+Вместо отдельной корутины с собственным циклом опроса на каждую задачу
+все операции регистрируются здесь и опрашиваются одним циклом:
+- интервал опроса каждой операции адаптивный (по прогрессу или с backoff),
+- общее число запросов fetchPredictOperation ограничено VEO_POLL_QPS,
+- запросы идут через общую HTTP сессию veo_client,
+- завершённые операции передаются на стадию доставки с ограниченной
+  параллельностью (скачивание, ffmpeg, отправка в Telegram),
+- раз в VEO_HEARTBEAT секунд владение задачами (опрос и доставка)
+  продлевается в generations; задачу, которую забрал другой процесс,
+  перестаём опрашивать.
+"""
+
+import os
+import time
+import logging
+import asyncio
+from dataclasses import dataclass, field
+from typing import Dict, Any, Optional, Callable, Awaitable, Set
+
+from app.services.clients import veo_client
+
+log = logging.getLogger("veo_scheduler")
+
+VEO_POLL_QPS = float(os.getenv("VEO_POLL_QPS", "5"))
+VEO_POLL_FAILURES = int(os.getenv("VEO_POLL_FAILURES", "5"))
+VEO_DELIVERY_CONCURRENCY = int(os.getenv("VEO_DELIVERY_CONCURRENCY", "4"))
+
+OnDone = Callable[[Dict[str, Any]], Awaitable[None]]
+OnError = Callable[[Exception], Awaitable[None]]
+
+@dataclass
+class Operation:
+    """Зарегистрированная операция Veo"""
+    name: str
+    on_done: OnDone
+    on_error: OnError
+    max_wait: float = veo_client.VEO_MAX_WAIT
+    started: float = field(default_factory=time.monotonic)
+    next_poll: float = 0.0
+    delay: float = veo_client.VEO_POLL_MIN
+    polls: int = 0
+    failures: int = 0
+    progress: Optional[float] = None
+    task_id: Optional[str] = None
+    polling: bool = False
+
+class VeoScheduler:
+    """Один цикл опроса на все операции Veo процесса"""
+
+    def __init__(self, max_qps: float = VEO_POLL_QPS,
+                 delivery_concurrency: int = VEO_DELIVERY_CONCURRENCY):
+        self.max_qps = max(0.1, max_qps)
+        self._operations: Dict[str, Operation] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._delivery = asyncio.Semaphore(max(1, delivery_concurrency))
+        self._delivery_tasks: Set[asyncio.Task] = set()
+        self._delivering: Set[str] = set()
+        self._poll_tasks: Set[asyncio.Task] = set()
+        # Раньше этого момента новую пачку опросов не запускаем (лимит max_qps)
+        self._next_batch = 0.0
+        self._heartbeat_task: Optional[asyncio.Task] = None
+
+        self.registered = 0
+        self.polls = 0
+        self.poll_errors = 0
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.lost = 0
+
+    def start(self):
+        """Запустить цикл опроса (идемпотентно)"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+            log.info(f"✅ Планировщик Veo запущен (до {self.max_qps} опросов/сек)")
+        if self._heartbeat_task is None or self._heartbeat_task.done():
+            self._heartbeat_task = asyncio.create_task(self._heartbeat())
+
+    def register(self, op_name: str, on_done: OnDone, on_error: OnError,
+                 max_wait: Optional[float] = None, elapsed: float = 0.0,
+                 task_id: Optional[str] = None):
+        """
+        Поставить операцию на опрос
+
+        Args:
+            op_name: Имя long-running операции
+            on_done: Корутина доставки, получает ответ завершённой операции
+            on_error: Корутина обработки ошибки (таймаут, ошибка опроса)
+            max_wait: Максимальное время ожидания операции
+            elapsed: Сколько операция уже выполняется (при возобновлении)
+            task_id: Задача в generations, владение которой продлевает heartbeat
+        """
+        now = time.monotonic()
+        self._operations[op_name] = Operation(
+            name=op_name,
+            on_done=on_done,
+            on_error=on_error,
+            max_wait=max_wait or veo_client.VEO_MAX_WAIT,
+            started=now - elapsed,
+            next_poll=now + veo_client.VEO_POLL_MIN,
+            task_id=task_id
+        )
+        self.registered += 1
+        self.start()
+        self._wakeup.set()
+
+    def active(self) -> int:
+        """Количество операций на опросе"""
+        return len(self._operations)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            # Опросы идут отдельными задачами: медленный запрос держит только свою операцию
+            idle = [op for op in self._operations.values() if not op.polling]
+            due = sorted((op for op in idle if op.next_poll <= now), key=lambda op: op.next_poll)
+
+            # Не больше max_qps запросов в секунду: пачка и пауза после неё
+            batch = []
+            if due and now >= self._next_batch:
+                batch = due[:max(1, int(self.max_qps))]
+                for op in batch:
+                    self._start_poll(op)
+                self._next_batch = now + len(batch) / self.max_qps
+
+            if len(due) > len(batch):
+                sleep_for = max(0.0, self._next_batch - now)
+            elif len(idle) > len(batch):
+                next_poll = min(op.next_poll for op in idle if not op.polling)
+                sleep_for = max(self._next_batch, next_poll) - now
+            else:
+                sleep_for = None  # разбудит завершение опроса или новая операция
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=sleep_for)
+            except asyncio.TimeoutError:
+                pass
+
+    def _start_poll(self, op: Operation):
+        op.polling = True
+        task = asyncio.create_task(self._poll_guarded(op))
+        self._poll_tasks.add(task)
+        task.add_done_callback(self._poll_tasks.discard)
+
+    async def _poll_guarded(self, op: Operation):
+        try:
+            await self._poll(op)
+        except Exception as e:
+            log.error(f"❌ Ошибка опроса операции {op.name}: {e}", exc_info=True)
+            op.next_poll = time.monotonic() + op.delay
+        finally:
+            op.polling = False
+            self._wakeup.set()
+
+    async def _poll(self, op: Operation):
+        try:
+            data = await veo_client.fetch_operation(op.name, attempts=1)
+        except Exception as e:
+            self.poll_errors += 1
+            op.failures += 1
+            if op.failures >= VEO_POLL_FAILURES:
+                self._finish(op)
+                self.failed += 1
+                log.error(f"❌ Операция {op.name}: {op.failures} ошибок опроса подряд")
+                self._handoff(op.on_error(e), op.task_id)
+            else:
+                op.next_poll = time.monotonic() + op.delay
+            return
+
+        self.polls += 1
+        op.polls += 1
+        op.failures = 0
+
+        if data.get("done"):
+            self._finish(op)
+            self.completed += 1
+            log.info(f"✅ Операция {op.name} завершена за {time.monotonic() - op.started:.0f}с ({op.polls} опросов)")
+            self._handoff(op.on_done(data), op.task_id)
+            return
+
+        if time.monotonic() - op.started > op.max_wait:
+            self._finish(op)
+            self.timed_out += 1
+            self._handoff(op.on_error(
+                TimeoutError(f"Veo operation {op.name} не завершилась за {op.max_wait:.0f} секунд")
+            ), op.task_id)
+            return
+
+        op.progress = veo_client._operation_progress(data)
+        op.delay = veo_client._next_poll_delay(op.delay, op.started, op.progress)
+        op.next_poll = time.monotonic() + op.delay
+
+    def _finish(self, op: Operation):
+        self._operations.pop(op.name, None)
+
+    def _handoff(self, coro: Awaitable[None], task_id: Optional[str] = None):
+        """Стадия доставки: ограниченная параллельность, ошибки не роняют цикл"""
+        async def run():
+            if task_id:
+                self._delivering.add(task_id)
+            try:
+                async with self._delivery:
+                    await coro
+            except Exception as e:
+                log.error(f"❌ Ошибка доставки результата Veo: {e}", exc_info=True)
+            finally:
+                if task_id:
+                    self._delivering.discard(task_id)
+
+        task = asyncio.create_task(run())
+        self._delivery_tasks.add(task)
+        task.add_done_callback(self._delivery_tasks.discard)
+
+    async def _heartbeat(self):
+        """Продлевать владение задачами; операции, забранные другим процессом, снимать с опроса"""
+        from app.db import generations
+
+        while True:
+            await asyncio.sleep(veo_client.VEO_HEARTBEAT)
+            polling = {op.task_id: op for op in self._operations.values() if op.task_id}
+            task_ids = list(polling) + list(self._delivering)
+            owned = await generations.heartbeat_generations(task_ids)
+            if owned is None:
+                continue  # ошибка БД - ничего не снимаем, повторим позже
+            for task_id, op in polling.items():
+                if task_id not in owned and self._operations.get(op.name) is op:
+                    self._finish(op)
+                    self.lost += 1
+                    log.warning(f"⚠️ Задача {task_id} больше не принадлежит процессу, опрос {op.name} остановлен")
+
+    async def stop(self, timeout: float = 20):
+        """Остановить опрос и дождаться текущих доставок"""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for task in list(self._poll_tasks):
+            task.cancel()
+        await asyncio.gather(*self._poll_tasks, return_exceptions=True)
+        if self._delivery_tasks:
+            await asyncio.wait(set(self._delivery_tasks), timeout=timeout)
+        # Heartbeat до конца доставок, иначе другая реплика заберёт их задачи
+        if self._heartbeat_task:
+            self._heartbeat_task.cancel()
+            await asyncio.gather(self._heartbeat_task, return_exceptions=True)
+            self._heartbeat_task = None
+        log.info(f"✅ Планировщик Veo остановлен ({self.active()} операций не дождались)")
+
+    def stats(self) -> Dict[str, Any]:
+        """Метрики планировщика"""
+        return {
+            "active": self.active(),
+            "polling": len(self._poll_tasks),
+            "delivering": len(self._delivery_tasks),
+            "registered": self.registered,
+            "polls": self.polls,
+            "poll_errors": self.poll_errors,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timed_out": self.timed_out,
+            "lost": self.lost,
+            "max_qps": self.max_qps,
+        }
+
+_scheduler: Optional[VeoScheduler] = None
+
+def get_scheduler() -> VeoScheduler:
+    """Планировщик процесса (создаётся лениво)"""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = VeoScheduler()
+    return _scheduler
+
+async def stop_scheduler():
+    """Остановить планировщик, если он был создан"""
+    if _scheduler is not None:
+        await _scheduler.stop()
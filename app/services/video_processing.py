@@ -0,0 +1,179 @@
+# app/services/video_processing.py
+"""
+Подготовка видео к отправке в Telegram (ffprobe / ffmpeg)
+
+Процессы запускаются асинхронно через asyncio.create_subprocess_exec,
+одновременно работает не больше FFMPEG_CONCURRENCY процессов (по числу доступных ядер).
+Если кодеки уже подходят Telegram (H.264 + AAC), делается только remux
+с +faststart и метаданными aspect - без перекодирования. Полное
+перекодирование libx264 остаётся запасным вариантом.
+"""
+
+import os
+import json
+import time
+import asyncio
+import logging
+from typing import Dict, Any, Optional
+
+log = logging.getLogger("video_processing")
+
+def _available_cpus() -> int:
+    """Ядра, доступные процессу (учитывает affinity и cpuset контейнера)"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        return os.cpu_count() or 2
+
+FFMPEG_CONCURRENCY = int(os.getenv("FFMPEG_CONCURRENCY", str(_available_cpus())))
+FFMPEG_TIMEOUT = int(os.getenv("FFMPEG_TIMEOUT", "300"))
+
+# Что Telegram проигрывает без перекодирования
+COPY_VIDEO_CODECS = {"h264"}
+COPY_AUDIO_CODECS = {"aac"}
+COPY_PIX_FMTS = {"yuv420p", "yuvj420p"}
+
+_semaphore: Optional[asyncio.Semaphore] = None
+
+_stats = {
+    "remuxed": 0,
+    "reencoded": 0,
+    "failed": 0,
+    "seconds": 0.0,
+}
+
+def _get_semaphore() -> asyncio.Semaphore:
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(max(1, FFMPEG_CONCURRENCY))
+    return _semaphore
+
+async def _run(*args: str, timeout: int = FFMPEG_TIMEOUT) -> bytes:
+    """Запустить процесс, вернуть stdout; ошибка при ненулевом коде"""
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise RuntimeError(f"{args[0]} не завершился за {timeout} секунд")
+
+    if process.returncode != 0:
+        raise RuntimeError(f"{args[0]} exit {process.returncode}: {stderr.decode(errors='ignore')[-500:]}")
+    return stdout
+
+async def probe(path: str) -> Dict[str, Any]:
+    """
+    Параметры видео через ffprobe
+
+    Returns:
+        {"video_codec", "pix_fmt", "audio_codec", "width", "height", "duration"}
+    """
+    out = await _run(
+        "ffprobe", "-v", "error",
+        "-print_format", "json",
+        "-show_streams", "-show_format",
+        path,
+        timeout=60
+    )
+    data = json.loads(out or b"{}")
+    streams = data.get("streams") or []
+    video = next((s for s in streams if s.get("codec_type") == "video"), {})
+    audio = next((s for s in streams if s.get("codec_type") == "audio"), None)
+
+    try:
+        duration = int(float((data.get("format") or {}).get("duration") or 0))
+    except (TypeError, ValueError):
+        duration = 0
+
+    return {
+        "video_codec": video.get("codec_name"),
+        "pix_fmt": video.get("pix_fmt"),
+        "audio_codec": audio.get("codec_name") if audio else None,
+        "width": video.get("width"),
+        "height": video.get("height"),
+        "duration": duration,
+    }
+
+def _can_stream_copy(info: Dict[str, Any]) -> bool:
+    """Кодеки уже подходят Telegram - достаточно remux"""
+    if info.get("video_codec") not in COPY_VIDEO_CODECS:
+        return False
+    if info.get("pix_fmt") and info["pix_fmt"] not in COPY_PIX_FMTS:
+        return False
+    if info.get("audio_codec") and info["audio_codec"] not in COPY_AUDIO_CODECS:
+        return False
+    return True
+
+def _remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+async def prepare_for_telegram(input_path: str, aspect: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Подготовить mp4 к отправке: faststart, корректный aspect, совместимые кодеки
+
+    Args:
+        input_path: Исходный файл
+        aspect: Соотношение сторон (например "9:16"); по умолчанию из размеров кадра
+
+    Returns:
+        {"file_path", "width", "height", "duration", "remuxed"}; при ошибке
+        ffmpeg возвращается исходный файл
+    """
+    fixed_path = input_path.replace(".mp4", "_fixed.mp4")
+    result = {"file_path": input_path, "width": None, "height": None, "duration": None, "remuxed": False}
+    started = time.monotonic()
+
+    async with _get_semaphore():
+        try:
+            info = await probe(input_path)
+            result.update(width=info["width"], height=info["height"], duration=info["duration"])
+            if not aspect and info["width"] and info["height"]:
+                aspect = f"{info['width']}:{info['height']}"
+
+            aspect_args = ["-aspect", aspect] if aspect else []
+            if _can_stream_copy(info):
+                await _run(
+                    "ffmpeg", "-y", "-v", "error", "-i", input_path,
+                    "-c", "copy", *aspect_args,
+                    "-movflags", "+faststart",
+                    fixed_path
+                )
+                _stats["remuxed"] += 1
+                result["remuxed"] = True
+            else:
+                log.info(f"🎞️ Перекодирование {input_path}: {info['video_codec']}/{info['audio_codec']}")
+                await _run(
+                    "ffmpeg", "-y", "-v", "error", "-i", input_path,
+                    "-c:v", "libx264", "-preset", "fast", "-crf", "18",
+                    "-c:a", "aac", "-b:a", "128k",
+                    *aspect_args,
+                    "-movflags", "+faststart",
+                    fixed_path
+                )
+                _stats["reencoded"] += 1
+            result["file_path"] = fixed_path
+        except Exception as e:
+            _stats["failed"] += 1
+            log.warning(f"FFmpeg fix failed: {e}")
+            # Недописанный результат ffmpeg не нужен - отдаём исходный файл
+            _remove_quietly(fixed_path)
+        finally:
+            _stats["seconds"] += time.monotonic() - started
+
+    return result
+
+def get_stats() -> Dict[str, Any]:
+    """Метрики стадии обработки видео"""
+    return {
+        **_stats,
+        "seconds": round(_stats["seconds"], 3),
+        "concurrency": FFMPEG_CONCURRENCY,
+    }
@@ -0,0 +1,183 @@
+# app/services/video_stream.py
+"""
+Потоковая доставка видео в Telegram без временных файлов
+
+Источник (GCS или base64 из ответа операции) читается кусками и сразу
+уходит в multipart загрузку Telegram. Буферизуется только начало файла,
+чтобы проверить порядок MP4 боксов и достать размеры кадра:
+- moov перед mdat (faststart) - байты идут в Telegram как есть;
+- mdat перед moov - запасной путь: временный файл + ffmpeg remux
+  (video_processing.prepare_for_telegram), файл удаляется после отправки.
+"""
+
+import os
+import base64
+import asyncio
+import struct
+import logging
+import tempfile
+from typing import AsyncIterator, AsyncGenerator, Optional, Dict, Any, List, Tuple
+
+from aiogram.types import InputFile, FSInputFile
+
+from app.services.video_processing import prepare_for_telegram
+
+log = logging.getLogger("video_stream")
+
+STREAM_CHUNK = 1024 * 1024
+# Сколько байт начала файла держать в памяти в поисках moov
+MAX_HEAD_BYTES = int(os.getenv("VIDEO_STREAM_MAX_HEAD", str(16 * 1024 * 1024)))
+
+_stats = {
+    "streamed": 0,
+    "spooled": 0,
+    "bytes_streamed": 0,
+}
+
+class StreamInputFile(InputFile):
+    """InputFile, отдающий байты из асинхронного итератора (читается один раз)"""
+
+    def __init__(self, chunks: AsyncIterator[bytes], filename: str = "video.mp4"):
+        super().__init__(filename=filename)
+        self._chunks = chunks
+
+    async def read(self, bot) -> AsyncGenerator[bytes, None]:
+        async for chunk in self._chunks:
+            _stats["bytes_streamed"] += len(chunk)
+            yield chunk
+
+async def b64_chunks(data: str, chunk_size: int = STREAM_CHUNK) -> AsyncGenerator[bytes, None]:
+    """Декодировать base64 кусками (без полной копии декодированных байт)"""
+    step = (chunk_size // 3) * 4
+    for offset in range(0, len(data), step):
+        yield base64.b64decode(data[offset:offset + step])
+
+def _iter_boxes(buf: bytes, start: int = 0, end: Optional[int] = None):
+    """Боксы MP4 внутри buf[start:end]: (тип, начало данных, конец бокса)"""
+    end = len(buf) if end is None else end
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack(">I4s", buf[pos:pos + 8])
+        header = 8
+        if size == 1:
+            if pos + 16 > end:
+                return
+            size = struct.unpack(">Q", buf[pos + 8:pos + 16])[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header:
+            return
+        yield box_type, pos + header, pos + size
+        pos += size
+
+def _scan_head(head: bytes) -> Tuple[Optional[bool], Optional[Dict[str, int]]]:
+    """
+    Порядок верхнеуровневых боксов в начале файла
+
+    Returns:
+        (faststart, размеры): faststart True - moov целиком перед mdat,
+        False - mdat раньше moov, None - нужно больше байт
+    """
+    for box_type, body, box_end in _iter_boxes(head):
+        if box_type == b"mdat":
+            return False, None
+        if box_type == b"moov":
+            if box_end > len(head):
+                return None, None
+            return True, _video_size(head, body, box_end)
+    return None, None
+
+def _video_size(buf: bytes, start: int, end: int) -> Optional[Dict[str, int]]:
+    """Ширина и высота видеодорожки из tkhd внутри moov"""
+    for box_type, body, box_end in _iter_boxes(buf, start, end):
+        if box_type != b"trak":
+            continue
+        for inner_type, inner_body, inner_end in _iter_boxes(buf, body, box_end):
+            if inner_type != b"tkhd":
+                continue
+            # width/height - последние 8 байт tkhd, fixed point 16.16
+            if inner_end - inner_body < 8:
+                continue
+            width, height = struct.unpack(">II", buf[inner_end - 8:inner_end])
+            if width and height:
+                return {"width": width >> 16, "height": height >> 16}
+    return None
+
+async def _prepend(head: bytes, rest: AsyncIterator[bytes]) -> AsyncGenerator[bytes, None]:
+    if head:
+        yield head
+    async for chunk in rest:
+        yield chunk
+
+async def open_video(chunks: AsyncIterator[bytes], filename: str = "video.mp4") -> Dict[str, Any]:
+    """
+    Подготовить видео к отправке из потока байт
+
+    Returns:
+        {"file": InputFile, "width", "height", "streamed": bool, "temp_paths": [...]}
+        Временные файлы (только в запасном пути) удаляет cleanup()
+    """
+    iterator = chunks.__aiter__()
+    head = b""
+    faststart, size = None, None
+
+    while faststart is None and len(head) < MAX_HEAD_BYTES:
+        try:
+            chunk = await iterator.__anext__()
+        except StopAsyncIteration:
+            break
+        head += chunk
+        faststart, size = _scan_head(head)
+
+    if faststart:
+        _stats["streamed"] += 1
+        return {
+            "file": StreamInputFile(_prepend(head, iterator), filename=filename),
+            "width": (size or {}).get("width"),
+            "height": (size or {}).get("height"),
+            "streamed": True,
+            "temp_paths": [],
+        }
+
+    # Запасной путь: moov в конце файла, без remux Telegram не покажет превью
+    _stats["spooled"] += 1
+    fd, local_path = tempfile.mkstemp(suffix=".mp4", prefix="veo_")
+    temp_paths: List[str] = [local_path]
+    try:
+        # Запись на диск - в потоке, чтобы не блокировать event loop
+        with os.fdopen(fd, "wb") as f:
+            await asyncio.to_thread(f.write, head)
+            del head
+            async for chunk in iterator:
+                await asyncio.to_thread(f.write, chunk)
+
+        prepared = await prepare_for_telegram(local_path)
+        if prepared["file_path"] != local_path:
+            temp_paths.append(prepared["file_path"])
+    except BaseException:
+        # Скачивание или remux оборвались - вызывающий не получит temp_paths
+        cleanup({"temp_paths": temp_paths})
+        raise
+
+    return {
+        "file": FSInputFile(prepared["file_path"], filename=filename),
+        "width": prepared.get("width"),
+        "height": prepared.get("height"),
+        "streamed": False,
+        "temp_paths": temp_paths,
+    }
+
+def cleanup(prepared: Optional[Dict[str, Any]]):
+    """Удалить временные файлы запасного пути"""
+    for path in (prepared or {}).get("temp_paths", []):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log.warning(f"Failed to remove temp file {path}: {e}")
+
+def get_stats() -> Dict[str, Any]:
+    """Метрики доставки видео"""
+    return dict(_stats)
@@ -8,8 +8,9 @@ from app.db import users
 from app.ui import t
 from app.ui.keyboards import build_video_result_menu
 from app.config.pricing import get_feature_cost
-from app.services.clients.sora_client import extract_user_from_metadata
-from app.core.bot import bot
+from app.services import billing
+from app.services.clients.sora_client import extract_user_from_metadata, extract_reservation_from_metadata
+from app.services import notifier
 
 log = logging.getLogger("kudoaibot")
 
@@ -24,10 +25,14 @@ async def sora2_callback(request):
         status = data.get("status")
         metadata = data.get("metadata", {})
         
-        # Извлекаем user_id
+        # Извлекаем user_id и резерв монеток
         user_id = extract_user_from_metadata(metadata)
+        reservation_id = extract_reservation_from_metadata(metadata)
         
         if status == "completed" and user_id:
+            if reservation_id:
+                await billing.commit(reservation_id)
+            
             # Получаем URL видео
             video_data = data.get("output", {})
             video_url = video_data.get("url")
@@ -39,7 +44,7 @@ async def sora2_callback(request):
                 
                 # Отправляем видео пользователю
                 try:
-                    await bot.send_video(
+                    await notifier.send_video(
                         user_id,
                         video=video_url,
                         caption=t("video.success", cost=get_feature_cost("video_8s_audio")),
@@ -53,7 +58,7 @@ async def sora2_callback(request):
                     
                     # Fallback - отправляем ссылку
                     try:
-                        await bot.send_message(
+                        await notifier.send_message(
                             user_id,
                             f"✨ <b>Видео готово!</b>\n\n"
                             f"📹 <a href='{video_url}'>Смотреть видео</a>\n\n"
@@ -74,20 +79,23 @@ async def sora2_callback(request):
             
             # Возвращаем монетки на баланс
             try:
-                # Возвращаем стоимость видео используя dual_balance
-                cost = get_feature_cost("video_8s_audio")
-                from app.services.dual_balance import add_permanent_coins
-                
-                # Возвращаем как постоянные монетки (не сгорают)
-                refund_result = await add_permanent_coins(user_id, cost)
+                if reservation_id:
+                    # Возвращаем зарезервированные монетки в те же кошельки
+                    refund_result = await billing.release(reservation_id, f"SORA 2: {error_message}"[:200])
+                    cost = refund_result['refunded']
+                else:
+                    # Старые задачи без резерва: возвращаем как постоянные монетки
+                    cost = get_feature_cost("video_8s_audio")
+                    from app.services.dual_balance import add_permanent_coins
+                    refund_result = await add_permanent_coins(user_id, cost)
                 
                 if refund_result['success']:
                     # Уведомляем пользователя
-                    await bot.send_message(
+                    await notifier.send_message(
                         user_id,
                         f"❌ <b>Ошибка генерации видео SORA 2</b>\n\n"
                         f"Причина: {error_message}\n\n"
-                        f"💰 Монетки возвращены на баланс (+{cost} постоянных монеток)",
+                        f"💰 Монетки возвращены на баланс (+{cost} монеток)",
                         parse_mode="HTML"
                     )
                     log.info(f"✅ Refunded {cost} permanent coins to user {user_id}")
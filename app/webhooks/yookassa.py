@@ -6,7 +6,7 @@ from aiohttp import web
 
 from app.services import billing
 from app.config.pricing import get_topup_pack
-from app.core.bot import bot
+from app.services import notifier
 
 log = logging.getLogger("kudoaibot")
 
@@ -36,9 +36,10 @@ async def yookassa_webhook(request):
                 
                 if result['success']:
                     try:
-                        await bot.send_message(
+                        await notifier.send_message(
                             user_id,
-                            result['message']
+                            result['message'],
+                            priority=notifier.PRIORITY_INTERACTIVE
                         )
                     except Exception as e:
                         log.error(f"Ошибка отправки уведомления: {e}")
@@ -58,9 +59,10 @@ async def yookassa_webhook(request):
                     
                     if result['success']:
                         try:
-                            await bot.send_message(
+                            await notifier.send_message(
                                 user_id,
-                                result['message']
+                                result['message'],
+                                priority=notifier.PRIORITY_INTERACTIVE
                             )
                         except Exception as e:
                             log.error(f"Ошибка отправки уведомления: {e}")
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк постобработки результата примерочной
+
+Сравнивает прежний путь (резкость + контраст, PNG compress_level=0 в потоках)
+с новым (JPEG/WebP в пуле процессов): время на изображение, пропускную
+способность при параллельной обработке и байты на отправку в Telegram.
+
+Использование:
+    python3 scripts/bench_tryon_image.py
+    BENCH_IMAGES=16 BENCH_SIZE=1536x2048 python3 scripts/bench_tryon_image.py
+    BENCH_INPUT=photo.png python3 scripts/bench_tryon_image.py
+"""
+
+import io
+import os
+import sys
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from PIL import Image, ImageEnhance, ImageDraw, ImageFilter
+
+from app.services.image_processing import enhance_image, IMAGE_WORKERS
+
+IMAGES = int(os.getenv("BENCH_IMAGES", "8"))
+SIZE = tuple(int(x) for x in os.getenv("BENCH_SIZE", "1024x1536").split("x"))
+INPUT = os.getenv("BENCH_INPUT")
+
+def make_sample() -> bytes:
+    """Тестовое изображение: фото из BENCH_INPUT или синтетика с градиентом и шумом"""
+    if INPUT:
+        return Path(INPUT).read_bytes()
+    width, height = SIZE
+    image = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+    noise = Image.effect_noise((width, height), 40).convert("RGB")
+    image = Image.blend(image, noise, 0.3)
+    draw = ImageDraw.Draw(image)
+    for i in range(0, width, 64):
+        draw.ellipse((i, i, i + 200, i + 300), outline=(200, 40, 40), width=6)
+    image = image.filter(ImageFilter.GaussianBlur(1))
+    output = io.BytesIO()
+    image.save(output, format="PNG")
+    return output.getvalue()
+
+def legacy_enhance(image_bytes: bytes) -> bytes:
+    """Прежняя обработка (без MedianFilter(size=1) - он ничего не делал)"""
+    image = Image.open(io.BytesIO(image_bytes))
+    image = ImageEnhance.Sharpness(image).enhance(1.2)
+    image = ImageEnhance.Contrast(image).enhance(1.1)
+    output = io.BytesIO()
+    image.save(output, format='PNG', quality=95, optimize=True, compress_level=0)
+    return output.getvalue()
+
+async def run(name: str, executor, func, sample: bytes, *args):
+    loop = asyncio.get_running_loop()
+    # Прогрев пула
+    await loop.run_in_executor(executor, func, sample, *args)
+    started = time.perf_counter()
+    results = await asyncio.gather(
+        *(loop.run_in_executor(executor, func, sample, *args) for _ in range(IMAGES))
+    )
+    elapsed = time.perf_counter() - started
+    size = len(results[0])
+    print(f"{name:<28} {elapsed:8.2f}s {IMAGES / elapsed:8.2f} img/s {size / 1024:10.0f} KB")
+    return elapsed, size
+
+async def main():
+    sample = make_sample()
+    print(f"Изображение: {len(sample) / 1024:.0f} KB, {IMAGES} шт., воркеров: {IMAGE_WORKERS}\n")
+    print(f"{'Вариант':<28} {'время':>9} {'скорость':>12} {'размер':>13}")
+
+    with ThreadPoolExecutor(max_workers=IMAGE_WORKERS) as threads, \
+            ProcessPoolExecutor(max_workers=IMAGE_WORKERS) as processes:
+        base_time, base_size = await run("PNG level 0, потоки", threads, legacy_enhance, sample)
+        for fmt in ("JPEG", "WEBP"):
+            await run(f"{fmt} q90, потоки", threads, enhance_image, sample, fmt, 90)
+            elapsed, size = await run(f"{fmt} q90, процессы", processes, enhance_image, sample, fmt, 90)
+            print(f"  → {fmt}: время x{base_time / elapsed:.2f}, байты -{100 - size * 100 / base_size:.0f}%")
+
+if __name__ == "__main__":
+    asyncio.run(main())
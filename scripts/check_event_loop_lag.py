@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Проверка: улучшение промпта в text.handle_text_message не блокирует event loop
+
+OpenAI клиент подменяется заглушкой, которая отвечает через GPT_DELAY секунд.
+Пока обработчик ждёт ответа, отдельная задача каждые 10 мс замеряет
+задержку event loop. Проверяется, что:
+- задержка не превышает LAG_THRESHOLD_MS (другие апдейты обрабатываются);
+- при медленном ответе дольше тайм-аута обработчик берёт исходный текст.
+
+Использование:
+    python3 scripts/check_event_loop_lag.py
+    GPT_DELAY=3 LAG_THRESHOLD_MS=50 python3 scripts/check_event_loop_lag.py
+"""
+
+import os
+import sys
+import time
+import asyncio
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+os.environ.setdefault("BOT_TOKEN", "123456:check-event-loop-lag")
+
+from app.handlers import text as text_handlers
+from app.handlers.states import get_user_state
+from app.services import ai_helper, gpt_templates
+
+GPT_DELAY = float(os.getenv("GPT_DELAY", "1.5"))
+LAG_THRESHOLD_MS = float(os.getenv("LAG_THRESHOLD_MS", "100"))
+TICK = 0.01
+USER_ID = 424242
+
+class FakeCompletions:
+    """chat.completions с ответом через заданное время"""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+
+    async def create(self, **kwargs):
+        await asyncio.sleep(self.delay)
+        message = SimpleNamespace(content="improved scene")
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+class FakeClient:
+    def __init__(self, delay: float):
+        self.chat = SimpleNamespace(completions=FakeCompletions(delay))
+
+    async def close(self):
+        pass
+
+class FakeMessage:
+    def __init__(self, text: str):
+        self.text = text
+        self.from_user = SimpleNamespace(id=USER_ID)
+        self.answers = []
+
+    async def answer(self, text: str, **kwargs):
+        self.answers.append(text)
+
+async def measure_lag(stop: asyncio.Event) -> float:
+    """Максимальная задержка пробуждения (мс) относительно TICK"""
+    worst = 0.0
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(TICK)
+        worst = max(worst, (time.perf_counter() - started - TICK) * 1000)
+    return worst
+
+async def run_helper(delay: float, timeout: float):
+    """Прогнать helper режим handle_text_message, вернуть (лаг мс, промпт, длительность)"""
+    ai_helper._client = FakeClient(delay)
+    gpt_templates.PROMPT_IMPROVE_TIMEOUT = timeout
+
+    prompts = []
+
+    async def fake_handle_text_input(message, custom_prompt=None):
+        prompts.append(custom_prompt)
+
+    text_handlers.handle_text_input = fake_handle_text_input
+
+    state = get_user_state(USER_ID)
+    state.awaiting_prompt = True
+    state.mode = "helper"
+
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(measure_lag(stop))
+    started = time.perf_counter()
+    await text_handlers.handle_text_message(FakeMessage("бабка на самокате"))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    return await lag_task, prompts[0] if prompts else None, elapsed
+
+async def main() -> bool:
+    ok = True
+
+    lag, prompt, elapsed = await run_helper(GPT_DELAY, GPT_DELAY * 4)
+    print(f"GPT {GPT_DELAY}s: обработчик {elapsed:.2f}s, лаг event loop {lag:.1f} мс, промпт: {prompt!r}")
+    if lag > LAG_THRESHOLD_MS:
+        print(f"❌ Лаг {lag:.1f} мс больше порога {LAG_THRESHOLD_MS} мс")
+        ok = False
+    if prompt != "improved scene":
+        print("❌ Улучшенный промпт не дошёл до генерации")
+        ok = False
+
+    timeout = GPT_DELAY / 3
+    lag, prompt, elapsed = await run_helper(GPT_DELAY, timeout)
+    print(f"Тайм-аут {timeout:.2f}s: обработчик {elapsed:.2f}s, лаг {lag:.1f} мс, промпт: {prompt!r}")
+    if elapsed > timeout + 0.5 or prompt != "бабка на самокате":
+        print("❌ По тайм-ауту обработчик должен сразу взять исходный текст")
+        ok = False
+
+    print("✅ Проверка пройдена" if ok else "❌ Проверка не пройдена")
+    return ok
+
+if __name__ == "__main__":
+    sys.exit(0 if asyncio.run(main()) else 1)
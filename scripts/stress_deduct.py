@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Нагрузочная проверка атомарного списания монеток против локального Postgres
+
+Создаёт тестового пользователя, запускает много параллельных списаний
+и проверяет, что баланс не ушёл в минус, а журнал транзакций сходится.
+
+Использование:
+    DATABASE_URL=postgresql://localhost/kudoaibot_test python3 scripts/stress_deduct.py
+"""
+
+import os
+import sys
+import asyncio
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from app.db import database
+from app.services.dual_balance import deduct_coins
+
+TEST_USER_ID = int(os.getenv("STRESS_USER_ID", "-424242"))
+SUBSCRIPTION_COINS = int(os.getenv("STRESS_SUB_COINS", "37"))
+PERMANENT_COINS = int(os.getenv("STRESS_PERM_COINS", "63"))
+COST = int(os.getenv("STRESS_COST", "3"))
+ATTEMPTS = int(os.getenv("STRESS_ATTEMPTS", "200"))
+
+async def prepare_user(pool):
+    """Пересоздать тестового пользователя с известным балансом"""
+    async with pool.acquire() as conn:
+        await conn.execute("DELETE FROM transactions WHERE user_id = $1", TEST_USER_ID)
+        await conn.execute("DELETE FROM users WHERE user_id = $1", TEST_USER_ID)
+        await conn.execute("""
+            INSERT INTO users (user_id, username, subscription_coins, permanent_coins, balance)
+            VALUES ($1, 'stress_test', $2, $3, $2 + $3)
+        """, TEST_USER_ID, SUBSCRIPTION_COINS, PERMANENT_COINS)
+
+async def main() -> bool:
+    if not await database.init_db():
+        print("❌ Не удалось подключиться к DATABASE_URL")
+        return False
+
+    pool = database.get_db_pool()
+    try:
+        await prepare_user(pool)
+
+        results = await asyncio.gather(
+            *(deduct_coins(TEST_USER_ID, COST, feature="stress_test") for _ in range(ATTEMPTS))
+        )
+        succeeded = [r for r in results if r['success']]
+
+        async with pool.acquire() as conn:
+            user = await conn.fetchrow(
+                "SELECT subscription_coins, permanent_coins, balance FROM users WHERE user_id = $1",
+                TEST_USER_ID
+            )
+            ledger = await conn.fetchrow("""
+                SELECT COUNT(*) AS cnt, COALESCE(SUM(coins_delta), 0) AS total
+                FROM transactions WHERE user_id = $1
+            """, TEST_USER_ID)
+
+        initial = SUBSCRIPTION_COINS + PERMANENT_COINS
+        expected_success = min(ATTEMPTS, initial // COST)
+        final = user['subscription_coins'] + user['permanent_coins']
+
+        print(f"Попыток: {ATTEMPTS}, успешных: {len(succeeded)} (ожидалось {expected_success})")
+        print(f"Баланс: {initial} → {final} (🟢 {user['subscription_coins']}, 🟣 {user['permanent_coins']})")
+        print(f"Журнал: {ledger['cnt']} строк, сумма {ledger['total']}")
+
+        checks = [
+            ("количество успешных списаний", len(succeeded) == expected_success),
+            ("баланс не отрицательный", user['subscription_coins'] >= 0 and user['permanent_coins'] >= 0),
+            ("баланс сходится", final == initial - COST * len(succeeded)),
+            ("balance = sub + perm", user['balance'] == final),
+            ("журнал сходится", ledger['cnt'] == len(succeeded) and -ledger['total'] == COST * len(succeeded)),
+            ("подписочные списаны первыми", user['permanent_coins'] == PERMANENT_COINS
+                or user['subscription_coins'] == 0),
+        ]
+
+        ok = True
+        for name, passed in checks:
+            print(f"{'✅' if passed else '❌'} {name}")
+            ok = ok and passed
+        return ok
+    finally:
+        async with pool.acquire() as conn:
+            await conn.execute("DELETE FROM transactions WHERE user_id = $1", TEST_USER_ID)
+            await conn.execute("DELETE FROM users WHERE user_id = $1", TEST_USER_ID)
+        await database.close_db()
+
+if __name__ == "__main__":
+    sys.exit(0 if asyncio.run(main()) else 1)